@@ -1,4 +1,5 @@
 import logging
+from asyncio import iscoroutinefunction
 from collections import defaultdict
 
 from django.utils.module_loading import autodiscover_modules
@@ -24,17 +25,39 @@ class HandlerRegistry:
     def __init__(self):
         self._handlers = defaultdict(callable)
         self._button_handlers = defaultdict(callable)
+        self._async_handlers = set()
 
     def handler(self, handler):
-        self._handlers[f'{handler.__module__}.{handler.__name__}'] = handler
+        name = self._register(handler)
+        self._handlers[name] = handler
 
         return handler
 
     def button_handler(self, handler):
-        self._button_handlers[f'{handler.__module__}.{handler.__name__}'] = handler
+        name = self._register(handler)
+        self._button_handlers[name] = handler
 
         return handler
 
+    def is_async(self, name: str, handler=None) -> bool:
+        """
+        Check the handler is a coroutine function (`async def`)
+        :param name: handler import path
+        :param handler: handler function, if it may be not registered
+        :return: True if the handler must be awaited
+        """
+        if name in self._async_handlers:
+            return True
+        return handler is not None and iscoroutinefunction(handler)
+
+    def _register(self, handler) -> str:
+        name = f'{handler.__module__}.{handler.__name__}'
+        if iscoroutinefunction(handler):
+            self._async_handlers.add(name)
+        else:
+            self._async_handlers.discard(name)
+        return name
+
     @property
     def handlers(self):
         return self._handlers
@@ -1,13 +1,22 @@
 import logging
+from collections import defaultdict
+from datetime import timedelta
 
 from django import forms
 from django.contrib import admin
 from django.forms.widgets import Select
+from django.db.models import OuterRef, Subquery, Sum
 from django.template.defaultfilters import pluralize
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from . import bot
-from .models import Messenger, Account, Menu, Button
+from .models import (
+    Messenger, Account, Menu, Button, FailedUpdate, InteractionStats,
+    MessageLog, OutboxMessage, OutboxStatus, Segment, StatsKind
+)
+from .profiles import profile_updater
+from .stats import usage_summary
 from .types import Text
 
 
@@ -99,6 +108,15 @@ class MessengerAdmin(admin.ModelAdmin):
             'fields': ('handler_list', 'handler', 'menu', 'welcome_text'),
             'classes': ('extrapretty', 'wide'),
         }),
+        (_('Stale messages'), {
+            'fields': ('stale_timeout', 'stale_policy', 'stale_text'),
+            'classes': ('extrapretty', 'wide', 'collapse', 'in'),
+        }),
+        (_('Webhook'), {
+            'fields': ('webhook_max_connections', 'webhook_allowed_updates',
+                       'webhook_drop_pending_updates', 'webhook_event_types'),
+            'classes': ('extrapretty', 'wide', 'collapse', 'in'),
+        }),
         (_('Proxy'), {
             'fields': ('proxy', ),
             'classes': ('extrapretty', 'wide', 'collapse', 'in'),
@@ -161,17 +179,17 @@ class AccountAdmin(admin.ModelAdmin):
                     'utm_source', 'is_active', 'updated')
     list_filter = ('messenger', 'utm_source', 'is_active', 'updated', 'created')
     search_fields = ('id', 'username', 'utm_source')
-    readonly_fields = ('id', 'info', 'messenger',
+    readonly_fields = ('id', 'info', 'avatar_url', 'messenger',
                        'is_active', 'updated', 'created')
-    actions = ('send_ping', 'update_info')
+    actions = ('send_ping', 'check_subscription', 'update_info')
     fieldsets = (
         (None, {
             'fields': ('id', 'messenger', 'is_active', 'username', 'user'),
             'classes': ('extrapretty', 'wide'),
         }),
         (_('Info'), {
-            'fields': ('info', 'menu', 'context', 'phone', 'utm_source',
-                       'updated', 'created'),
+            'fields': ('avatar_url', 'info', 'menu', 'context', 'phone',
+                       'utm_source', 'updated', 'created'),
             'classes': ('extrapretty', 'wide'),
         })
     )
@@ -179,18 +197,75 @@ class AccountAdmin(admin.ModelAdmin):
     class Meta:
         model = Account
 
+    def get_queryset(self, request):
+        queryset = Account.full.get_queryset()
+        ordering = self.get_ordering(request)
+        if ordering:
+            queryset = queryset.order_by(*ordering)
+        return queryset
+
     def send_ping(self, request, queryset):
-        # TODO: implement checking subscription or ping message (mb. user_info?)
         for account in queryset:
             account.send_message(Text(text='ping'))
     send_ping.short_description = _('Send ping')
 
+    def check_subscription(self, request, queryset):
+        accounts = defaultdict(list)
+        for account in queryset.select_related('messenger'):
+            if account.messenger:
+                accounts[account.messenger].append(account)
+
+        changed = 0
+        for messenger, messenger_accounts in accounts.items():
+            changed += messenger.probe_accounts(messenger_accounts)
+        self.message_user(request, _(f'{changed} account{pluralize(changed)} '
+                                     f'changed subscription status'))
+    check_subscription.short_description = _('Check subscription')
+
     def update_info(self, request, queryset):
-        for account in queryset:
-            account.update_info()
+        queued = 0
+        for account in queryset.select_related(None).only('id', 'messenger_id'):
+            queued += profile_updater.enqueue(account)
+        self.message_user(request, _(f'{queued} account{pluralize(queued)} '
+                                     f'queued for update'))
     update_info.short_description = _('Update info')
 
 
+class UsageStatsMixin:
+    """
+    Menu and button usage for the last week from the stats table.
+    """
+    stats_kind = None
+    stats_days = 7
+
+    def get_queryset(self, request):
+        since = timezone.now() - timedelta(days=self.stats_days)
+        clicks = (InteractionStats.objects
+                  .filter(kind=self.stats_kind, object_id=OuterRef('pk'),
+                          bucket__gte=since)
+                  .order_by().values('object_id')
+                  .annotate(total=Sum('clicks')).values('total'))
+        return super().get_queryset(request).annotate(
+            week_clicks=Subquery(clicks))
+
+    def week_clicks(self, obj):
+        return obj.week_clicks or 0
+    week_clicks.short_description = _('clicks (7 days)')
+    week_clicks.admin_order_field = 'week_clicks'
+
+    def usage_stats(self, obj):
+        if not obj.pk:
+            return '-'
+        usage = usage_summary(self.stats_kind, [obj.pk],
+                              self.stats_days).get(obj.pk)
+        if not usage:
+            return _('No clicks')
+        return _(f'Clicks: {usage["clicks"]}; '
+                 f'unique accounts: ~{usage["unique_accounts"]}; '
+                 f'handler errors: {usage["errors"]}')
+    usage_stats.short_description = _('usage (7 days)')
+
+
 class MenuForm(forms.ModelForm):
     """
     Form that lets you create and modify chatbot menus.
@@ -219,16 +294,18 @@ class MenuForm(forms.ModelForm):
 
 
 @admin.register(Menu)
-class MenuAdmin(admin.ModelAdmin):
+class MenuAdmin(UsageStatsMixin, admin.ModelAdmin):
     """
     Admin-interface for chatbot menus.
     """
     form = MenuForm
+    stats_kind = StatsKind.MENU
 
-    list_display = ('title', 'message', 'handler', 'comment', 'updated')
+    list_display = ('title', 'message', 'handler', 'comment', 'week_clicks',
+                    'updated')
     list_filter = ('updated', 'created')
     search_fields = ('title', 'message', 'comment', 'handler')
-    readonly_fields = ('updated', )
+    readonly_fields = ('usage_stats', 'updated', )
     # filter_horizontal = ('buttons', )  # used sortedm2m
     fieldsets = (
         (None, {
@@ -236,6 +313,10 @@ class MenuAdmin(admin.ModelAdmin):
                        'buttons', 'comment'),
             'classes': ('extrapretty', 'wide'),
         }),
+        (_('Usage'), {
+            'fields': ('usage_stats', ),
+            'classes': ('extrapretty', 'wide'),
+        }),
     )
 
     class Meta:
@@ -290,18 +371,19 @@ class ButtonForm(forms.ModelForm):
 
 
 @admin.register(Button)
-class ButtonAdmin(admin.ModelAdmin):
+class ButtonAdmin(UsageStatsMixin, admin.ModelAdmin):
     """
     Admin-interface for chatbot buttons.
     """
     form = ButtonForm
+    stats_kind = StatsKind.BUTTON
 
     list_display = ('title', 'text', 'handler', 'next_menu',
                     'is_inline', 'for_staff', 'for_admin', 'is_active',
-                    'comment', 'updated')
+                    'comment', 'week_clicks', 'updated')
     list_filter = ('is_inline', 'for_staff', 'for_admin', 'is_active')
     search_fields = ('title', 'text', 'message', 'comment', 'command')
-    readonly_fields = ('command', 'updated', )
+    readonly_fields = ('command', 'usage_stats', 'updated', )
     fieldsets = (
         (None, {
             'fields': ('title', 'text', 'command', 'message',
@@ -310,7 +392,129 @@ class ButtonAdmin(admin.ModelAdmin):
                        'comment'),
             'classes': ('extrapretty', 'wide'),
         }),
+        (_('Usage'), {
+            'fields': ('usage_stats', ),
+            'classes': ('extrapretty', 'wide'),
+        }),
     )
 
     class Meta:
         model = Button
+
+
+@admin.register(FailedUpdate)
+class FailedUpdateAdmin(admin.ModelAdmin):
+    """
+    Admin-interface for failed incoming updates (dead letters).
+    """
+    list_display = ('__str__', 'messenger', 'attempts', 'updated', 'created')
+    list_filter = ('messenger', 'attempts', 'created')
+    search_fields = ('body', 'error')
+    readonly_fields = ('messenger', 'body', 'headers', 'error', 'traceback',
+                       'attempts', 'updated', 'created')
+    actions = ('replay', )
+
+    class Meta:
+        model = FailedUpdate
+
+    def has_add_permission(self, request):
+        return False
+
+    def replay(self, request, queryset):
+        processed = 0
+        for update in queryset.select_related('messenger'):
+            if update.replay():
+                update.delete()
+                processed += 1
+            else:
+                update.save()
+        self.message_user(request, _(f'{processed} update{pluralize(processed)} '
+                                     f'successfully replayed'))
+    replay.short_description = _('Replay selected updates')
+
+
+@admin.register(OutboxMessage)
+class OutboxMessageAdmin(admin.ModelAdmin):
+    """
+    Admin-interface for outbound messages waiting for the relay.
+    """
+    list_display = ('__str__', 'messenger', 'status', 'attempts',
+                    'available_at', 'sent_at', 'created')
+    list_filter = ('status', 'messenger', 'created')
+    search_fields = ('account__id', 'account__username', 'error')
+    readonly_fields = ('messenger', 'account', 'idempotency_key', 'status',
+                       'attempts', 'available_at', 'error', 'sent_at',
+                       'created')
+    exclude = ('payload', )
+    actions = ('retry', )
+
+    class Meta:
+        model = OutboxMessage
+
+    def has_add_permission(self, request):
+        return False
+
+    def retry(self, request, queryset):
+        count = queryset.exclude(status=OutboxStatus.SENT).update(
+            status=OutboxStatus.PENDING, attempts=0,
+            available_at=timezone.now())
+        self.message_user(request, _(f'{count} message{pluralize(count)} '
+                                     f'queued again'))
+    retry.short_description = _('Send selected messages again')
+
+
+@admin.register(MessageLog)
+class MessageLogAdmin(admin.ModelAdmin):
+    """
+    Admin-interface for the message history (SAVE_MESSAGES setting).
+    """
+    list_display = ('account_id', 'messenger', 'direction', 'message_type',
+                    'text', 'created')
+    list_filter = ('direction', 'messenger', 'message_type')
+    date_hierarchy = 'created'
+    search_fields = ('text', )
+    readonly_fields = ('messenger', 'account', 'direction', 'message_type',
+                       'message_id', 'text', 'payload', 'created')
+    show_full_result_count = False
+
+    class Meta:
+        model = MessageLog
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_search_results(self, request, queryset, search_term):
+        # the full-text index instead of LIKE over every row
+        return queryset.search(search_term), False
+
+
+@admin.register(Segment)
+class SegmentAdmin(admin.ModelAdmin):
+    """
+    Admin-interface for audience segments.
+    """
+    list_display = ('title', 'messenger', 'menu', 'utm_source', 'is_active',
+                    'seen_days', 'size', 'refreshed_at')
+    list_filter = ('messenger', 'menu', 'is_active')
+    search_fields = ('title', 'utm_source')
+    readonly_fields = ('size', 'refreshed_at', 'updated', 'created')
+    actions = ('refresh', )
+
+    class Meta:
+        model = Segment
+
+    def save_model(self, request, obj, form, change):
+        # a rebuild of a large audience doesn't fit in a request,
+        # the refresh_segments command rebuilds dirty segments
+        if form.changed_data:
+            obj.refreshed_at = None
+        super().save_model(request, obj, form, change)
+
+    def refresh(self, request, queryset):
+        count = queryset.update(refreshed_at=None)
+        self.message_user(request, _(f'{count} segment{pluralize(count)} '
+                                     f'queued for refresh'))
+    refresh.short_description = _('Refresh selected segments')
@@ -0,0 +1,34 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Coroutine
+
+
+_loop = None
+_lock = threading.Lock()
+
+
+def event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Shared event loop of async handlers and connectors.
+    It runs in a daemon thread, so coroutines can be scheduled
+    from sync code under both WSGI and ASGI.
+    """
+    global _loop
+    if _loop is None:
+        with _lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever,
+                                 name='bot-engine-loop', daemon=True).start()
+                _loop = loop
+    return _loop
+
+
+def run_coroutine(coro: Coroutine) -> Future:
+    """
+    Schedule the coroutine on the shared event loop
+    :param coro: coroutine object
+    :return: concurrent.futures.Future with the result
+    """
+    return asyncio.run_coroutine_threadsafe(coro, event_loop())
@@ -7,4 +7,6 @@ class BotEngineConfig(AppConfig):
     verbose_name = 'Django Bot Engine'
 
     def ready(self):
+        from . import segments  # noqa: F401 (signal receivers)
+
         self.module.autodiscover()
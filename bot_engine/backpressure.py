@@ -0,0 +1,76 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+from .errors import Overloaded
+from .lanes import queue_depth
+from .settings import bot_api_settings
+from .types import Message, Event, EType
+
+
+log = logging.getLogger(__name__)
+
+LOW_VALUE_EVENTS = (EType.DELIVERED, EType.SEEN)
+
+
+class LoadGuard:
+    """
+    Webhook backpressure. Above the high-water marks low-value updates
+    are dropped and the rest are rejected with a retryable status,
+    so the messenger API backs off and delivers them later.
+    """
+
+    def __init__(self):
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @contextmanager
+    def track(self):
+        """
+        Count a dispatch in flight
+        """
+        with self._lock:
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def is_overloaded(self) -> bool:
+        max_in_flight = bot_api_settings.WEBHOOK_MAX_IN_FLIGHT
+        max_queue_depth = bot_api_settings.WEBHOOK_MAX_QUEUE_DEPTH
+        return bool(
+            (max_in_flight and self._in_flight > max_in_flight) or
+            (max_queue_depth and queue_depth() > max_queue_depth)
+        )
+
+    def admit(self, messenger, message: Message) -> bool:
+        """
+        Check the load before processing the message
+        :param messenger: bot_engine.Messenger object
+        :param message: parsed message
+        :return: False if the message must be dropped
+        :raise Overloaded: the message must be retried later
+        """
+        if not self.is_overloaded():
+            return True
+
+        if isinstance(message, Event):
+            is_low_value = message.event_type in LOW_VALUE_EVENTS
+        else:
+            is_low_value = messenger.is_stale(message.sent_at)
+        if is_low_value:
+            log.debug(f'Load guard; Dropped message={message};')
+            return False
+
+        raise Overloaded(f'Webhook is overloaded; In flight={self._in_flight};'
+                         f' Queue depth={queue_depth()}',
+                         retry_after=bot_api_settings.WEBHOOK_RETRY_AFTER)
+
+
+load_guard = LoadGuard()
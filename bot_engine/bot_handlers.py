@@ -26,3 +26,4 @@ def button_echo(message: Message, account: Account):
     Simple echo on the button.
     """
     account.send_message(message)
+
@@ -0,0 +1,183 @@
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from typing import Any, Callable, Dict
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+
+from . import bot
+from .aio import run_coroutine
+from .settings import bot_api_settings
+
+
+log = logging.getLogger(__name__)
+
+
+class HandlerBudget:
+    """
+    Runs handlers under a time budget.
+    The caller stops waiting for a handler that exceeds the budget,
+    and a handler that exceeds it repeatedly is moved to a small
+    background executor, so it can't take all the workers.
+    """
+
+    def __init__(self):
+        self.overruns: Dict[str, int] = Counter()
+        self.offloaded = set()
+        self._executor = None
+        self._background = None
+        self._lock = threading.Lock()
+
+    def run(self, name: str, handler: Callable, *args,
+            on_error: Callable[[Exception], Any] = None, **kwargs) -> Any:
+        """
+        Call the handler under the time budget. A handler that can outlive
+        the call gets its own copy of the account and saves its context
+        itself, the account is reloaded if the handler finishes in time.
+        Errors of a handler that is not waited for are logged.
+        :param name: handler import path
+        :param handler: handler function
+        :param on_error: called with the error of a handler that is
+            not waited for (optional)
+        :return: handler result or None if it is not finished in time
+        """
+        budget = bot_api_settings.HANDLER_TIME_BUDGET
+        is_async = bot.is_async(name, handler)
+        offloaded = name in self.offloaded
+        if not budget and not offloaded:
+            if is_async:
+                # coroutines are awaited on the shared loop without a thread
+                return run_coroutine(handler(*args, **kwargs)).result()
+            return handler(*args, **kwargs)
+
+        detached = self._detach(args)
+        if is_async:
+            future = run_coroutine(self._acall(handler, detached, kwargs))
+        elif offloaded:
+            future = self._get_background().submit(
+                self._call, handler, detached, kwargs)
+        else:
+            future = self._get_executor().submit(
+                self._call, handler, detached, kwargs)
+
+        if offloaded:
+            self._watch(name, future, on_error)
+            return None
+        try:
+            return future.result(timeout=budget)
+        except TimeoutError:
+            self.overrun(name, budget)
+            self._watch(name, future, on_error)
+            return None
+        finally:
+            if future.done():
+                self._attach(args, detached)
+
+    def overrun(self, name: str, budget: float):
+        with self._lock:
+            self.overruns[name] += 1
+            overruns = self.overruns[name]
+            if overruns >= bot_api_settings.HANDLER_OFFLOAD_AFTER:
+                self.offloaded.add(name)
+        log.warning(f'Handler budget; Handler={name}; Budget={budget}s; '
+                    f'Overruns={overruns}; Offloaded={name in self.offloaded};')
+
+    def reset(self, name: str = None):
+        """
+        Forget overruns of the handler (all handlers by default)
+        """
+        with self._lock:
+            if name is None:
+                self.overruns.clear()
+                self.offloaded.clear()
+            else:
+                self.overruns.pop(name, None)
+                self.offloaded.discard(name)
+
+    @staticmethod
+    def _detach(args: tuple) -> tuple:
+        # the account of the dispatch is not shared with another thread:
+        # the send position and the context are copied
+        from .models import Account
+
+        detached = []
+        for arg in args:
+            if isinstance(arg, Account):
+                arg.state.save()
+                arg = arg.detached()
+            detached.append(arg)
+        return tuple(detached)
+
+    @staticmethod
+    def _attach(args: tuple, detached: tuple):
+        # the dispatch goes on with the changes of the finished handler
+        from .models import Account
+
+        for arg, copy in zip(args, detached):
+            if isinstance(arg, Account):
+                arg.attach(copy)
+
+    @staticmethod
+    def _save_context(args: tuple):
+        from .models import Account
+
+        for arg in args:
+            if isinstance(arg, Account):
+                arg.state.save()
+
+    @classmethod
+    def _call(cls, handler: Callable, args: tuple, kwargs: dict) -> Any:
+        close_old_connections()
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            try:
+                cls._save_context(args)
+            finally:
+                close_old_connections()
+
+    @classmethod
+    async def _acall(cls, handler: Callable, args: tuple,
+                     kwargs: dict) -> Any:
+        try:
+            return await handler(*args, **kwargs)
+        finally:
+            await sync_to_async(cls._save_context,
+                                thread_sensitive=False)(args)
+
+    @staticmethod
+    def _watch(name: str, future: Future,
+               on_error: Callable[[Exception], Any] = None):
+        def done(future: Future):
+            if future.cancelled() or future.exception() is None:
+                return
+            error = future.exception()
+            log.error(f'Handler budget; Handler={name}; Error={error};',
+                      exc_info=error)
+            if on_error is not None:
+                on_error(error)
+
+        future.add_done_callback(done)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        bot_api_settings.HANDLER_WORKERS,
+                        thread_name_prefix='bot-engine-handler')
+        return self._executor
+
+    def _get_background(self) -> ThreadPoolExecutor:
+        if self._background is None:
+            with self._lock:
+                if self._background is None:
+                    self._background = ThreadPoolExecutor(
+                        bot_api_settings.HANDLER_BACKGROUND_WORKERS,
+                        thread_name_prefix='bot-engine-slow-handler')
+        return self._background
+
+
+handler_budget = HandlerBudget()
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Any, Callable, Dict, MutableMapping
+
+from .errors import CircuitOpen, MessengerException, MessengerTimeout
+from .settings import bot_api_settings
+
+
+log = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """
+    Opens after a number of failures in a row and rejects calls
+    until the reset timeout passes, then lets one trial call through.
+    Another trial call is let through only if the first one hasn't
+    reported its result within the reset timeout.
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            if (self.probe_at is not None
+                    and now - self.probe_at < self.reset_timeout):
+                # half-open: the trial call is in progress
+                return False
+            self.probe_at = now
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probe_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.probe_at is not None or self.failures >= self.threshold:
+                # a failed trial call opens the circuit again
+                self.opened_at = time.monotonic()
+                self.probe_at = None
+
+
+class Bulkhead:
+    """
+    Isolated capacity for outbound calls of one messenger:
+    its own executor, a bounded queue, a call timeout and
+    a circuit breaker, so a slow or failing API can't take
+    the capacity of other messengers.
+    """
+
+    def __init__(self, name: str, max_concurrent: int, max_queue: int,
+                 timeout: float, breaker: CircuitBreaker):
+        self.name = name
+        self.timeout = timeout
+        self.breaker = breaker
+        self.max_concurrent = max_concurrent
+        self._executor = ThreadPoolExecutor(
+            max_concurrent, thread_name_prefix=f'bot-engine-{name}')
+        self._slots = threading.BoundedSemaphore(max_concurrent + max_queue)
+        # an asyncio semaphore is bound to a loop, every loop has its own
+        self._async_slots: MutableMapping[
+            asyncio.AbstractEventLoop, asyncio.Semaphore
+        ] = weakref.WeakKeyDictionary()
+
+    def call(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Call the API function in the bulkhead
+        :param func: connector method
+        :return: function result
+        :raise CircuitOpen: the circuit is open or the bulkhead is full
+        :raise MessengerTimeout: the call timed out
+        :raise MessengerException: the call failed
+        """
+        if not self.breaker.allow():
+            raise CircuitOpen(f'Circuit is open; Bulkhead={self.name};')
+        if not self._slots.acquire(blocking=False):
+            raise CircuitOpen(f'Bulkhead is full; Bulkhead={self.name};')
+
+        try:
+            future = self._executor.submit(func, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            result = future.result(timeout=self.timeout)
+        except TimeoutError:
+            self._failure()
+            raise MessengerTimeout(f'API call timed out; '
+                                   f'Bulkhead={self.name};')
+        except MessengerException:
+            self._failure()
+            raise
+        self.breaker.success()
+        return result
+
+    async def acall(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Await the async API function in the bulkhead.
+        Concurrent calls are limited in each event loop.
+        """
+        if not self.breaker.allow():
+            raise CircuitOpen(f'Circuit is open; Bulkhead={self.name};')
+        loop = asyncio.get_running_loop()
+        slots = self._async_slots.get(loop)
+        if slots is None:
+            slots = self._async_slots.setdefault(
+                loop, asyncio.Semaphore(self.max_concurrent))
+
+        async with slots:
+            try:
+                result = await asyncio.wait_for(func(*args, **kwargs),
+                                                self.timeout)
+            except asyncio.TimeoutError:
+                self._failure()
+                raise MessengerTimeout(f'API call timed out; '
+                                       f'Bulkhead={self.name};')
+            except MessengerException:
+                self._failure()
+                raise
+        self.breaker.success()
+        return result
+
+    def _failure(self):
+        was_open = self.breaker.is_open
+        self.breaker.failure()
+        if self.breaker.is_open and not was_open:
+            log.warning(f'Circuit opened; Bulkhead={self.name};')
+
+
+_bulkheads: Dict[Any, Bulkhead] = {}
+_lock = threading.Lock()
+
+
+def bulkhead(messenger) -> Bulkhead:
+    """
+    Bulkhead of the messenger
+    :param messenger: bot_engine.Messenger object
+    :return: Bulkhead object
+    """
+    if messenger.id not in _bulkheads:
+        with _lock:
+            if messenger.id not in _bulkheads:
+                _bulkheads[messenger.id] = Bulkhead(
+                    f'messenger-{messenger.id}',
+                    max_concurrent=bot_api_settings.BULKHEAD_MAX_CONCURRENT,
+                    max_queue=bot_api_settings.BULKHEAD_MAX_QUEUE,
+                    timeout=bot_api_settings.BULKHEAD_TIMEOUT,
+                    breaker=CircuitBreaker(
+                        bot_api_settings.CIRCUIT_FAILURE_THRESHOLD,
+                        bot_api_settings.CIRCUIT_RESET_TIMEOUT))
+    return _bulkheads[messenger.id]
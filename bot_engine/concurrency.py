@@ -0,0 +1,34 @@
+import logging
+import random
+import time
+from typing import Any, Callable
+
+from .errors import ConcurrentUpdate
+from .settings import bot_api_settings
+
+
+log = logging.getLogger(__name__)
+
+
+def retry_on_conflict(account, func: Callable, *args,
+                      attempts: int = None, **kwargs) -> Any:
+    """
+    Call the function and call it again with the reloaded account
+    if a compare-and-swap update of the account fails
+    :param account: bot_engine.Account object used by the function
+    :param func: function that updates the account with `Account.update()`
+    :param attempts: ACCOUNT_CONFLICT_RETRIES by default
+    :return: function result
+    """
+    attempts = attempts or bot_api_settings.ACCOUNT_CONFLICT_RETRIES
+    for attempt in range(attempts):
+        try:
+            return func(*args, **kwargs)
+        except ConcurrentUpdate as err:
+            if attempt + 1 >= attempts:
+                raise
+            log.info(f'Conflict; Account={account.id}; '
+                     f'Attempt={attempt + 1}; Error={err};')
+            # a short random pause lets the other worker finish
+            time.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+            account.reload()
@@ -0,0 +1,393 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Optional
+
+from django.core.cache import caches
+from django.db import connections, router, transaction
+
+from .settings import bot_api_settings
+
+
+# context key with the expiration time of a TTL'd key (database store)
+EXPIRES_PREFIX = '_expires.'
+
+
+def check_key(key: str):
+    if not isinstance(key, str) or not key or '"' in key or '\\' in key:
+        raise ValueError(f'Invalid context key: {key!r}')
+
+
+class BaseContextStore:
+    """
+    Storage of the conversation state of accounts: small JSON values
+    by string keys. Writes of a key don't rewrite the other keys.
+    """
+
+    def get(self, account_id: str, key: str, default: Any = None) -> Any:
+        raise NotImplementedError('`get()` must be implemented.')
+
+    def get_many(self, account_id: str) -> Dict[str, Any]:
+        """
+        All keys of the account that are not expired
+        """
+        raise NotImplementedError('`get_many()` must be implemented.')
+
+    def set(self, account_id: str, key: str, value: Any,
+            ttl: Optional[int] = None):
+        """
+        :param account_id: account id
+        :param key: context key
+        :param value: JSON serializable value
+        :param ttl: key lifetime in seconds (optional)
+        :return: None
+        """
+        self.set_many(account_id, {key: value}, ttl=ttl)
+
+    def set_many(self, account_id: str, values: Dict[str, Any],
+                 deleted: Iterable[str] = (), ttl: Optional[int] = None):
+        raise NotImplementedError('`set_many()` must be implemented.')
+
+    def delete(self, account_id: str, key: str):
+        self.set_many(account_id, {}, deleted=[key])
+
+    def incr(self, account_id: str, key: str, delta: int = 1) -> int:
+        """
+        Atomic increment, a missing key starts from zero
+        :return: new value
+        """
+        raise NotImplementedError('`incr()` must be implemented.')
+
+
+class DatabaseContextStore(BaseContextStore):
+    """
+    Stores the state in the Account.context JSON field. Keys are written
+    with JSON functions of the database (jsonb_set, JSON_SET), so parallel
+    writes of different keys don't overwrite each other.
+    """
+
+    @staticmethod
+    def _table():
+        from .models import Account
+
+        return Account, connections[router.db_for_write(Account)]
+
+    def get(self, account_id: str, key: str, default: Any = None) -> Any:
+        return self.get_many(account_id).get(key, default)
+
+    def get_many(self, account_id: str) -> Dict[str, Any]:
+        from .models import Account
+
+        context = (Account.objects.filter(id=account_id)
+                   .values_list('context', flat=True).first()) or {}
+        now = time.time()
+        expired = {key[len(EXPIRES_PREFIX):]
+                   for key, expires in context.items()
+                   if key.startswith(EXPIRES_PREFIX) and expires <= now}
+        return {key: value for key, value in context.items()
+                if not key.startswith(EXPIRES_PREFIX) and key not in expired}
+
+    def set_many(self, account_id: str, values: Dict[str, Any],
+                 deleted: Iterable[str] = (), ttl: Optional[int] = None):
+        values = dict(values)
+        deleted = [key for key in deleted if key not in values]
+        for key in list(values):
+            check_key(key)
+            if ttl:
+                values[EXPIRES_PREFIX + key] = time.time() + ttl
+            else:
+                deleted.append(EXPIRES_PREFIX + key)
+        for key in list(deleted):
+            check_key(key)
+            if not key.startswith(EXPIRES_PREFIX):
+                deleted.append(EXPIRES_PREFIX + key)
+        if not values and not deleted:
+            return
+
+        model, connection = self._table()
+        table = connection.ops.quote_name(model._meta.db_table)
+        column = connection.ops.quote_name('context')
+        if connection.vendor == 'postgresql':
+            sql, params = f"COALESCE({column}, '{{}}'::jsonb)", []
+            for key, value in values.items():
+                sql = f'jsonb_set({sql}, %s, %s::jsonb, true)'
+                params += [[key], json.dumps(value)]
+            for key in deleted:
+                sql = f'({sql} - %s)'
+                params.append(key)
+        elif connection.vendor in ('sqlite', 'mysql'):
+            cast = ('JSON(%s)' if connection.vendor == 'sqlite'
+                    else 'CAST(%s AS JSON)')
+            sql, params = f"COALESCE({column}, '{{}}')", []
+            if values:
+                pairs = ', '.join(f'%s, {cast}' for _ in values)
+                sql = f'JSON_SET({sql}, {pairs})'
+                for key, value in values.items():
+                    params += [f'$."{key}"', json.dumps(value)]
+            if deleted:
+                paths = ', '.join('%s' for _ in deleted)
+                sql = f'JSON_REMOVE({sql}, {paths})'
+                params += [f'$."{key}"' for key in deleted]
+        else:
+            self._update_row(account_id, values, deleted)
+            return
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {table} SET {column} = {sql} WHERE id = %s',
+                params + [account_id])
+
+    def incr(self, account_id: str, key: str, delta: int = 1) -> int:
+        check_key(key)
+        model, connection = self._table()
+        expires_key = EXPIRES_PREFIX + key
+        with transaction.atomic(using=connection.alias):
+            context = (model.objects.select_for_update()
+                       .filter(id=account_id)
+                       .values_list('context', flat=True).first()) or {}
+            if context.get(expires_key, float('inf')) <= time.time():
+                context.pop(key, None)
+                context.pop(expires_key, None)
+            value = int(context.get(key) or 0) + delta
+            # the row is locked, only the key is written
+            self.set_many(account_id, {key: value},
+                          ttl=self._ttl_left(context.get(expires_key)))
+        return value
+
+    @staticmethod
+    def _ttl_left(expires: Optional[float]) -> Optional[int]:
+        if expires is None:
+            return None
+        return max(1, int(expires - time.time()))
+
+    def _update_row(self, account_id: str, values: Dict[str, Any],
+                    deleted: Iterable[str]):
+        # databases without JSON functions: a locked read-modify-write
+        model, connection = self._table()
+        with transaction.atomic(using=connection.alias):
+            account = (model.objects.select_for_update()
+                       .only('id', 'context').get(id=account_id))
+            account.context.update(values)
+            for key in deleted:
+                account.context.pop(key, None)
+            # the state is not versioned, a checked save would
+            # outdate the account loaded by the dispatch
+            model.objects.filter(id=account_id).update(
+                context=account.context)
+
+
+class CacheContextStore(BaseContextStore):
+    """
+    Stores the state in the django cache (CONTEXT_CACHE_ALIAS),
+    e.g. Redis. Every key is a cache entry, so TTL and incr are native.
+    The list of keys of an account is changed under a lock made with
+    `cache.add()`, only when a new key is added or a key is deleted.
+    """
+
+    def __init__(self, alias: str = None, timeout: Optional[int] = None):
+        self.alias = alias or bot_api_settings.CONTEXT_CACHE_ALIAS
+        self.timeout = (timeout if timeout is not None
+                        else bot_api_settings.CONTEXT_CACHE_TIMEOUT)
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @staticmethod
+    def _key(account_id: str, key: str = None) -> str:
+        if key is None:
+            return f'bot_engine:ctx:{account_id}'  # list of keys
+        return f'bot_engine:ctx:{account_id}:{key}'
+
+    def get(self, account_id: str, key: str, default: Any = None) -> Any:
+        return self.cache.get(self._key(account_id, key), default)
+
+    def get_many(self, account_id: str) -> Dict[str, Any]:
+        keys = self.cache.get(self._key(account_id)) or []
+        values = self.cache.get_many([self._key(account_id, key)
+                                      for key in keys])
+        prefix = len(self._key(account_id, ''))
+        return {key[prefix:]: value for key, value in values.items()}
+
+    def set_many(self, account_id: str, values: Dict[str, Any],
+                 deleted: Iterable[str] = (), ttl: Optional[int] = None):
+        timeout = ttl or self.timeout
+        deleted = [key for key in deleted if key not in values]
+        if values:
+            self.cache.set_many({self._key(account_id, key): value
+                                 for key, value in values.items()}, timeout)
+        if deleted:
+            self.cache.delete_many([self._key(account_id, key)
+                                    for key in deleted])
+        self._index(account_id, values, deleted)
+
+    def incr(self, account_id: str, key: str, delta: int = 1) -> int:
+        cache_key = self._key(account_id, key)
+        if self.cache.add(cache_key, delta, self.timeout):
+            self._index(account_id, [key])
+            return delta
+        try:
+            return self.cache.incr(cache_key, delta)
+        except ValueError:  # expired between add() and incr()
+            self.cache.set(cache_key, delta, self.timeout)
+            return delta
+
+    def _index(self, account_id: str, added: Iterable[str],
+               deleted: Iterable[str] = ()):
+        index_key = self._key(account_id)
+        added, deleted = set(added), set(deleted)
+        keys = set(self.cache.get(index_key) or [])
+        if added <= keys and not deleted & keys:
+            return
+        # the list of keys is rewritten by one writer at a time
+        with self._lock(index_key):
+            keys = set(self.cache.get(index_key) or [])
+            changed = (keys | added) - deleted
+            if changed != keys:
+                self.cache.set(index_key, sorted(changed), self.timeout)
+
+    @contextmanager
+    def _lock(self, key: str, timeout: int = 5):
+        # cache.add() is atomic, a lock of a dead writer expires
+        lock_key = f'{key}:lock'
+        deadline = time.monotonic() + timeout
+        locked = self.cache.add(lock_key, True, timeout)
+        while not locked and time.monotonic() < deadline:
+            time.sleep(0.005)
+            locked = self.cache.add(lock_key, True, timeout)
+        try:
+            yield
+        finally:
+            if locked:
+                self.cache.delete(lock_key)
+
+
+class MemoryContextStore(BaseContextStore):
+    """
+    Stores the state in the process memory. For tests and single process
+    bots: the state is lost on restart.
+    """
+
+    def __init__(self):
+        self._data: Dict[str, Dict[str, tuple]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, account_id: str, key: str, default: Any = None) -> Any:
+        return self.get_many(account_id).get(key, default)
+
+    def get_many(self, account_id: str) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            items = dict(self._data.get(account_id, {}))
+        return {key: value for key, (value, expires) in items.items()
+                if expires is None or expires > now}
+
+    def set_many(self, account_id: str, values: Dict[str, Any],
+                 deleted: Iterable[str] = (), ttl: Optional[int] = None):
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            data = self._data.setdefault(account_id, {})
+            for key in deleted:
+                data.pop(key, None)
+            for key, value in values.items():
+                data[key] = (value, expires)
+
+    def incr(self, account_id: str, key: str, delta: int = 1) -> int:
+        now = time.monotonic()
+        with self._lock:
+            data = self._data.setdefault(account_id, {})
+            value, expires = data.get(key, (0, None))
+            if expires is not None and expires <= now:
+                value, expires = 0, None
+            data[key] = (int(value) + delta, expires)
+            return data[key][0]
+
+
+class AccountContext:
+    """
+    Conversation state of an account with dirty tracking: read keys are
+    cached, changed keys are written to the store at once by `save()`
+    (called after a successful dispatch). Increments are written
+    immediately, so they are not undone if the dispatch is retried.
+    """
+
+    def __init__(self, account_id: str, store: BaseContextStore = None):
+        self.account_id = account_id
+        self.store = store or context_store()
+        self._values = None
+        self._dirty: Dict[str, Any] = {}
+        self._expiring: Dict[str, tuple] = {}
+        self._deleted = set()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self._load().get(key, default)
+
+    def set(self, key: str, value: Any, ttl: Optional[int] = None):
+        self._load()[key] = value
+        self._deleted.discard(key)
+        if ttl:
+            self._dirty.pop(key, None)
+            self._expiring[key] = (value, ttl)
+        else:
+            self._expiring.pop(key, None)
+            self._dirty[key] = value
+
+    def delete(self, key: str):
+        self._load().pop(key, None)
+        self._dirty.pop(key, None)
+        self._expiring.pop(key, None)
+        self._deleted.add(key)
+
+    def incr(self, key: str, delta: int = 1) -> int:
+        if key in self._dirty or key in self._expiring:
+            self.save()
+        value = self.store.incr(self.account_id, key, delta)
+        self._load()[key] = value
+        return value
+
+    def all(self) -> Dict[str, Any]:
+        return dict(self._load())
+
+    @property
+    def is_dirty(self) -> bool:
+        return bool(self._dirty or self._expiring or self._deleted)
+
+    def save(self):
+        if not self.is_dirty:
+            return
+        if self._dirty or self._deleted:
+            self.store.set_many(self.account_id, self._dirty, self._deleted)
+        for key, (value, ttl) in self._expiring.items():
+            self.store.set(self.account_id, key, value, ttl=ttl)
+        self._dirty, self._expiring, self._deleted = {}, {}, set()
+
+    def __getitem__(self, key: str) -> Any:
+        values = self._load()
+        if key not in values:
+            raise KeyError(key)
+        return values[key]
+
+    def __setitem__(self, key: str, value: Any):
+        self.set(key, value)
+
+    def __delitem__(self, key: str):
+        self.delete(key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._load()
+
+    def _load(self) -> Dict[str, Any]:
+        if self._values is None:
+            self._values = self.store.get_many(self.account_id)
+        return self._values
+
+
+_context_store = None
+
+
+def context_store() -> BaseContextStore:
+    global _context_store
+    if _context_store is None:
+        _context_store = bot_api_settings.CONTEXT_STORE()
+    return _context_store
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Callable
+
+from django.core.cache import cache
+
+from .errors import MessengerUnavailable, RequestsLimitExceeded
+from .settings import bot_api_settings
+
+
+log = logging.getLogger(__name__)
+
+LEDGER_PREFIX = 'bot_engine:sent:'
+
+
+def retry_delay(attempt: int, error: Exception,
+                max_delay: float = None) -> float:
+    """
+    Delay before the next attempt: `retry_after` of the API
+    or an exponential backoff with full jitter
+    :param attempt: number of the failed attempt, from 0
+    :param error: raised exception
+    :param max_delay: backoff limit, SEND_RETRY_MAX_DELAY by default
+    :return: seconds
+    """
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after:
+        return float(retry_after)
+    if max_delay is None:
+        max_delay = bot_api_settings.SEND_RETRY_MAX_DELAY
+    return random.uniform(0, min(max_delay, (
+        bot_api_settings.SEND_RETRY_BASE_DELAY * 2 ** attempt)))
+
+
+def retry_call(func: Callable, *args, max_delay: float = None,
+               **kwargs) -> Any:
+    """
+    Call the function and retry it on errors after which the request
+    is surely not processed: rate limits, server errors and refused
+    connections. Timeouts and other errors are not retried, the message
+    may be delivered already. The last error is raised if all attempts
+    fail or the API asks to wait longer than `max_delay`.
+    :param func: API function
+    :param max_delay: longest wait in seconds, SEND_RETRY_MAX_DELAY
+        by default
+    :return: function result
+    """
+    if max_delay is None:
+        max_delay = bot_api_settings.SEND_RETRY_MAX_DELAY
+    attempts = bot_api_settings.SEND_RETRY_ATTEMPTS
+    for attempt in range(attempts):
+        try:
+            return func(*args, **kwargs)
+        except (MessengerUnavailable, RequestsLimitExceeded) as err:
+            delay = retry_delay(attempt, err, max_delay)
+            if attempt + 1 >= attempts or delay > max_delay:
+                raise
+            log.warning(f'Retry; Attempt={attempt + 1}; Delay={delay:.2f}s; '
+                        f'Error={err};')
+            time.sleep(delay)
+
+
+async def aretry_call(func: Callable, *args, max_delay: float = None,
+                      **kwargs) -> Any:
+    """
+    Async counterpart of `retry_call`
+    """
+    if max_delay is None:
+        max_delay = bot_api_settings.SEND_RETRY_MAX_DELAY
+    attempts = bot_api_settings.SEND_RETRY_ATTEMPTS
+    for attempt in range(attempts):
+        try:
+            return await func(*args, **kwargs)
+        except (MessengerUnavailable, RequestsLimitExceeded) as err:
+            delay = retry_delay(attempt, err, max_delay)
+            if attempt + 1 >= attempts or delay > max_delay:
+                raise
+            log.warning(f'Retry; Attempt={attempt + 1}; Delay={delay:.2f}s; '
+                        f'Error={err};')
+            await asyncio.sleep(delay)
+
+
+class SendLedger:
+    """
+    Deduplication ledger of outbound messages in the django cache.
+    A message is claimed by its idempotency key before sending,
+    so a retried dispatch doesn't send the same reply twice.
+    Use a shared cache backend (e.g. Redis) with several processes.
+    """
+
+    @staticmethod
+    def claim(key: str) -> bool:
+        """
+        :param key: idempotency key
+        :return: False if the message is already sent or being sent
+        """
+        return cache.add(f'{LEDGER_PREFIX}{key}', True,
+                         bot_api_settings.SEND_DEDUP_TTL)
+
+    @staticmethod
+    def release(key: str):
+        """
+        Forget the key of a message that was not sent
+        """
+        cache.delete(f'{LEDGER_PREFIX}{key}')
+
+
+send_ledger = SendLedger()
@@ -12,13 +12,51 @@ class MessengerException(BotApiError):
     """
 
 
+class CircuitOpen(MessengerException):
+    """
+    Exception class a Messenger API calls are stopped by a circuit breaker
+    """
+
+
+class MessengerUnavailable(MessengerException):
+    """
+    Exception class a Messenger API is unavailable: the connection is refused
+    or the API answered with a server error, the request is not processed
+    """
+
+
+class MessengerTimeout(MessengerException):
+    """
+    Exception class a Messenger API call timed out, the request may be
+    processed anyway, so it must not be sent again
+    """
+
+
 class RequestsLimitExceeded(BotApiError):
     """
     Exception class a Request limit exceeded
     """
+    def __init__(self, *args, retry_after: float = None):
+        super().__init__(*args)
+        self.retry_after = retry_after
 
 
 class NotSubscribed(BotApiError):
     """
     Exception class a Account not subscribed
     """
+
+
+class Overloaded(BotApiError):
+    """
+    Exception class a Webhook is overloaded, the update must be retried
+    """
+    def __init__(self, *args, retry_after: int = None):
+        super().__init__(*args)
+        self.retry_after = retry_after
+
+
+class ConcurrentUpdate(BotApiError):
+    """
+    Exception class a Account is changed by another worker since it was loaded
+    """
@@ -0,0 +1,141 @@
+import logging
+import threading
+from collections import Counter
+from typing import Any, Callable, Dict, Hashable
+
+from .settings import bot_api_settings
+from .types import (
+    Message, Text, Button, Event, File, Picture, Sticker, Audio, Video
+)
+from .workers import OrderedWorkerPool
+
+
+log = logging.getLogger(__name__)
+
+
+class Lane:
+    INTERACTIVE = 'interactive'  # buttons and commands
+    TEXT = 'text'
+    MEDIA = 'media'
+    EVENTS = 'events'
+
+    # from the fastest lane to the slowest one
+    PRIORITY = (INTERACTIVE, TEXT, MEDIA, EVENTS)
+
+
+def message_lane(message: Message) -> str:
+    """
+    Priority lane of an incoming message, classified without queries.
+    Telegram reply keyboard presses are texts, they are matched with
+    the menu buttons in the text lane.
+    :param message: bot_engine.Message object
+    :return: lane name
+    """
+    if isinstance(message, Event):
+        return Lane.EVENTS
+    if isinstance(message, Button):
+        return Lane.INTERACTIVE
+    if isinstance(message, Text) and (message.text or '').startswith('/'):
+        return Lane.INTERACTIVE
+    if isinstance(message, (File, Picture, Sticker, Audio, Video)):
+        return Lane.MEDIA
+    return Lane.TEXT
+
+
+class LanePool:
+    """
+    Separate worker pools for each priority lane, so cheap interactive
+    messages are not queued behind heavy media and service events.
+    A message of a chat goes to a faster lane with earlier messages of
+    the chat, so it isn't answered before them, but never waits in
+    a slower lane.
+    """
+
+    def __init__(self, workers: Dict[str, int] = None):
+        workers = workers or bot_api_settings.LANE_WORKERS
+        self._pools = {
+            lane: OrderedWorkerPool(self._process, workers=count,
+                                    name=f'bot-engine-{lane}')
+            for lane, count in workers.items()
+        }
+        # numbers of queued messages of a chat in the lanes
+        self._chats: Dict[Hashable, Counter] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, messenger, message: Message, body: bytes,
+               headers: Dict[str, Any] = None,
+               callback: Callable[[], Any] = None) -> str:
+        """
+        Queue the message in its lane
+        :param messenger: bot_engine.Messenger object
+        :param message: parsed message
+        :param body: raw update, saved if the processing fails
+        :param headers: request headers needed to parse the body again
+        :param callback: called when the message is processed or failed
+        :return: lane name
+        """
+        key = message.user_id
+        lane = message_lane(message)
+        if lane not in self._pools:
+            lane = Lane.TEXT
+        with self._lock:
+            chat = self._chats.setdefault(key, Counter())
+            lane = min((lane, *chat), key=self._priority)
+            chat[lane] += 1
+
+        self._pools[lane].submit(
+            key, (messenger, message, body, headers, callback, lane))
+        return lane
+
+    def qsize(self) -> int:
+        return sum(pool.qsize() for pool in self._pools.values())
+
+    def join(self):
+        for pool in self._pools.values():
+            pool.join()
+
+    @staticmethod
+    def _priority(lane: str) -> int:
+        if lane in Lane.PRIORITY:
+            return Lane.PRIORITY.index(lane)
+        return len(Lane.PRIORITY)
+
+    def _process(self, item):
+        from .models import FailedUpdate
+
+        messenger, message, body, headers, callback, lane = item
+        try:
+            messenger.dispatch_message(message)
+        except Exception as err:
+            log.exception(f'Lane; Message={message}; Error={err};')
+            FailedUpdate.capture(messenger, body, err, headers)
+        finally:
+            with self._lock:
+                chat = self._chats[message.user_id]
+                chat[lane] -= 1
+                if not chat[lane]:
+                    del chat[lane]
+                if not chat:
+                    del self._chats[message.user_id]
+            if callback is not None:
+                callback()
+
+
+_lane_pool = None
+_lane_lock = threading.Lock()
+
+
+def lane_pool() -> LanePool:
+    global _lane_pool
+    if _lane_pool is None:
+        with _lane_lock:
+            if _lane_pool is None:
+                _lane_pool = LanePool()
+    return _lane_pool
+
+
+def queue_depth() -> int:
+    """
+    Number of messages waiting in the lanes of this process
+    """
+    return _lane_pool.qsize() if _lane_pool is not None else 0
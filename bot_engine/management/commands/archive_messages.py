@@ -0,0 +1,46 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ...message_log import archive_messages
+from ...settings import bot_api_settings
+
+
+class Command(BaseCommand):
+    help = ('Move the message log older than the retention period to '
+            'gzipped JSONL files on the archive storage, a file per day. '
+            'Run it periodically, e.g. from cron.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int,
+            default=bot_api_settings.MESSAGE_LOG_RETENTION_DAYS,
+            help='Retention period in days '
+                 '(MESSAGE_LOG_RETENTION_DAYS by default).')
+        parser.add_argument(
+            '--chunk-size', type=int, default=5000,
+            help='Number of messages fetched or deleted at once.')
+        parser.add_argument(
+            '--path', default=None,
+            help='Directory in the storage '
+                 '(MESSAGE_LOG_ARCHIVE_PATH by default).')
+        parser.add_argument(
+            '--keep', action='store_true',
+            help='Export messages without deleting them.')
+
+    def handle(self, *args, **options):
+        if options['days'] is None:
+            raise CommandError('Set MESSAGE_LOG_RETENTION_DAYS or --days.')
+
+        border = timezone.now() - timedelta(days=options['days'])
+        total = 0
+        for name, count in archive_messages(
+                border, path=options['path'],
+                chunk_size=options['chunk_size'],
+                delete=not options['keep']):
+            total += count
+            self.stdout.write(f'Archived {count} messages to {name}.')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Done. Archived {total} messages older than {border:%Y-%m-%d}.'))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from ...models import Messenger, MessengerType
+
+
+class Command(BaseCommand):
+    help = ('Check subscription of accounts with the cheapest messenger API '
+            'call and update their active flags.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of accounts loaded and saved at once.')
+        parser.add_argument(
+            '--messenger', type=int, action='append', dest='messengers',
+            help='Check accounts of this messenger id only.')
+
+    def handle(self, *args, **options):
+        messengers = Messenger.objects.exclude(api_type=MessengerType.NONE)
+        if options['messengers']:
+            messengers = messengers.filter(id__in=options['messengers'])
+
+        for messenger in messengers:
+            changed = messenger.probe_accounts(
+                batch_size=options['batch_size'])
+            self.stdout.write(f'{messenger}: {changed} accounts changed.')
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from ...profiles import refresh_profiles, stale_accounts
+from ...settings import bot_api_settings
+
+
+class Command(BaseCommand):
+    help = ('Refresh profiles of accounts whose information is older '
+            'than the TTL. Run it periodically, e.g. from cron.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--ttl', type=int, default=bot_api_settings.PROFILE_TTL,
+            help='Profile lifetime in seconds.')
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of accounts loaded and saved at once.')
+        parser.add_argument(
+            '--workers', type=int, default=4,
+            help='Number of concurrent requests to messenger APIs.')
+        parser.add_argument(
+            '--messenger', type=int, action='append', dest='messengers',
+            help='Refresh accounts of this messenger id only.')
+
+    def handle(self, *args, **options):
+        total = refreshed = 0
+        for batch in stale_accounts(options['ttl'], options['batch_size'],
+                                    options['messengers']):
+            total += len(batch)
+            refreshed += refresh_profiles(batch, workers=options['workers'])
+            self.stdout.write(f'Refreshed {refreshed} of {total} accounts.')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Done. Refreshed {refreshed} of {total} stale accounts.'))
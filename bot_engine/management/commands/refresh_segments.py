@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from ...models import Segment
+
+
+class Command(BaseCommand):
+    help = ('Rebuild materialized segments from their definitions. '
+            'Run it periodically, e.g. from cron: accounts leave '
+            '"seen in days" segments without being saved, and segments '
+            'changed in the admin are rebuilt only by this command.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--segment', type=int, action='append', dest='segments',
+            help='Refresh this segment id only.')
+        parser.add_argument(
+            '--dirty', action='store_true',
+            help='Refresh only segments changed since their last refresh.')
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='Number of memberships inserted or deleted at once.')
+
+    def handle(self, *args, **options):
+        segments = Segment.objects.all()
+        if options['segments']:
+            segments = segments.filter(id__in=options['segments'])
+        if options['dirty']:
+            segments = segments.filter(refreshed_at__isnull=True)
+
+        for segment in segments:
+            size = segment.refresh(options['batch_size'])
+            self.stdout.write(f'Segment {segment}: {size} accounts.')
+
+        self.stdout.write(self.style.SUCCESS('Done.'))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from ...outbox import OutboxRelay
+
+
+class Command(BaseCommand):
+    help = ('Send messages saved to the outbox (OUTBOX_ENABLED setting). '
+            'Run several relays to scale the throughput.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help='Number of messages claimed at once '
+                 '(OUTBOX_BATCH_SIZE by default).')
+        parser.add_argument(
+            '--interval', type=float, default=1.0,
+            help='Seconds between polls of an empty outbox.')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Stop when the outbox is empty.')
+
+    def handle(self, *args, **options):
+        relay = OutboxRelay(batch_size=options['batch_size'])
+        try:
+            relay.run(interval=options['interval'], once=options['once'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS('Outbox relay stopped.'))
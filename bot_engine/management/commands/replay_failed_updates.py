@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+
+from ...models import FailedUpdate
+from ...utils import keyset_batches
+
+
+class Command(BaseCommand):
+    help = ('Dispatch failed updates again. Processed updates are deleted, '
+            'the rest keep their last error.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-attempts', type=int, default=3,
+            help='Skip updates that have failed this number of times.')
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Number of updates loaded and saved at once.')
+        parser.add_argument(
+            '--messenger', type=int, action='append', dest='messengers',
+            help='Replay updates of this messenger id only.')
+
+    def handle(self, *args, **options):
+        queryset = (FailedUpdate.objects.select_related('messenger')
+                    .filter(attempts__lt=options['max_attempts']))
+        if options['messengers']:
+            queryset = queryset.filter(messenger_id__in=options['messengers'])
+
+        messengers = {}
+        processed = failed = 0
+        for batch in keyset_batches(queryset, options['batch_size']):
+            done, not_done = [], []
+            for update in batch:
+                # one connector per messenger instead of one per update
+                update.messenger = messengers.setdefault(
+                    update.messenger_id, update.messenger)
+                (done if update.replay() else not_done).append(update)
+
+            FailedUpdate.objects.filter(id__in=[u.id for u in done]).delete()
+            FailedUpdate.objects.bulk_update(
+                not_done, ['attempts', 'error', 'traceback', 'updated'])
+            processed += len(done)
+            failed += len(not_done)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Replayed {processed} updates, {failed} failed again.'))
@@ -0,0 +1,181 @@
+import json
+import logging
+import threading
+import time
+from typing import Iterable, List, Optional
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...errors import MessengerException
+from ...lanes import LanePool
+from ...models import FailedUpdate, Messenger, MessengerType, StalePolicy
+from ...workers import OrderedWorkerPool
+
+
+log = logging.getLogger(__name__)
+
+
+class OffsetTracker:
+    """
+    Offset of the first update that is not processed yet. Batches are
+    pulled while earlier ones are processed, the saved offset never
+    passes an unprocessed update, so a restart never skips updates.
+    """
+
+    def __init__(self, offset: Optional[int] = None):
+        self._pending = set()
+        self._next = offset
+        self._condition = threading.Condition()
+
+    def add(self, update_ids: Iterable[int]):
+        with self._condition:
+            for update_id in update_ids:
+                self._pending.add(update_id)
+                self._next = max(self._next or 0, update_id + 1)
+
+    def done(self, update_id: int):
+        with self._condition:
+            self._pending.discard(update_id)
+            self._condition.notify_all()
+
+    def skip(self, update_id: int):
+        self.add([update_id])
+        self.done(update_id)
+
+    @property
+    def offset(self) -> Optional[int]:
+        with self._condition:
+            return min(self._pending) if self._pending else self._next
+
+    def wait(self, limit: int):
+        """
+        Block while more than `limit` updates are being processed
+        """
+        with self._condition:
+            while len(self._pending) > limit:
+                self._condition.wait()
+
+
+class Command(BaseCommand):
+    help = ('Pull Telegram updates with long polling instead of a webhook '
+            'and process them in a pool of workers.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'messenger', type=int,
+            help='Messenger id.')
+        parser.add_argument(
+            '--workers', type=int, default=8,
+            help='Number of parsing workers. Processing workers are set '
+                 'by the LANE_WORKERS setting.')
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Max number of updates pulled at once (up to 100).')
+        parser.add_argument(
+            '--timeout', type=int, default=30,
+            help='Long polling timeout in seconds.')
+        parser.add_argument(
+            '--max-pending', type=int, default=1000,
+            help='Max number of pulled updates that are not processed yet.')
+
+    def handle(self, *args, **options):
+        try:
+            messenger = Messenger.objects.get(id=options['messenger'])
+        except Messenger.DoesNotExist:
+            raise CommandError(f'Messenger {options["messenger"]} not found.')
+        if messenger.api_type != MessengerType.TELEGRAM:
+            raise CommandError('Long polling is supported by Telegram only.')
+
+        # updates are not pulled while a webhook is set
+        messenger.disable_webhook()
+        Messenger.objects.filter(id=messenger.id).update(is_active=False)
+
+        lanes = LanePool()
+        tracker = OffsetTracker(messenger.updates_offset or None)
+
+        def parse(update: dict):
+            update_id = update['update_id']
+            body = json.dumps(update).encode()
+            try:
+                message = messenger.api.parse_update(update)
+            except Exception as err:
+                log.exception(f'Runbot; Update={update}; Error={err};')
+                FailedUpdate.capture(messenger, body, err)
+                tracker.done(update_id)
+                return
+            lanes.submit(messenger, message, body,
+                         callback=lambda: tracker.done(update_id))
+
+        # updates are parsed in parallel and processed in priority lanes
+        pool = OrderedWorkerPool(parse, workers=options['workers'],
+                                 name=f'runbot-{messenger.id}')
+        offset = saved_offset = tracker.offset
+        catching_up = False
+        self.stdout.write(f'Polling updates of {messenger}...')
+
+        while True:
+            try:
+                updates = messenger.api.get_updates(
+                    offset, options['batch_size'], options['timeout'])
+            except MessengerException as err:
+                log.exception(f'Runbot; Messenger={messenger.id}; Error={err};')
+                time.sleep(5)
+                continue
+
+            saved_offset = self.save_offset(messenger, tracker, saved_offset)
+            if not updates:
+                continue
+
+            stale = [update for update in updates if messenger.is_stale(
+                messenger.api.update_timestamp(update))]
+            if stale:
+                if not catching_up:
+                    self.stdout.write('Catch-up mode: draining stale updates.')
+                catching_up = True
+                updates_to_process = self.catch_up(messenger, updates, stale)
+            else:
+                if catching_up:
+                    self.stdout.write('Backlog is drained, normal mode.')
+                catching_up = False
+                updates_to_process = updates
+
+            queued = {update['update_id'] for update in updates_to_process}
+            tracker.add(queued)
+            for update in updates_to_process:
+                pool.submit(messenger.api.update_sender(update), update)
+            for update in updates:
+                if update['update_id'] not in queued:
+                    # dropped by the stale policy
+                    tracker.skip(update['update_id'])
+
+            # the next batch is pulled at once, only a long backlog of
+            # unprocessed updates stops polling
+            offset = updates[-1]['update_id'] + 1
+            tracker.wait(options['max_pending'])
+
+    @staticmethod
+    def save_offset(messenger: Messenger, tracker: OffsetTracker,
+                    saved_offset: Optional[int]) -> Optional[int]:
+        offset = tracker.offset
+        if offset is not None and offset != saved_offset:
+            Messenger.objects.filter(id=messenger.id).update(
+                updates_offset=offset)
+        return offset
+
+    @staticmethod
+    def catch_up(messenger: Messenger, updates: List[dict],
+                 stale: List[dict]) -> List[dict]:
+        """
+        Apply the stale policy to a whole batch before parsing it:
+        stale updates are dropped or only the last one of each chat is kept
+        to be answered with the stale text.
+        """
+        skipped = {update['update_id'] for update in stale}
+        if messenger.stale_policy == StalePolicy.SUMMARIZE:
+            last = {messenger.api.update_sender(update): update['update_id']
+                    for update in stale}
+            skipped -= set(last.values())
+        elif messenger.stale_policy != StalePolicy.DROP:
+            return updates
+        return [update for update in updates
+                if update['update_id'] not in skipped]
@@ -0,0 +1,202 @@
+import atexit
+import gzip
+import json
+import logging
+import tempfile
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Iterator, Tuple
+
+from django.core.files import File
+from django.core.files.storage import Storage, default_storage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .settings import bot_api_settings
+from .types import Message
+from .utils import normalize_datetime
+
+
+log = logging.getLogger(__name__)
+
+# message attributes saved as columns or not saved at all
+SKIPPED_ATTRS = {'id', 'user_id', 'timestamp', 'text', 'buttons',
+                 'inline_buttons', 'file'}
+
+
+def message_payload(message: Message) -> dict:
+    """
+    Simple attributes of the message that are stored in the log
+    :param message: bot_engine.Message object
+    :return: JSON serializable dict
+    """
+    return {key: value for key, value in vars(message).items()
+            if key not in SKIPPED_ATTRS and not key.startswith('_')
+            and isinstance(value, (str, int, float, bool, dict))}
+
+
+class MessageLogBuffer:
+    """
+    In-process buffer of the message log. Records are saved by a background
+    thread with a single bulk insert when the batch is full or the flush
+    interval expires, so logging costs the hot path only a list append.
+    """
+
+    def __init__(self, batch_size: int = None, flush_interval: float = None,
+                 max_size: int = None):
+        self.batch_size = (batch_size or
+                           bot_api_settings.MESSAGE_LOG_BATCH_SIZE)
+        self.flush_interval = (flush_interval or
+                               bot_api_settings.MESSAGE_LOG_FLUSH_INTERVAL)
+        self.max_size = max_size or bot_api_settings.MESSAGE_LOG_MAX_BUFFER
+
+        self._records = deque()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._dropped = 0
+
+    def log_incoming(self, messenger, account, message: Message):
+        self.append(messenger, account, message, incoming=True)
+
+    def log_outgoing(self, messenger, account, message: Message):
+        self.append(messenger, account, message, incoming=False)
+
+    def append(self, messenger, account, message: Message, incoming: bool):
+        """
+        Buffer the message, the database is not touched
+        :param messenger: bot_engine.Messenger object or id
+        :param account: bot_engine.Account object or id
+        :param message: bot_engine.Message object
+        :param incoming: the message is received, not sent
+        :return: None
+        """
+        from .models import MessageDirection, MessageLog
+
+        record = MessageLog(
+            messenger_id=getattr(messenger, 'id', messenger),
+            account_id=getattr(account, 'id', account),
+            direction=(MessageDirection.INCOMING if incoming
+                       else MessageDirection.OUTGOING),
+            message_type=message.__class__.__name__,
+            message_id=message.id if incoming else None,
+            text=getattr(message, 'text', None) or '',
+            payload=message_payload(message),
+            created=((incoming and normalize_datetime(message.sent_at))
+                     or timezone.now()),
+        )
+        with self._condition:
+            if len(self._records) >= self.max_size:
+                # the database can't keep up, old records are dropped
+                self._records.popleft()
+                self._dropped += 1
+            self._records.append(record)
+            if len(self._records) >= self.batch_size:
+                self._condition.notify()
+            self._start()
+
+    def flush(self) -> int:
+        """
+        Save buffered records
+        :return: number of saved records
+        """
+        from .models import MessageLog
+
+        with self._condition:
+            records, self._records = list(self._records), deque()
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            log.warning(f'Message log; Dropped={dropped};')
+        if not records:
+            return 0
+
+        try:
+            MessageLog.objects.bulk_create(records, self.batch_size)
+        except Exception as err:
+            log.exception(f'Message log; Records={len(records)}; '
+                          f'Error={err};')
+            return 0
+        return len(records)
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name='bot-engine-message-log', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if len(self._records) < self.batch_size:
+                    self._condition.wait(self.flush_interval)
+            close_old_connections()
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+
+message_log = MessageLogBuffer()
+atexit.register(message_log.flush)
+
+
+ARCHIVE_FIELDS = ('id', 'messenger_id', 'account_id', 'direction',
+                  'message_type', 'message_id', 'text', 'payload', 'created')
+
+
+def archive_storage() -> Storage:
+    storage = bot_api_settings.MESSAGE_LOG_ARCHIVE_STORAGE
+    if storage is None:
+        return default_storage
+    return storage() if isinstance(storage, type) else storage
+
+
+def archive_messages(border: datetime, storage: Storage = None,
+                     path: str = None, chunk_size: int = 5000,
+                     delete: bool = True) -> Iterator[Tuple[str, int]]:
+    """
+    Move messages older than the border to gzipped JSONL files, a file
+    per day. Rows are streamed with a server-side cursor (where the
+    database supports it) and deleted in chunks after the file is saved,
+    so memory use doesn't depend on the number of messages.
+    :param border: messages created before this time are archived
+    :param storage: django storage, MESSAGE_LOG_ARCHIVE_STORAGE by default
+    :param path: directory in the storage
+    :param chunk_size: number of rows fetched or deleted at once
+    :param delete: delete archived messages
+    :return: iterator over saved file names and numbers of messages
+    """
+    from .models import MessageLog
+
+    storage = storage or archive_storage()
+    path = path or bot_api_settings.MESSAGE_LOG_ARCHIVE_PATH
+    old = MessageLog.objects.filter(created__lt=border)
+
+    for day in old.datetimes('created', 'day'):
+        rows = old.filter(created__gte=day,
+                          created__lt=day + timedelta(days=1))
+        count = last_id = 0
+        with tempfile.TemporaryFile() as tmp:
+            with gzip.GzipFile(fileobj=tmp, mode='wb') as archive:
+                for row in (rows.order_by('id').values(*ARCHIVE_FIELDS)
+                            .iterator(chunk_size=chunk_size)):
+                    archive.write(json.dumps(row, cls=DjangoJSONEncoder)
+                                  .encode('utf-8') + b'\n')
+                    count += 1
+                    last_id = row['id']
+            if not count:
+                continue
+            tmp.seek(0)
+            name = storage.save(f'{path}/{day:%Y/%m/%Y-%m-%d}.jsonl.gz',
+                                File(tmp))
+
+        if delete:
+            # rows logged after the export are archived by the next run
+            archived = rows.filter(id__lte=last_id)
+            while True:
+                ids = list(archived.values_list('id', flat=True)[:chunk_size])
+                if not ids:
+                    break
+                MessageLog.objects.filter(id__in=ids).delete()
+        yield name, count
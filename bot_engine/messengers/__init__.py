@@ -1,6 +1,7 @@
-from .base_messenger import BaseMessenger
+from .base_messenger import AsyncBaseMessenger, BaseMessenger
 
 
 __all__ = (
+    'AsyncBaseMessenger',
     'BaseMessenger',
 )
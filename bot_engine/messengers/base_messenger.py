@@ -1,14 +1,45 @@
-from typing import Any, Dict, List, Optional, Union
+import asyncio
+import weakref
+from datetime import datetime
+from typing import Any, Dict, List, MutableMapping, Optional, Union
 
+import httpx
+import requests
 from django.http.request import HttpRequest
 
 from ..types import Message
 
 
+def is_server_error(status: Optional[int]) -> bool:
+    # 504 is a timeout of a proxy, the request may be processed
+    return status is not None and status >= 500 and status != 504
+
+
+def is_unavailable(err: Exception) -> bool:
+    """
+    The request failed before it reached the API or the API answered
+    with a server error, so it can be sent again. Read timeouts and
+    dropped connections are ambiguous: the request may be processed.
+    :param err: exception of requests, httpx or apihelper
+    :return: True if the request is not processed
+    """
+    if isinstance(err, (requests.ConnectTimeout, httpx.ConnectError,
+                        httpx.ConnectTimeout)):
+        return True
+    if isinstance(err, requests.ConnectionError):
+        # refused connection or unknown host, not a dropped one
+        return 'NewConnectionError' in str(err)
+    response = (getattr(err, 'response', None)
+                or getattr(err, 'result', None))
+    return is_server_error(getattr(response, 'status_code', None))
+
+
 class BaseMessenger:
     """
     Base class for IM API connector
     """
+    # max number of user ids in one `probe_accounts()` call
+    probe_batch_size = 1
 
     def __init__(self, token: str, **kwargs):
         self.token = token
@@ -20,7 +51,9 @@ class BaseMessenger:
         """
         Activate IM bot webhook
         :param url: webhook url
-        :param kwargs:
+        :param kwargs: webhook options, each connector uses its own:
+            max_connections, allowed_updates, drop_pending_updates (Telegram),
+            event_types (Viber)
         :return: None or response from api
         """
         raise NotImplementedError('`enable_webhook()` must be implemented.')
@@ -47,6 +80,14 @@ class BaseMessenger:
         """
         raise NotImplementedError('`get_user_info()` must be implemented.')
 
+    def probe_accounts(self, user_ids: List[str]) -> Dict[str, Optional[bool]]:
+        """
+        Check subscription of users without sending them a message
+        :param user_ids: no more than `probe_batch_size` user ids
+        :return: dict of user id to subscription flag, None if unknown
+        """
+        return {}
+
     def parse_message(self, request: HttpRequest) -> Message:
         """
         Parse incoming message
@@ -55,6 +96,41 @@ class BaseMessenger:
         """
         raise NotImplementedError('`_parse_message()` must be implemented.')
 
+    def get_updates(self, offset: int = None, limit: int = 100,
+                    timeout: int = 30) -> List[Dict[str, Any]]:
+        """
+        Pull incoming updates (long polling)
+        :param offset: id of the first update to return
+        :param limit: max number of updates
+        :param timeout: long polling timeout in seconds
+        :return: list of raw updates
+        """
+        raise NotImplementedError('`get_updates()` must be implemented.')
+
+    def parse_update(self, update: Dict[str, Any]) -> Message:
+        """
+        Parse a pulled update
+        :param update: raw update
+        :return: Message object
+        """
+        raise NotImplementedError('`parse_update()` must be implemented.')
+
+    def update_sender(self, update: Dict[str, Any]) -> Optional[str]:
+        """
+        Sender of a pulled update without parsing it
+        :param update: raw update
+        :return: chat or user id (optional)
+        """
+        return None
+
+    def update_timestamp(self, update: Dict[str, Any]) -> Optional[datetime]:
+        """
+        Sending time of a pulled update without parsing it
+        :param update: raw update
+        :return: datetime (optional)
+        """
+        return None
+
     def send_message(self, receiver: str,
                      messages: Union[Message, List[Message]]) -> List[str]:
         """
@@ -78,3 +154,111 @@ class BaseMessenger:
         if proxy_url:
             return {'https': proxy_url, 'http': proxy_url}
         return None
+
+
+class AsyncBaseMessenger:
+    """
+    Base class for async IM API connector.
+    Connectors share HTTP connection pools (one for each event loop
+    and proxy), so a concurrent fan-out costs coroutines instead of threads.
+    """
+    # a client can't be used from another loop, the clients of
+    # a closed and collected loop are dropped with it
+    _clients: MutableMapping[asyncio.AbstractEventLoop, Dict[
+        Optional[str], httpx.AsyncClient]] = weakref.WeakKeyDictionary()
+
+    def __init__(self, token: str, **kwargs):
+        self.token = token
+        self.proxy_url = kwargs.get('proxy') or None
+        self.name = kwargs.get('name')
+        self.avatar_url = kwargs.get('avatar')
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """
+        HTTP client of the running event loop
+        """
+        clients = self._clients.setdefault(asyncio.get_running_loop(), {})
+        client = clients.get(self.proxy_url)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                proxy=self.proxy_url,
+                timeout=httpx.Timeout(30, connect=10),
+                limits=httpx.Limits(max_connections=100,
+                                    max_keepalive_connections=20))
+            clients[self.proxy_url] = client
+        return client
+
+    @classmethod
+    async def aclose(cls):
+        """
+        Close HTTP clients of the running event loop, e.g. before
+        the loop is closed
+        :return: None
+        """
+        clients = cls._clients.pop(asyncio.get_running_loop(), {})
+        for client in clients.values():
+            await client.aclose()
+
+    async def enable_webhook(self, url: str, **kwargs):
+        """
+        Activate IM bot webhook
+        :param url: webhook url
+        :param kwargs: webhook options, see `BaseMessenger.enable_webhook()`
+        :return: None or response from api
+        """
+        raise NotImplementedError('`enable_webhook()` must be implemented.')
+
+    async def disable_webhook(self):
+        """
+        Deactivate IM bot webhook
+        :return: None or response from api
+        """
+        raise NotImplementedError('`disable_webhook()` must be implemented.')
+
+    async def get_user_info(self, user_id: str, **kwargs) -> Dict[str, Any]:
+        """
+        User info from IM API
+        :type user_id: user id
+        :return: dict with user info
+        """
+        raise NotImplementedError('`get_user_info()` must be implemented.')
+
+    async def get_file_url(self, file_id: str) -> str:
+        """
+        Download URL of a file received from IM API
+        :param file_id: file id
+        :return: file url
+        """
+        raise NotImplementedError('`get_file_url()` must be implemented.')
+
+    async def send_message(self, receiver: str,
+                           messages: Union[Message, List[Message]]) -> List[str]:
+        """
+        Send message method
+        :param receiver: receiver user id
+        :param messages: Message object or list of Message objects
+        :return: message id list
+        """
+        raise NotImplementedError('`send_message()` must be implemented.')
+
+    async def send_many(self, receivers: List[str],
+                        messages: Union[Message, List[Message]],
+                        concurrency: int = 20) -> Dict[str, Any]:
+        """
+        Send the message to many receivers concurrently
+        :param receivers: receiver user ids
+        :param messages: Message object or list of Message objects
+        :param concurrency: max number of requests at once
+        :return: dict of receiver to message ids or exception
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def send(receiver: str):
+            async with semaphore:
+                return await self.send_message(receiver, messages)
+
+        results = await asyncio.gather(
+            *(send(receiver) for receiver in receivers),
+            return_exceptions=True)
+        return dict(zip(receivers, results))
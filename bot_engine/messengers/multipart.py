@@ -0,0 +1,159 @@
+import asyncio
+import mimetypes
+import os
+from typing import (
+    Any, AsyncIterator, BinaryIO, Dict, Iterator, List, Optional, Tuple
+)
+from uuid import uuid4
+
+
+CHUNK_SIZE = 64 * 1024
+
+# percent encoding of header parameters as urllib3 does it (WHATWG HTML)
+_PARAM_ESCAPES = {ord('\n'): '%0A', ord('\r'): '%0D', ord('"'): '%22'}
+
+
+def quote_param(value: Any) -> str:
+    """
+    Escape a Content-Disposition parameter value, so quotes and line
+    breaks in a name can't break the part header.
+    :param value: parameter value
+    :return: escaped value to put between double quotes
+    """
+    return str(value).translate(_PARAM_ESCAPES)
+
+
+class MediaSource:
+    """
+    Local media for upload: a path, a django storage file or a file object.
+    The file is opened lazily and read in chunks, never as a whole.
+    """
+
+    def __init__(self, source: Any, file_name: str = None,
+                 mime_type: str = None):
+        self.source = source
+        self._file = None
+        self._own_file = False
+
+        self.file_name = file_name or os.path.basename(
+            str(getattr(source, 'name', None) or source)) or 'file'
+        self.mime_type = (mime_type or
+                          mimetypes.guess_type(self.file_name)[0] or
+                          'application/octet-stream')
+
+    def open(self) -> BinaryIO:
+        if self._file is None:
+            source = self.source
+            if isinstance(source, (str, os.PathLike)):
+                self._file = open(source, 'rb')
+                self._own_file = True
+            elif hasattr(source, 'read'):
+                # django File/FieldFile or any binary file object
+                if getattr(source, 'closed', False) and hasattr(source, 'open'):
+                    source.open('rb')
+                    self._own_file = True
+                elif getattr(source, 'seekable', lambda: False)():
+                    # the file object may be read by a failed attempt
+                    source.seek(0)
+                self._file = source
+            else:
+                raise TypeError(f'Unsupported media source: {source!r}')
+        return self._file
+
+    def close(self):
+        if self._file is not None and self._own_file:
+            self._file.close()
+        self._file = None
+
+    @property
+    def size(self) -> int:
+        file = self.open()
+        try:
+            return os.fstat(file.fileno()).st_size - file.tell()
+        except (AttributeError, OSError, ValueError):
+            position = file.tell()
+            size = file.seek(0, os.SEEK_END) - position
+            file.seek(position)
+            return size
+
+    def chunks(self, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        file = self.open()
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class MultipartStream:
+    """
+    multipart/form-data body that is generated on the fly.
+    Its length is known in advance, so requests sends it with
+    a Content-Length header and reads the files chunk by chunk.
+    Async clients iterate it with `async for`.
+    """
+
+    def __init__(self, fields: Dict[str, Any],
+                 files: Dict[str, MediaSource],
+                 chunk_size: int = CHUNK_SIZE):
+        self.boundary = uuid4().hex
+        self.chunk_size = chunk_size
+        self._parts: List[Tuple[bytes, Optional[MediaSource]]] = []
+
+        for name, value in fields.items():
+            if value is None:
+                continue
+            header = (f'--{self.boundary}\r\n'
+                      f'Content-Disposition: form-data; '
+                      f'name="{quote_param(name)}"\r\n'
+                      f'\r\n{value}\r\n')
+            self._parts.append((header.encode('utf-8'), None))
+        for name, media in files.items():
+            header = (f'--{self.boundary}\r\n'
+                      f'Content-Disposition: form-data; '
+                      f'name="{quote_param(name)}"; '
+                      f'filename="{quote_param(media.file_name)}"\r\n'
+                      f'Content-Type: {media.mime_type}\r\n\r\n')
+            self._parts.append((header.encode('utf-8'), media))
+        self._closing = f'--{self.boundary}--\r\n'.encode('utf-8')
+
+    @property
+    def content_type(self) -> str:
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def __len__(self) -> int:
+        length = len(self._closing)
+        for header, media in self._parts:
+            length += len(header)
+            if media is not None:
+                length += media.size + 2
+        return length
+
+    def __iter__(self) -> Iterator[bytes]:
+        for header, media in self._parts:
+            yield header
+            if media is not None:
+                yield from media.chunks(self.chunk_size)
+                yield b'\r\n'
+        yield self._closing
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        # files are read in a thread, the event loop isn't blocked
+        loop = asyncio.get_running_loop()
+        for header, media in self._parts:
+            yield header
+            if media is not None:
+                chunks = media.chunks(self.chunk_size)
+                while True:
+                    chunk = await loop.run_in_executor(None, next,
+                                                       chunks, None)
+                    if chunk is None:
+                        break
+                    yield chunk
+                yield b'\r\n'
+        yield self._closing
+
+    def close(self):
+        for _, media in self._parts:
+            if media is not None:
+                media.close()
@@ -1,13 +1,22 @@
+import asyncio
 import json
 import logging
-from typing import Any, Dict, List, Union
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Union
 
+import requests
 from django.http.request import HttpRequest
 # TODO: change tg api implementation to telethon
 from telebot import apihelper, types
 
-from .base_messenger import BaseMessenger
-from ..errors import MessengerException
+from .base_messenger import (
+    AsyncBaseMessenger, BaseMessenger, is_server_error, is_unavailable
+)
+from .multipart import MediaSource, MultipartStream
+from ..errors import (
+    MessengerException, MessengerUnavailable, NotSubscribed,
+    RequestsLimitExceeded
+)
 from ..types import (
     Message, Text, Contact, Location, RichMedia, Url, Button,
     File, Picture, Sticker, Audio, Video, Event, EType, MessageList
@@ -30,7 +39,14 @@ class Telegram(BaseMessenger):
             apihelper.proxy = self.proxy_addr
 
     def enable_webhook(self, url: str, **kwargs):
-        return apihelper.set_webhook(self.token, url)
+        params = {}
+        if kwargs.get('max_connections'):
+            params.update(max_connections=kwargs['max_connections'])
+        if kwargs.get('allowed_updates') is not None:
+            params.update(allowed_updates=kwargs['allowed_updates'])
+        if kwargs.get('drop_pending_updates'):
+            params.update(drop_pending_updates=True)
+        return apihelper.set_webhook(self.token, url, **params)
 
     def disable_webhook(self):
         return apihelper.set_webhook(self.token)
@@ -85,9 +101,61 @@ class Telegram(BaseMessenger):
             'info': data
         }
 
+    def probe_accounts(self, user_ids: List[str]) -> Dict[str, Optional[bool]]:
+        # Telegram has no batch method; getChat is the cheapest call
+        # without side effects for the user. It fails for deleted users and
+        # chats the bot can't reach, but succeeds for users who blocked
+        # the bot, so a success tells nothing (these are found by a failed
+        # send, NotSubscribed) and must not activate an account.
+        result = {}
+        for user_id in user_ids:
+            try:
+                apihelper.get_chat(self.token, user_id)
+                result[user_id] = None
+            except Exception as err:
+                if (getattr(err, 'error_code', None) == 403
+                        or 'Error code: 403' in str(err)
+                        or 'chat not found' in str(err)):
+                    result[user_id] = False
+                else:
+                    log.warning(f'Probe failed; User={user_id}; Error={err};')
+                    result[user_id] = None
+        return result
+
     def parse_message(self, request: HttpRequest) -> Message:
         return self._from_tg_message(json.loads(request.body))
 
+    def get_updates(self, offset: int = None, limit: int = 100,
+                    timeout: int = 30) -> List[Dict[str, Any]]:
+        params = {'offset': offset, 'limit': limit, 'timeout': timeout}
+        try:
+            response = requests.post(
+                f'https://api.telegram.org/bot{self.token}/getUpdates',
+                json={k: v for k, v in params.items() if v is not None},
+                proxies=self.proxy_addr,
+                timeout=(apihelper.CONNECT_TIMEOUT, timeout + 10)
+            )
+            data = response.json()
+        except Exception as err:
+            raise MessengerException(err)
+
+        if not data.get('ok'):
+            raise MessengerException(f'Telegram getUpdates failed; '
+                                     f'Response={data};')
+        return data['result']
+
+    def parse_update(self, update: Dict[str, Any]) -> Message:
+        return self._from_tg_message(update)
+
+    def update_sender(self, update: Dict[str, Any]) -> Optional[str]:
+        tg_object = self._update_object(update)
+        chat = tg_object.get('chat') or tg_object.get('from') or {}
+        return str(chat['id']) if chat.get('id') else None
+
+    def update_timestamp(self, update: Dict[str, Any]) -> Optional[datetime]:
+        date = self._update_object(update).get('date')
+        return datetime.fromtimestamp(date, timezone.utc) if date else None
+
     def send_message(self, receiver: str,
                      messages: Union[Message, List[Message]]) -> List[str]:
         if isinstance(messages, MessageList):
@@ -97,11 +165,13 @@ class Telegram(BaseMessenger):
 
         message_ids = []
         for message in messages:
-            # try:
-            message_id = self._send_message(receiver, message)
+            try:
+                message_id = self._send_message(receiver, message)
+            except MessengerException:
+                raise
+            except Exception as err:
+                raise self._api_error(err)
             message_ids.append(message_id)
-            # except Exception as err:
-            #     raise MessengerException(err)
 
         return message_ids
 
@@ -109,6 +179,33 @@ class Telegram(BaseMessenger):
 
     # region Help methods
 
+    @staticmethod
+    def _api_error(err: Any, result: Dict[str, Any] = None) -> Exception:
+        """
+        Convert an apihelper exception to a bot engine one
+        :param err: exception or error text
+        :param result: API response, if the request is made directly
+        :return: exception to raise
+        """
+        result = result or getattr(err, 'result_json', None) or {}
+        error_code = getattr(err, 'error_code', None) or result.get('error_code')
+        if error_code == 429 or 'Error code: 429' in str(err):
+            retry_after = (result.get('parameters') or {}).get('retry_after')
+            return RequestsLimitExceeded(err, retry_after=retry_after)
+        if error_code == 403 or 'Error code: 403' in str(err):
+            return NotSubscribed(err)
+        if is_server_error(error_code) or is_unavailable(err):
+            return MessengerUnavailable(err)
+        return MessengerException(err)
+
+    @staticmethod
+    def _update_object(update: Dict[str, Any]) -> Dict[str, Any]:
+        # update = {'update_id': 268489, 'message': {...}}
+        for value in update.values():
+            if isinstance(value, dict):
+                return value
+        return {}
+
     def _from_tg_message(self, update: dict) -> Message:
         # update = {
         #     'update_id': 268489,
@@ -382,7 +479,11 @@ class Telegram(BaseMessenger):
         # TODO implement chat work. now only tet-a-tet
         receiver = receiver.split('_')[0]
 
-        if isinstance(message, Text):
+        if getattr(message, 'file', None) is not None and not message.file_id:
+            msg_id = self._upload_file(receiver, message,
+                                       reply_to_message_id=reply_to_id,
+                                       reply_markup=kb)
+        elif isinstance(message, Text):
             msg_id = apihelper.send_message(
                 self.token, receiver, message.text,
                 reply_to_message_id=reply_to_id,
@@ -491,6 +592,59 @@ class Telegram(BaseMessenger):
 
         return f'{receiver}_{msg_id}'
 
+    def _upload_file(self, receiver: str, message: Message,
+                     **kwargs) -> Dict[str, Any]:
+        """
+        Send a local file as a streamed multipart request.
+        apihelper builds the whole multipart body in memory,
+        so the upload is made here and the file is read in chunks.
+        """
+        if isinstance(message, Picture):
+            method_name, field = 'sendPhoto', 'photo'
+        elif isinstance(message, Audio) and message.is_voice:
+            method_name, field = 'sendVoice', 'voice'
+        elif isinstance(message, Audio):
+            method_name, field = 'sendAudio', 'audio'
+        elif isinstance(message, Video) and message.is_video_note:
+            method_name, field = 'sendVideoNote', 'video_note'
+        elif isinstance(message, Video):
+            method_name, field = 'sendVideo', 'video'
+        else:
+            method_name, field = 'sendDocument', 'document'
+
+        reply_markup = kwargs.get('reply_markup')
+        params = {
+            'chat_id': receiver,
+            'caption': message.text,
+            'duration': getattr(message, 'file_duration', None),
+            'reply_to_message_id': kwargs.get('reply_to_message_id'),
+            'reply_markup': reply_markup.to_json() if reply_markup else None,
+        }
+        if method_name == 'sendAudio':
+            params.update(title=message.file_name)
+
+        body = MultipartStream(params, {field: MediaSource(
+            message.file, message.file_name, message.file_mime_type
+        )})
+        try:
+            response = requests.post(
+                f'https://api.telegram.org/bot{self.token}/{method_name}',
+                data=body, headers={'Content-Type': body.content_type},
+                proxies=self.proxy_addr,
+                timeout=(apihelper.CONNECT_TIMEOUT, apihelper.READ_TIMEOUT)
+            )
+            data = response.json()
+        except Exception as err:
+            raise self._api_error(err)
+        finally:
+            body.close()
+
+        if not data.get('ok'):
+            raise self._api_error(f'Telegram upload failed; '
+                                  f'Method={method_name}; Response={data};',
+                                  data)
+        return data['result']
+
     def get_file_url(self, file_id: str) -> str:
         # TODO make download and save on this server
         try:
@@ -540,3 +694,171 @@ class Telegram(BaseMessenger):
     # objects InlineQueryResultArticle, etc.
     # object InputMessageContent
     # ChosenInlineResult
+
+
+class AsyncTelegram(AsyncBaseMessenger):
+    """
+    Async IM connector for Telegram Bot API
+    """
+
+    async def enable_webhook(self, url: str, **kwargs):
+        params = {'url': url}
+        if kwargs.get('max_connections'):
+            params.update(max_connections=kwargs['max_connections'])
+        if kwargs.get('allowed_updates') is not None:
+            params.update(allowed_updates=kwargs['allowed_updates'])
+        if kwargs.get('drop_pending_updates'):
+            params.update(drop_pending_updates=True)
+        return await self._request('setWebhook', params)
+
+    async def disable_webhook(self):
+        return await self._request('setWebhook', {'url': ''})
+
+    async def get_user_info(self, user_id: str, **kwargs) -> Dict[str, Any]:
+        data = await self._request('getChatMember', {
+            'chat_id': kwargs.get('chat_id') or user_id, 'user_id': user_id
+        })
+        photos = await self._request('getUserProfilePhotos',
+                                     {'user_id': user_id})
+        photo_url = None
+        if photos['total_count'] > 0:
+            photo_url = await self.get_file_url(
+                photos['photos'][0][0]['file_id'])
+        data.update(avatar=photo_url, photos=photos)
+
+        return {
+            'id': data['user']['id'],
+            'username': data['user'].get('username'),
+            'avatar': photo_url,
+            'info': data
+        }
+
+    async def get_file_url(self, file_id: str) -> str:
+        try:
+            file = await self._request('getFile', {'file_id': file_id})
+        except MessengerException as err:
+            log.exception(err)
+            return ''
+        return f'https://api.telegram.org/file/bot{self.token}/{file["file_path"]}'
+
+    async def send_message(self, receiver: str,
+                           messages: Union[Message, List[Message]]) -> List[str]:
+        if isinstance(messages, MessageList):
+            messages = messages.as_list()
+        elif isinstance(messages, Message):
+            messages = [messages]
+
+        message_ids = []
+        for message in messages:
+            message_ids.append(await self._send_message(receiver, message))
+        return message_ids
+
+    async def _send_message(self, receiver: str, message: Message) -> str:
+        # TODO implement chat work. now only tet-a-tet
+        receiver = receiver.split('_')[0]
+        params = {'chat_id': receiver}
+        if message.buttons:
+            kb = types.ReplyKeyboardMarkup()
+            kb.add(*[x.text for x in message.buttons])
+            params.update(reply_markup=kb.to_json())
+        if message.reply_to_id:
+            params.update(reply_to_message_id=message.reply_to_id.split('_')[1])
+
+        file_field = None
+        if isinstance(message, Text):
+            method_name = 'sendMessage'
+            params.update(text=message.text)
+        elif isinstance(message, Sticker):
+            method_name = 'sendSticker'
+            params.update(sticker=message.file_id)
+        elif isinstance(message, Picture):
+            method_name, file_field = 'sendPhoto', 'photo'
+        elif isinstance(message, Audio) and message.is_voice:
+            method_name, file_field = 'sendVoice', 'voice'
+            params.update(duration=message.file_duration)
+        elif isinstance(message, Audio):
+            method_name, file_field = 'sendAudio', 'audio'
+            params.update(title=message.file_name,
+                          duration=message.file_duration)
+        elif isinstance(message, Video) and message.is_video_note:
+            method_name, file_field = 'sendVideoNote', 'video_note'
+            params.update(duration=message.file_duration)
+        elif isinstance(message, Video):
+            method_name, file_field = 'sendVideo', 'video'
+            params.update(duration=message.file_duration)
+        elif isinstance(message, File):
+            method_name, file_field = 'sendDocument', 'document'
+        elif isinstance(message, Contact):
+            method_name = 'sendContact'
+            params.update(phone_number=message.contact.get('phone'),
+                          first_name=message.contact.get('first_name'))
+        elif isinstance(message, Location):
+            method_name = 'sendLocation'
+            params.update(latitude=message.location.get('latitude'),
+                          longitude=message.location.get('longitude'))
+        elif isinstance(message, RichMedia):
+            method_name = 'sendMessage'
+            params.update(text=message.text, parse_mode=message.rich_media)
+        elif isinstance(message, Url):
+            method_name = 'sendMessage'
+            params.update(text=message.text or message.url)
+        else:
+            method_name = 'sendMessage'
+            params.update(text=message.context)
+
+        if file_field is None:
+            result = await self._request(method_name, params)
+        elif message.file is not None and not message.file_id:
+            params.update(caption=message.text)
+            result = await self._upload(method_name, params, file_field,
+                                        message)
+        else:
+            params.update(caption=message.text)
+            params[file_field] = message.file_id or message.file_url
+            result = await self._request(method_name, params)
+
+        return f'{receiver}_{result["message_id"]}'
+
+    async def _request(self, method_name: str,
+                       params: Dict[str, Any]) -> Any:
+        params = {k: v for k, v in params.items() if v is not None}
+        try:
+            response = await self.client.post(
+                f'https://api.telegram.org/bot{self.token}/{method_name}',
+                json=params)
+            data = response.json()
+        except Exception as err:
+            raise Telegram._api_error(err)
+
+        if not data.get('ok'):
+            raise Telegram._api_error(f'Telegram request failed; '
+                                      f'Method={method_name}; '
+                                      f'Response={data};', data)
+        return data['result']
+
+    async def _upload(self, method_name: str, params: Dict[str, Any],
+                      file_field: str, message: Message) -> Any:
+        body = MultipartStream(params, {file_field: MediaSource(
+            message.file, message.file_name, message.file_mime_type
+        )})
+
+        try:
+            # the file is opened and read in a thread
+            length = await asyncio.get_running_loop().run_in_executor(
+                None, len, body)
+            response = await self.client.post(
+                f'https://api.telegram.org/bot{self.token}/{method_name}',
+                content=body.__aiter__(),
+                headers={'Content-Type': body.content_type,
+                         'Content-Length': str(length)})
+            data = response.json()
+        except Exception as err:
+            raise Telegram._api_error(err)
+        finally:
+            body.close()
+
+        if not data.get('ok'):
+            raise Telegram._api_error(f'Telegram upload failed; '
+                                      f'Method={method_name}; '
+                                      f'Response={data};', data)
+        return data['result']
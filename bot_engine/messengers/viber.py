@@ -2,6 +2,7 @@ import json
 import logging
 from typing import Any, Dict, List, Optional, Union
 
+from asgiref.sync import sync_to_async
 from django.contrib.sites.models import Site
 from django.db.models import Model
 from django.http.request import HttpRequest
@@ -13,8 +14,11 @@ from viberbot.api.messages.typed_message import TypedMessage
 from viberbot.api import viber_requests as vbr
 from viberbot.api.viber_requests.viber_request import ViberRequest
 
-from .base_messenger import BaseMessenger
-from ..errors import MessengerException, NotSubscribed, RequestsLimitExceeded
+from .base_messenger import AsyncBaseMessenger, BaseMessenger, is_unavailable
+from ..errors import (
+    MessengerException, MessengerUnavailable, NotSubscribed,
+    RequestsLimitExceeded
+)
 from ..types import (
     Message, Text, Contact, Location, RichMedia, Url, Button,
     File, Picture, Sticker, Audio, Video, Event, EType, MessageList
@@ -24,10 +28,108 @@ from ..types import (
 log = logging.getLogger(__name__)
 
 
-class Viber(BaseMessenger):
+class ViberMessageMixin:
+    """
+    Conversion of messages to Viber API objects,
+    shared by sync and async connectors
+    """
+
+    def _to_viber_message(self, message: Message) -> VbMessage:
+        kb = self._get_keyboard(message.buttons)
+
+        if isinstance(message, Text):
+            return vbm.TextMessage(text=message.text, keyboard=kb)
+        if isinstance(message, Sticker):
+            return vbm.StickerMessage(sticker_id=message.file_id, keyboard=kb)
+        elif isinstance(message, Picture):
+            return vbm.PictureMessage(
+                media=self._media_url(message), text=message.text, keyboard=kb
+            )
+        elif isinstance(message, Video):
+            return vbm.VideoMessage(
+                media=self._media_url(message), size=message.file_size,
+                text=message.text, keyboard=kb
+            )
+        elif isinstance(message, (File, Audio)):
+            return vbm.FileMessage(
+                media=self._media_url(message), size=message.file_size or 0,
+                file_name=message.file_name or '', keyboard=kb
+            )
+        elif isinstance(message, Contact):
+            contact = message.contact
+            return vbm.ContactMessage(contact=contact, keyboard=kb)
+        elif isinstance(message, Url):
+            return vbm.URLMessage(media=message.url, keyboard=kb)
+        elif isinstance(message, Location):
+            location = message.location
+            return vbm.LocationMessage(location=location, keyboard=kb)
+        elif isinstance(message, RichMedia):
+            rich_media = message.rich_media
+            return vbm.RichMediaMessage(
+                rich_media=rich_media, alt_text=message.text, keyboard=kb
+            )
+
+    @staticmethod
+    def _media_url(message: Message) -> str:
+        """
+        Viber API downloads media by URL only, so a local file can be sent
+        only if it is kept in a django storage with a public URL.
+        """
+        if message.file_url or message.file is None:
+            return message.file_url
+        url = getattr(message.file, 'url', None)
+        if not url:
+            raise MessengerException(f'Viber cannot upload local files; '
+                                     f'File={message.file};')
+        if url.startswith('/'):
+            domain = Site.objects.get_current().domain
+            url = f'https://{domain}{url}'
+        return url
+
+    @staticmethod
+    def _get_keyboard(buttons: List[Button]) -> Optional[Dict[str, Any]]:
+        # TODO do refactoring
+        if not buttons:
+            return None
+
+        vb_buttons = []
+        for button in buttons:
+            # assert isinstance(button, Button), f'{button=} {type(button)}'
+            vb_btn = {
+                'Columns': 2,  # TODO: how is it storage in Model?
+                'Rows': 1,
+                'BgColor': '#aaaaaa',
+                'ActionType': 'reply',
+                'ActionBody': button.command,
+                'Text': '<font color="{clr}"><b>{text}'
+                        '</b></font>'.format(text=button.text, clr='#131313'),
+                'TextVAlign': 'middle', 'TextHAlign': 'center',
+                'TextOpacity': 60, 'TextSize': 'large',
+                'TextPaddings': [12, 8, 8, 20],  # [up, left, right, bottom]
+            }
+
+            if hasattr(button, 'image'):
+                domain = Site.objects.get_current().domain
+                vb_btn.update({
+                    'BgMedia': f'https://{domain}{button.image}',
+                    'BgMediaScaleType': 'fill'
+                })
+
+            vb_buttons.append(vb_btn)
+
+        return {
+            'Type': 'keyboard',
+            'BgColor': '#ffffff',
+            'min_api_version': 6,
+            'Buttons': vb_buttons,
+        }
+
+
+class Viber(ViberMessageMixin, BaseMessenger):
     """
     IM connector for Viber Bot API
     """
+    probe_batch_size = 100
     # region Interface
 
     def __init__(self, token: str, **kwargs):
@@ -40,7 +142,8 @@ class Viber(BaseMessenger):
         ))
 
     def enable_webhook(self, url: str, **kwargs):
-        return self.bot.set_webhook(url=url)
+        return self.bot.set_webhook(
+            url=url, webhook_events=kwargs.get('event_types') or None)
 
     def disable_webhook(self):
         return self.bot.unset_webhook()
@@ -116,6 +219,26 @@ class Viber(BaseMessenger):
             'info': data,
         }
 
+    def probe_accounts(self, user_ids: List[str]) -> Dict[str, Optional[bool]]:
+        # users = [{
+        #     "id": "01234567890=",
+        #     "online_status": 0,  # 0 online, 1 offline, 2 undisclosed,
+        #                          # 3 try later, 4 unavailable
+        #     "online_status_message": "online"
+        # }]
+        try:
+            users = self.bot.get_online(list(user_ids))
+        except Exception as err:
+            if 'failed with status: 12' in str(err):
+                raise RequestsLimitExceeded(err)
+            raise MessengerException(err)
+
+        result = {}
+        for user in users:
+            status = user.get('online_status')
+            result[user.get('id')] = (None if status == 3 else status != 4)
+        return result
+
     def parse_message(self, request: HttpRequest) -> Message:
         # Verify signature
         sign = request.META.get('HTTP_X_VIBER_CONTENT_SIGNATURE')
@@ -142,6 +265,10 @@ class Viber(BaseMessenger):
         except Exception as err:
             if 'failed with status: 6, message: notSubscribed' in str(err):
                 raise NotSubscribed(err)
+            if 'failed with status: 12' in str(err):
+                raise RequestsLimitExceeded(err)
+            if is_unavailable(err):
+                raise MessengerUnavailable(err)
             raise MessengerException(err)
 
     def welcome_message(self, text: str) -> Union[str, Dict[str, Any], None]:
@@ -263,77 +390,77 @@ class Viber(BaseMessenger):
                     f'Object={vb_request};')
         return Text(timestamp=vb_request.timestamp, text=str(vb_request))
 
-    def _to_viber_message(self, message: Message) -> VbMessage:
-        kb = self._get_keyboard(message.buttons)
-
-        if isinstance(message, Text):
-            return vbm.TextMessage(text=message.text, keyboard=kb)
-        if isinstance(message, Sticker):
-            return vbm.StickerMessage(sticker_id=message.file_id, keyboard=kb)
-        elif isinstance(message, Picture):
-            return vbm.PictureMessage(
-                media=message.file_url, text=message.text, keyboard=kb
-            )
-        elif isinstance(message, Video):
-            return vbm.VideoMessage(
-                media=message.file_url, size=message.file_size,
-                text=message.text, keyboard=kb
-            )
-        elif isinstance(message, (File, Audio)):
-            return vbm.FileMessage(
-                media=message.file_url, size=message.file_size or 0,
-                file_name=message.file_name or '', keyboard=kb
-            )
-        elif isinstance(message, Contact):
-            contact = message.contact
-            return vbm.ContactMessage(contact=contact, keyboard=kb)
-        elif isinstance(message, Url):
-            return vbm.URLMessage(media=message.url, keyboard=kb)
-        elif isinstance(message, Location):
-            location = message.location
-            return vbm.LocationMessage(location=location, keyboard=kb)
-        elif isinstance(message, RichMedia):
-            rich_media = message.rich_media
-            return vbm.RichMediaMessage(
-                rich_media=rich_media, alt_text=message.text, keyboard=kb
-            )
+    # endregion
 
-    @staticmethod
-    def _get_keyboard(buttons: List[Button]) -> Optional[Dict[str, Any]]:
-        # TODO do refactoring
-        if not buttons:
-            return None
 
-        vb_buttons = []
-        for button in buttons:
-            # assert isinstance(button, Button), f'{button=} {type(button)}'
-            vb_btn = {
-                'Columns': 2,  # TODO: how is it storage in Model?
-                'Rows': 1,
-                'BgColor': '#aaaaaa',
-                'ActionType': 'reply',
-                'ActionBody': button.command,
-                'Text': '<font color="{clr}"><b>{text}'
-                        '</b></font>'.format(text=button.text, clr='#131313'),
-                'TextVAlign': 'middle', 'TextHAlign': 'center',
-                'TextOpacity': 60, 'TextSize': 'large',
-                'TextPaddings': [12, 8, 8, 20],  # [up, left, right, bottom]
-            }
+class AsyncViber(ViberMessageMixin, AsyncBaseMessenger):
+    """
+    Async IM connector for Viber Bot API
+    """
 
-            if hasattr(button, 'image'):
-                domain = Site.objects.get_current().domain
-                vb_btn.update({
-                    'BgMedia': f'https://{domain}{button.image}',
-                    'BgMediaScaleType': 'fill'
-                })
+    async def enable_webhook(self, url: str, **kwargs):
+        params = {'url': url}
+        if kwargs.get('event_types'):
+            params.update(event_types=kwargs['event_types'])
+        return await self._request('set_webhook', params)
 
-            vb_buttons.append(vb_btn)
+    async def disable_webhook(self):
+        return await self._request('set_webhook', {'url': ''})
 
+    async def get_user_info(self, user_id: str, **kwargs) -> Dict[str, Any]:
+        data = (await self._request('get_user_details', {'id': user_id}))['user']
         return {
-            'Type': 'keyboard',
-            'BgColor': '#ffffff',
-            'min_api_version': 6,
-            'Buttons': vb_buttons,
+            'id': data.get('id'),
+            'username': data.get('name'),
+            'avatar': data.get('avatar'),
+            'info': data,
         }
 
-    # endregion
+    async def get_file_url(self, file_id: str) -> str:
+        # Viber sends media as URLs
+        return file_id
+
+    async def send_message(self, receiver: str,
+                           messages: Union[Message, List[Message]]) -> List[str]:
+        if isinstance(messages, MessageList):
+            messages = messages.as_list()
+        elif isinstance(messages, Message):
+            messages = [messages]
+
+        # media and button image URLs may need the current site,
+        # it is read from the database outside of the event loop
+        to_viber_message = sync_to_async(self._to_viber_message,
+                                         thread_sensitive=False)
+        tokens = []
+        for message in messages:
+            payload = (await to_viber_message(message)).to_dict()
+            payload.update(receiver=receiver, sender={
+                'name': self.name, 'avatar': self.avatar_url
+            })
+            result = await self._request('send_message', payload)
+            tokens.append(result['message_token'])
+        return tokens
+
+    async def _request(self, endpoint: str,
+                       params: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            response = await self.client.post(
+                f'https://chatapi.viber.com/pa/{endpoint}', json=params,
+                headers={'X-Viber-Auth-Token': self.token})
+            response.raise_for_status()
+            data = response.json()
+        except Exception as err:
+            if is_unavailable(err):
+                raise MessengerUnavailable(err)
+            raise MessengerException(err)
+
+        status = data.get('status')
+        if status == 6:
+            raise NotSubscribed(f'Viber request failed; Response={data};')
+        if status == 12:
+            raise RequestsLimitExceeded(f'Viber request failed; '
+                                        f'Response={data};')
+        if status != 0:
+            raise MessengerException(f'Viber request failed; '
+                                     f'Endpoint={endpoint}; Response={data};')
+        return data
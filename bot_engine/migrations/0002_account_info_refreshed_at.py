@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 02:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot_engine', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='info_refreshed_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True, verbose_name='information refreshed'),
+        ),
+    ]
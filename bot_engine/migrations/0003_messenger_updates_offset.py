@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 02:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot_engine', '0002_account_info_refreshed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messenger',
+            name='updates_offset',
+            field=models.BigIntegerField(default=0, editable=False, help_text='Id of the next update pulled by the runbot command.', verbose_name='updates offset'),
+        ),
+    ]
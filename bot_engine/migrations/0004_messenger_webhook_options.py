@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-19 02:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot_engine', '0003_messenger_updates_offset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messenger',
+            name='webhook_allowed_updates',
+            field=models.JSONField(blank=True, default=list, help_text='List of update types sent to the webhook, e.g. ["message", "callback_query"]. Empty list for all types. Used by: Telegram.', verbose_name='allowed updates'),
+        ),
+        migrations.AddField(
+            model_name='messenger',
+            name='webhook_drop_pending_updates',
+            field=models.BooleanField(blank=True, default=False, help_text='Drop updates queued on the API server when the webhook is enabled. Used by: Telegram.', verbose_name='drop pending updates'),
+        ),
+        migrations.AddField(
+            model_name='messenger',
+            name='webhook_event_types',
+            field=models.JSONField(blank=True, default=list, help_text='List of events sent to the webhook, e.g. ["subscribed", "unsubscribed", "conversation_started"]. Empty list for default events. Used by: Viber.', verbose_name='event types'),
+        ),
+        migrations.AddField(
+            model_name='messenger',
+            name='webhook_max_connections',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='Max number of simultaneous webhook connections (1-100). Match it to the number of workers. Used by: Telegram.', null=True, verbose_name='max connections'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-19 02:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot_engine', '0004_messenger_webhook_options'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messenger',
+            name='stale_policy',
+            field=models.CharField(choices=[('process', 'Process'), ('drop', 'Drop'), ('summarize', 'Summarize'), ('defer', 'Defer')], default='process', help_text='Drop stale messages, answer them once with the stale text (summarize) or process them in the background after fresh ones (defer).', max_length=16, verbose_name='stale policy'),
+        ),
+        migrations.AddField(
+            model_name='messenger',
+            name='stale_text',
+            field=models.TextField(blank=True, default='', help_text='The message sent once to an account instead of answers to its stale messages (summarize policy).', verbose_name='stale text'),
+        ),
+        migrations.AddField(
+            model_name='messenger',
+            name='stale_timeout',
+            field=models.PositiveIntegerField(blank=True, help_text='Messages older than this number of seconds are stale, e.g. replayed by the messenger API after an outage. Leave empty to process all messages as fresh.', null=True, verbose_name='stale timeout'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-19 02:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot_engine', '0005_messenger_stale_policy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FailedUpdate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('body', models.TextField(help_text='Raw request body.', verbose_name='body')),
+                ('headers', models.JSONField(blank=True, default=dict, help_text='Request headers needed to parse the body, e.g. a signature.', verbose_name='headers')),
+                ('error', models.TextField(blank=True, default='', verbose_name='error')),
+                ('traceback', models.TextField(blank=True, default='', verbose_name='traceback')),
+                ('attempts', models.PositiveSmallIntegerField(default=1, verbose_name='attempts')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='updated')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+                ('messenger', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='failed_updates', to='bot_engine.messenger', verbose_name='messenger')),
+            ],
+            options={
+                'verbose_name': 'failed update',
+                'verbose_name_plural': 'failed updates',
+                'ordering': ('id',),
+            },
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.2.25 on 2026-10-19 02:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot_engine', '0006_failedupdate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('idempotency_key', models.CharField(blank=True, editable=False, help_text='Incoming update and position of the answer, the same answer is saved once.', max_length=256, null=True, unique=True, verbose_name='idempotency key')),
+                ('payload', models.BinaryField(help_text='Pickled bot_engine.Message object.', verbose_name='payload')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=16, verbose_name='status')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='attempts')),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now, help_text='The message is not sent before this time.', verbose_name='available at')),
+                ('error', models.TextField(blank=True, default='', verbose_name='error')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='sent')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outbox', to='bot_engine.account', verbose_name='account')),
+                ('messenger', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outbox', to='bot_engine.messenger', verbose_name='messenger')),
+            ],
+            options={
+                'verbose_name': 'outbox message',
+                'verbose_name_plural': 'outbox messages',
+                'ordering': ('id',),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='outboxmessage',
+            index=models.Index(fields=['status', 'available_at', 'id'], name='bot_engine_outbox_pending'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 3.2.25 on 2026-10-19 02:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot_engine', '0007_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageLog',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('direction', models.CharField(choices=[('in', 'Incoming'), ('out', 'Outgoing')], max_length=3, verbose_name='direction')),
+                ('message_type', models.CharField(max_length=32, verbose_name='message type')),
+                ('message_id', models.CharField(blank=True, max_length=256, null=True, verbose_name='message id')),
+                ('text', models.TextField(blank=True, default='', verbose_name='text')),
+                ('payload', models.JSONField(blank=True, default=dict, verbose_name='payload')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='created')),
+                ('account', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='bot_engine.account', verbose_name='account')),
+                ('messenger', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='bot_engine.messenger', verbose_name='messenger')),
+            ],
+            options={
+                'verbose_name': 'message log',
+                'verbose_name_plural': 'message log',
+                'ordering': ('-created', '-id'),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='messagelog',
+            index=models.Index(fields=['account', '-created', '-id'], name='bot_engine_log_account'),
+        ),
+        migrations.AddIndex(
+            model_name='messagelog',
+            index=models.Index(fields=['messenger', '-created'], name='bot_engine_log_messenger'),
+        ),
+        migrations.AddIndex(
+            model_name='messagelog',
+            index=models.Index(fields=['created'], name='bot_engine_log_created'),
+        ),
+    ]
@@ -0,0 +1,59 @@
+from django.db import migrations
+
+
+SEARCH_CONFIG = 'simple'
+FTS_TABLE = 'bot_engine_messagelog_fts'
+
+
+def create_index(apps, schema_editor):
+    connection = schema_editor.connection
+    table = apps.get_model('bot_engine', 'MessageLog')._meta.db_table
+    if connection.vendor == 'postgresql':
+        schema_editor.execute(
+            f"CREATE INDEX bot_engine_log_text_search ON {table} "
+            f"USING gin (to_tsvector('{SEARCH_CONFIG}', \"text\"))")
+    elif connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA compile_options')
+            if 'ENABLE_FTS5' not in {row[0] for row in cursor.fetchall()}:
+                return
+        # external content table, kept in sync by triggers
+        for statement in (
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+            f"text, content='{table}', content_rowid='id')",
+            f"CREATE TRIGGER {FTS_TABLE}_ai AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {FTS_TABLE}(rowid, text) "
+            f"VALUES (new.id, new.text); END",
+            f"CREATE TRIGGER {FTS_TABLE}_ad AFTER DELETE ON {table} BEGIN "
+            f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text) "
+            f"VALUES ('delete', old.id, old.text); END",
+            f"CREATE TRIGGER {FTS_TABLE}_au AFTER UPDATE OF text ON {table} "
+            f"BEGIN "
+            f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text) "
+            f"VALUES ('delete', old.id, old.text); "
+            f"INSERT INTO {FTS_TABLE}(rowid, text) "
+            f"VALUES (new.id, new.text); END",
+            f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+        ):
+            schema_editor.execute(statement)
+
+
+def drop_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS bot_engine_log_text_search')
+    elif connection.vendor == 'sqlite':
+        for trigger in ('ai', 'ad', 'au'):
+            schema_editor.execute(f'DROP TRIGGER IF EXISTS {FTS_TABLE}_{trigger}')
+        schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot_engine', '0008_messagelog'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
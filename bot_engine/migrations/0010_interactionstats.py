@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-19 02:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot_engine', '0009_messagelog_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InteractionStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('menu', 'Menu'), ('button', 'Button')], max_length=8, verbose_name='kind')),
+                ('object_id', models.PositiveIntegerField(verbose_name='menu or button id')),
+                ('bucket', models.DateTimeField(verbose_name='period start')),
+                ('clicks', models.PositiveIntegerField(default=0, verbose_name='clicks')),
+                ('unique_accounts', models.PositiveIntegerField(default=0, help_text='Estimated by the sketch.', verbose_name='unique accounts')),
+                ('errors', models.PositiveIntegerField(default=0, verbose_name='handler errors')),
+                ('sketch', models.BinaryField(help_text='HyperLogLog registers of account ids.', verbose_name='sketch')),
+            ],
+            options={
+                'verbose_name': 'interaction stats',
+                'verbose_name_plural': 'interaction stats',
+                'ordering': ('-bucket',),
+                'unique_together': {('kind', 'object_id', 'bucket')},
+            },
+        ),
+    ]
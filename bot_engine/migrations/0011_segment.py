@@ -0,0 +1,48 @@
+# Generated by Django 3.2.25 on 2026-10-19 02:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot_engine', '0010_interactionstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Segment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=256, unique=True, verbose_name='title')),
+                ('utm_source', models.CharField(blank=True, default='', max_length=256, verbose_name='utm source')),
+                ('is_active', models.BooleanField(blank=True, help_text='Subscribed or unsubscribed accounts, leave empty for both.', null=True, verbose_name='active')),
+                ('seen_days', models.PositiveIntegerField(blank=True, help_text='Accounts with the last visit in this number of days.', null=True, verbose_name='seen in days')),
+                ('size', models.PositiveIntegerField(default=0, editable=False, verbose_name='size')),
+                ('refreshed_at', models.DateTimeField(blank=True, editable=False, null=True, verbose_name='refreshed')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='updated')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+                ('menu', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='segments', to='bot_engine.menu', verbose_name='current menu')),
+                ('messenger', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='segments', to='bot_engine.messenger', verbose_name='messenger')),
+            ],
+            options={
+                'verbose_name': 'segment',
+                'verbose_name_plural': 'segments',
+            },
+        ),
+        migrations.CreateModel(
+            name='SegmentMembership',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='segment_memberships', to='bot_engine.account', verbose_name='account')),
+                ('segment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='bot_engine.segment', verbose_name='segment')),
+            ],
+            options={
+                'verbose_name': 'segment membership',
+                'verbose_name_plural': 'segment memberships',
+                'unique_together': {('segment', 'account')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 02:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot_engine', '0011_segment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Incremented by every update of the account state.', verbose_name='version'),
+        ),
+    ]
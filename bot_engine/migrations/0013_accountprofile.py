@@ -0,0 +1,65 @@
+# Generated by Django 3.2.25 on 2026-10-19 02:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def move_info(apps, schema_editor):
+    Account = apps.get_model('bot_engine', 'Account')
+    AccountProfile = apps.get_model('bot_engine', 'AccountProfile')
+    accounts = Account.objects.exclude(info={}).only('id', 'info')
+    batch = []
+    for account in accounts.iterator(chunk_size=1000):
+        avatar = (account.info or {}).get('avatar') or ''
+        if avatar:
+            Account.objects.filter(id=account.id).update(
+                avatar_url=avatar[:1024])
+        batch.append(AccountProfile(account_id=account.id, info=account.info))
+        if len(batch) >= 1000:
+            AccountProfile.objects.bulk_create(batch)
+            batch = []
+    AccountProfile.objects.bulk_create(batch)
+
+
+def restore_info(apps, schema_editor):
+    Account = apps.get_model('bot_engine', 'Account')
+    AccountProfile = apps.get_model('bot_engine', 'AccountProfile')
+    batch = []
+    for profile in AccountProfile.objects.iterator(chunk_size=1000):
+        batch.append(Account(id=profile.account_id, info=profile.info))
+        if len(batch) >= 1000:
+            Account.objects.bulk_update(batch, ['info'])
+            batch = []
+    Account.objects.bulk_update(batch, ['info'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot_engine', '0012_account_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='avatar_url',
+            field=models.URLField(blank=True, default='', editable=False, max_length=1024, verbose_name='avatar'),
+        ),
+        migrations.CreateModel(
+            name='AccountProfile',
+            fields=[
+                ('account', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='profile', serialize=False, to='bot_engine.account', verbose_name='account')),
+                ('info', models.JSONField(blank=True, default=dict, verbose_name='information')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='updated')),
+            ],
+            options={
+                'verbose_name': 'account profile',
+                'verbose_name_plural': 'account profiles',
+            },
+        ),
+        migrations.RunPython(move_info, restore_info),
+        migrations.RemoveField(
+            model_name='account',
+            name='info',
+        ),
+    ]
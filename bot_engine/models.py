@@ -1,26 +1,56 @@
 from __future__ import annotations
+import copy
 import logging
+import pickle
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from functools import partial
 from hashlib import md5
-from typing import Any, Callable, List, Optional, Type
+from traceback import format_exception
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Type
 from uuid import uuid4
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib.sites.models import Site
-from django.db import models
-from django.db.models import Q
+from django.core.cache import cache
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, Q
 from django.http.request import HttpRequest
 from django.urls import reverse
 from django.utils.module_loading import import_string
+from django.utils import timezone
 from django.utils.text import slugify
 from django.utils.translation import gettext_lazy as _
 from sortedm2m.fields import SortedManyToManyField
 
-from .errors import MessengerException, NotSubscribed, RequestsLimitExceeded
-from .messengers import BaseMessenger
+from .backpressure import load_guard
+from .budgets import handler_budget
+from .context import AccountContext
+from .bulkheads import bulkhead
+from .concurrency import retry_on_conflict
+from .delivery import aretry_call, retry_call, send_ledger
+from .errors import (
+    ConcurrentUpdate, MessengerException, MessengerTimeout, NotSubscribed,
+    RequestsLimitExceeded
+)
+from .lanes import lane_pool
+from .message_log import message_log
+from .messengers import AsyncBaseMessenger, BaseMessenger
+from .profiles import profile_updater
+from .search import search_messages
+from .settings import bot_api_settings
+from .signals import account_updated
+from .stats import interaction_counter
+from .throttling import RateLimiter
 from .types import Message, Event, EType, Text, Button as MButton
+from .utils import keyset_batches, normalize_datetime
+from .workers import deferred_pool
 
 
-__all__ = ('Account', 'Button', 'Menu', 'Messenger')
+__all__ = ('Account', 'AccountProfile', 'Button', 'FailedUpdate',
+           'InteractionStats', 'Menu', 'MessageLog', 'Messenger',
+           'OutboxMessage', 'Segment', 'SegmentMembership')
 
 log = logging.getLogger(__name__)
 
@@ -50,6 +80,36 @@ class MessengerType(models.TextChoices):
             return None
         return import_string(f'bot_engine.messengers.{self}.{self.capitalize()}')
 
+    @property
+    def async_messenger_class(self) -> Optional[Type[AsyncBaseMessenger]]:
+        if self == MessengerType.NONE:
+            return None
+        return import_string(
+            f'bot_engine.messengers.{self}.Async{self.capitalize()}')
+
+
+class StalePolicy(models.TextChoices):
+    PROCESS = 'process'
+    DROP = 'drop'
+    SUMMARIZE = 'summarize'
+    DEFER = 'defer'
+
+
+class MessageDirection(models.TextChoices):
+    INCOMING = 'in'
+    OUTGOING = 'out'
+
+
+class StatsKind(models.TextChoices):
+    MENU = 'menu'
+    BUTTON = 'button'
+
+
+class OutboxStatus(models.TextChoices):
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
 
 class Messenger(models.Model):
     title = models.CharField(
@@ -91,6 +151,48 @@ class Messenger(models.Model):
         null=True, blank=True,
         help_text=_('The root menu. For example, "Home".'))
 
+    webhook_max_connections = models.PositiveSmallIntegerField(
+        _('max connections'),
+        null=True, blank=True,
+        help_text=_('Max number of simultaneous webhook connections (1-100). '
+                    'Match it to the number of workers. Used by: Telegram.'))
+    webhook_allowed_updates = models.JSONField(
+        _('allowed updates'),
+        default=list, blank=True,
+        help_text=_('List of update types sent to the webhook, e.g. '
+                    '["message", "callback_query"]. Empty list for all '
+                    'types. Used by: Telegram.'))
+    webhook_drop_pending_updates = models.BooleanField(
+        _('drop pending updates'),
+        default=False, blank=True,
+        help_text=_('Drop updates queued on the API server when the webhook '
+                    'is enabled. Used by: Telegram.'))
+    webhook_event_types = models.JSONField(
+        _('event types'),
+        default=list, blank=True,
+        help_text=_('List of events sent to the webhook, e.g. '
+                    '["subscribed", "unsubscribed", "conversation_started"]. '
+                    'Empty list for default events. Used by: Viber.'))
+
+    stale_timeout = models.PositiveIntegerField(
+        _('stale timeout'),
+        null=True, blank=True,
+        help_text=_('Messages older than this number of seconds are stale, '
+                    'e.g. replayed by the messenger API after an outage. '
+                    'Leave empty to process all messages as fresh.'))
+    stale_policy = models.CharField(
+        _('stale policy'), max_length=16,
+        choices=StalePolicy.choices,
+        default=StalePolicy.PROCESS,
+        help_text=_('Drop stale messages, answer them once with the stale '
+                    'text (summarize) or process them in the background '
+                    'after fresh ones (defer).'))
+    stale_text = models.TextField(
+        _('stale text'),
+        default='', blank=True,
+        help_text=_('The message sent once to an account instead of answers '
+                    'to its stale messages (summarize policy).'))
+
     hash = models.CharField(
         _('token hash'), max_length=256,
         default='', editable=False)
@@ -99,6 +201,10 @@ class Messenger(models.Model):
         default=False, editable=False,
         help_text=_('This flag changes when the webhook on the messenger API '
                     'server is activated/deactivated.'))
+    updates_offset = models.BigIntegerField(
+        _('updates offset'),
+        default=0, editable=False,
+        help_text=_('Id of the next update pulled by the runbot command.'))
     updated = models.DateTimeField(
         _('updated'), auto_now=True)
     created = models.DateTimeField(
@@ -136,9 +242,31 @@ class Messenger(models.Model):
         :return: Answer data (optional)
         """
         message = self.api.parse_message(request)
+        if not load_guard.admit(self, message):
+            return None
+
+        # the answer to the start event is returned in the response
+        if (bot_api_settings.DISPATCH_LANES and not (
+                isinstance(message, Event)
+                and message.event_type == EType.START)):
+            lane_pool().submit(self, message, request.body, request.META)
+            return None
+        return self.dispatch_message(message)
 
+    def dispatch_message(self, message: Message,
+                         deferred: bool = False) -> Optional[Any]:
+        """
+        Process a parsed incoming message
+        :param message: bot_engine.Message object
+        :param deferred: the stale message is processed in the background
+        :return: Answer data (optional)
+        """
         log.debug(f'Dispatch; Incoming message={message};')
 
+        if (not deferred and not isinstance(message, Event)
+                and self.is_stale(message.sent_at)):
+            return self.process_stale_message(message)
+
         if message.user_id:
             user_id = message.user_id
             default = {
@@ -147,16 +275,29 @@ class Messenger(models.Model):
                 'menu': self.menu,
                 'is_active': True,
             }
-            account, created = Account.objects.get_or_create(
+            account, created = Account.objects.for_dispatch().get_or_create(
                 id=user_id, defaults=default
             )
+            if account.messenger_id == self.id:
+                account.messenger = self
             if not account.menu and self.menu:
-                account.update(menu=self.menu)
-            if created or not account.info:
-                account.update_info()
+                def set_menu():
+                    if not account.menu:
+                        account.update(menu=self.menu)
+                retry_on_conflict(account, set_menu)
+            if created or account.info_refreshed_at is None:
+                if bot_api_settings.PROFILE_UPDATE_DEFERRED:
+                    profile_updater.enqueue(account)
+                else:
+                    account.update_info()
+            account.begin_update(
+                f'{self.id}:{message.id}' if message.id else None)
         else:
             account = None
 
+        if bot_api_settings.SAVE_MESSAGES:
+            message_log.log_incoming(self, account, message)
+
         log.debug(f'Dispatch; {message=}; {account=};')
 
         if isinstance(message, Event):
@@ -166,16 +307,64 @@ class Messenger(models.Model):
                 account.send_message(Text(text=self.welcome_text))
                 return self.api.welcome_message(self.welcome_text)
             elif message.event_type == EType.UNSUBSCRIBED and account:
-                account.update(is_active=False)
+                retry_on_conflict(account, account.update, is_active=False)
             return self.process_service_message(message, account)
 
         message = self.preprocess_message(message, account)
 
         log.debug(f'Dispatch; {message=}; {account=};')
-        if account.menu:
-            account.menu.process_message(message, account)
-        else:
-            self.process_message(message, account)
+        def process():
+            # with the outbox the answers, account changes and context
+            # of the attempt are saved together. Handlers offloaded by
+            # the time budget run in their own thread and transaction.
+            with (transaction.atomic() if bot_api_settings.OUTBOX_ENABLED
+                  else nullcontext()):
+                if account.menu:
+                    account.menu.process_message(message, account)
+                else:
+                    self.process_message(message, account)
+                # changed context keys are written at once, only if
+                # the attempt has succeeded
+                account.state.save()
+
+        # the handlers run again after a conflict. Answers sent before it
+        # are not sent again while the send ledger (django cache) or the
+        # outbox keeps their idempotency keys, context increments and
+        # other side effects of the handlers are not undone.
+        retry_on_conflict(account, process)
+
+    def is_stale(self, sent_at: Optional[datetime]) -> bool:
+        """
+        Check the message age with the stale timeout
+        :param sent_at: message timestamp
+        :return: True if the message is stale
+        """
+        if (not self.stale_timeout or sent_at is None
+                or self.stale_policy == StalePolicy.PROCESS):
+            return False
+        age = timezone.now() - normalize_datetime(sent_at)
+        return age.total_seconds() > self.stale_timeout
+
+    def process_stale_message(self, message: Message) -> None:
+        """
+        Process the stale message with the stale policy.
+        :param message: bot_engine.Message object
+        :return: None
+        """
+        log.debug(f'Dispatch; Stale message={message}; '
+                  f'Policy={self.stale_policy};')
+
+        if self.stale_policy == StalePolicy.DEFER:
+            deferred_pool().submit(message.user_id, (self, message))
+        elif self.stale_policy == StalePolicy.SUMMARIZE and message.user_id:
+            # one answer for all stale messages of the account
+            key = f'bot_engine:stale:{self.id}:{message.user_id}'
+            if self.stale_text and cache.add(key, True, self.stale_timeout):
+                try:
+                    self.call_api('send_message', message.user_id,
+                                  Text(text=self.stale_text))
+                except MessengerException as err:
+                    log.exception(err)
 
     def preprocess_message(self, message: Message, account: Account) -> Message:
         """
@@ -224,12 +413,67 @@ class Messenger(models.Model):
         if not hasattr(self, '_handler') or self.handler != self._old_handler:
             self._handler = import_string(self.handler)
             self._old_handler = self.handler
-        return self._handler
+        return partial(handler_budget.run, self.handler, self._handler)
+
+    def probe_accounts(self, accounts: Iterable[Account] = None,
+                       batch_size: int = 500) -> int:
+        """
+        Check subscription of accounts without spending message quota
+        and save changed `is_active` flags with bulk updates.
+        :param accounts: accounts of this messenger (default all)
+        :param batch_size: number of accounts loaded and saved at once
+        :return: number of changed accounts
+        """
+        if accounts is None:
+            accounts = keyset_batches(
+                self.accounts.only('id', 'is_active'), batch_size)
+        else:
+            accounts = [list(accounts)]
+
+        limiter = RateLimiter(bot_api_settings.PROBE_RATE_LIMIT)
+        chunk_size = self.api.probe_batch_size
+        changed = 0
+        for batch in accounts:
+            to_update = []
+            for i in range(0, len(batch), chunk_size):
+                chunk = {account.id: account
+                         for account in batch[i:i + chunk_size]}
+                limiter.acquire()
+                try:
+                    result = self.call_api('probe_accounts', list(chunk))
+                except MessengerException as err:
+                    log.exception(err)
+                    continue
+                for user_id, is_active in result.items():
+                    account = chunk.get(user_id)
+                    if (account is None or is_active is None
+                            or account.is_active == is_active):
+                        continue
+                    account.is_active = is_active
+                    to_update.append(account)
+            # the loaded accounts of other workers are outdated now
+            for is_active in (True, False):
+                Account.objects.filter(id__in=[
+                    account.id for account in to_update
+                    if account.is_active == is_active
+                ]).update(is_active=is_active, version=F('version') + 1)
+            for account in to_update:
+                account_updated.send(sender=Account, instance=account,
+                                     created=False,
+                                     update_fields={'is_active', 'version'})
+            changed += len(to_update)
+        return changed
 
     def enable_webhook(self):
         domain = Site.objects.get_current().domain
         url = reverse('bot_engine:webhook', kwargs={'hash': self.token_hash})
-        return self.api.enable_webhook(url=f'https://{domain}{url}')
+        return self.api.enable_webhook(
+            url=f'https://{domain}{url}',
+            max_connections=self.webhook_max_connections,
+            allowed_updates=self.webhook_allowed_updates,
+            drop_pending_updates=self.webhook_drop_pending_updates,
+            event_types=self.webhook_event_types,
+        )
 
     def disable_webhook(self):
         return self.api.disable_webhook()
@@ -245,6 +489,38 @@ class Messenger(models.Model):
             )
         return self._api
 
+    def call_api(self, method_name: str, *args, **kwargs) -> Any:
+        """
+        Call the connector method in the bulkhead of this messenger
+        :param method_name: BaseMessenger method name
+        :return: method result
+        """
+        return bulkhead(self).call(getattr(self.api, method_name),
+                                   *args, **kwargs)
+
+    async def acall_api(self, method_name: str, *args, **kwargs) -> Any:
+        """
+        Await the async connector method in the bulkhead of this messenger
+        :param method_name: AsyncBaseMessenger method name
+        :return: method result
+        """
+        if not hasattr(self, '_aapi'):
+            # the connector is created with the current site from the database
+            await sync_to_async(getattr, thread_sensitive=False)(self, 'aapi')
+        return await bulkhead(self).acall(getattr(self.aapi, method_name),
+                                          *args, **kwargs)
+
+    @property
+    def aapi(self) -> AsyncBaseMessenger:
+        if not hasattr(self, '_aapi'):
+            domain = Site.objects.get_current().domain
+            url = self.logo
+            self._aapi = MessengerType(self.api_type).async_messenger_class(
+                self.token, proxy=self.proxy, name=self.title,
+                avatar=f'https://{domain}{url}'
+            )
+        return self._aapi
+
     @property
     def _api_class(self) -> Type[BaseMessenger]:
         """
@@ -253,9 +529,52 @@ class Messenger(models.Model):
         return MessengerType(self.api_type).messenger_class
 
 
-class AccountManager(models.Manager):
+class AccountQuerySet(models.QuerySet):
+    # columns read while a message is dispatched
+    DISPATCH_FIELDS = ('id', 'username', 'avatar_url', 'messenger', 'menu',
+                       'user', 'is_active', 'info_refreshed_at', 'version')
+    # columns read by bulk jobs, e.g. broadcasts and probes
+    BULK_FIELDS = ('id', 'messenger', 'menu', 'is_active', 'version')
+
+    def for_dispatch(self) -> AccountQuerySet:
+        """
+        Hot path projection: the current menu is joined,
+        the messenger is taken from the dispatching one
+        """
+        return self.select_related('menu').only(
+            *self.DISPATCH_FIELDS, 'menu__id', 'menu__title',
+            'menu__message', 'menu__handler')
+
+    def with_relations(self) -> AccountQuerySet:
+        return self.select_related('user', 'messenger', 'menu')
+
+    def batches(self, batch_size: int = 500) -> Iterator[List[Account]]:
+        """
+        Iterate over accounts in keyset batches
+        """
+        return keyset_batches(self, batch_size)
+
+
+class AccountManager(models.Manager.from_queryset(AccountQuerySet)):
+    """
+    Default manager: all columns of the account, no joins
+    """
+
+
+class FullAccountManager(AccountManager):
+    """
+    Accounts with the user, messenger and menu joined, e.g. for the admin
+    """
+    def get_queryset(self):
+        return super().get_queryset().with_relations()
+
+
+class BulkAccountManager(AccountManager):
+    """
+    Accounts for jobs iterating over many rows: a narrow projection
+    """
     def get_queryset(self):
-        return super().get_queryset().select_related('user', 'messenger', 'menu')
+        return super().get_queryset().only(*AccountQuerySet.BULK_FIELDS)
 
 
 class Account(models.Model):
@@ -268,9 +587,9 @@ class Account(models.Model):
     utm_source = models.CharField(
         _('utm source'), max_length=256,
         null=True, blank=True)
-    info = models.JSONField(
-        _('information'),
-        default=dict, blank=True)
+    avatar_url = models.URLField(
+        _('avatar'), max_length=1024,
+        default='', blank=True, editable=False)
     context = models.JSONField(
         _('context'),
         default=dict, blank=True)
@@ -296,12 +615,21 @@ class Account(models.Model):
         default=False, editable=False,
         help_text=_('This flag changes when the user account on '
                     'the messenger API server is subscribed/unsubscribed.'))
+    info_refreshed_at = models.DateTimeField(
+        _('information refreshed'),
+        null=True, blank=True, editable=False, db_index=True)
+    version = models.PositiveIntegerField(
+        _('version'),
+        default=0, editable=False,
+        help_text=_('Incremented by every update of the account state.'))
     updated = models.DateTimeField(
         _('last visit'), auto_now=True)
     created = models.DateTimeField(
         _('first visit'), auto_now_add=True)
 
     objects = AccountManager()
+    full = FullAccountManager()
+    bulk = BulkAccountManager()
 
     class Meta:
         verbose_name = _('account')
@@ -315,18 +643,232 @@ class Account(models.Model):
         return f'<bot_engine.Account object ({self.id})>'
 
     def update(self, **kwargs):
-        for key, value in kwargs.items():
-            if hasattr(self, key):
-                setattr(self, key, value)
-        self.save()
+        """
+        Compare-and-swap update of the fields: the row is changed only if
+        its version is the loaded one, other columns are not written.
+        `info` is saved to the account profile with the avatar URL.
+        :raise ConcurrentUpdate: the account is changed by another worker
+        :return: None
+        """
+        fields = {name for field in self._meta.concrete_fields
+                  for name in (field.name, field.attname)}
+        values = {key: value for key, value in kwargs.items()
+                  if key in fields}
+        if 'info' in kwargs:
+            info = kwargs['info'] or {}
+            values['avatar_url'] = (info.get('avatar') or '')[:1024]
+
+        now = timezone.now()
+        with transaction.atomic():
+            updated = Account.objects.filter(
+                id=self.id, version=self.version
+            ).update(version=F('version') + 1, updated=now, **values)
+            if not updated:
+                raise ConcurrentUpdate(f'Account {self.id} version '
+                                       f'{self.version} is outdated.')
+            if 'info' in kwargs:
+                self.info = kwargs['info']
+                AccountProfile.save_many([self])
+        for key, value in values.items():
+            setattr(self, key, value)
+        self.version += 1
+        self.updated = now
+        account_updated.send(sender=Account, instance=self, created=False,
+                             update_fields={'version', 'updated', *values})
+
+    def save(self, *args, **kwargs):
+        """
+        Checked save: an existing row is written only if its version is
+        the loaded one and the version is incremented, as by `update()`.
+        :raise ConcurrentUpdate: the account is changed by another worker
+        """
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'version'}
+        created = self._state.adding
+        # a conflict rolls back only this save, as in `update()`
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+        account_updated.send(sender=Account, instance=self, created=created,
+                             update_fields=kwargs.get('update_fields'))
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields,
+                   forced_update):
+        values = [(field, model, F('version') + 1
+                   if field.attname == 'version' else value)
+                  for field, model, value in values]
+        updated = super()._do_update(
+            base_qs.filter(version=self.version), using, pk_val, values,
+            update_fields, forced_update)
+        if updated:
+            self.version += 1
+        elif base_qs.filter(pk=pk_val).exists():
+            raise ConcurrentUpdate(f'Account {self.id} version '
+                                   f'{self.version} is outdated.')
+        return updated
+
+    def reload(self):
+        """
+        Load the account from the database again, e.g. after a conflict.
+        Unsaved context changes are dropped, answers keep their keys.
+        """
+        self.refresh_from_db()
+        self._context = None
+        self._send_position = 0
+        self._detached_count = 0
+
+    def detached(self) -> Account:
+        """
+        Copy of the account for a handler that runs in another thread:
+        the context is not shared with this object and the answers of
+        the copy have their own idempotency keys
+        """
+        account = copy.copy(self)
+        account._context = None
+        update_key = getattr(self, '_update_key', None)
+        if update_key:
+            self._detached_count = getattr(self, '_detached_count', 0) + 1
+            update_key = f'{update_key}:detached:{self._detached_count}'
+        account.begin_update(update_key)
+        return account
+
+    def attach(self, account: Account):
+        """
+        Take over the changes of the detached copy after its handler:
+        the account is reloaded if the copy has updated it and
+        the context is read again, the send position is kept.
+        :param account: copy returned by `detached()`
+        :return: None
+        """
+        if account.version != self.version:
+            self.refresh_from_db()
+        self._context = None
+
+    @property
+    def state(self) -> AccountContext:
+        """
+        Conversation state in the context store (CONTEXT_STORE setting)
+        """
+        if getattr(self, '_context', None) is None:
+            self._context = AccountContext(self.id)
+        return self._context
 
     @property
     def avatar(self) -> str:
-        return self.info.get('avatar') or ''
+        return self.avatar_url
+
+    @property
+    def info(self) -> dict:
+        """
+        Full profile from the messenger API, loaded from the side table
+        on the first access
+        """
+        if getattr(self, '_info', None) is None:
+            self._info = (AccountProfile.objects.filter(account_id=self.id)
+                          .values_list('info', flat=True).first()) or {}
+        return self._info
+
+    @info.setter
+    def info(self, value: dict):
+        self._info = value or {}
+        self.avatar_url = (self._info.get('avatar') or '')[:1024]
 
     def send_message(self, message: Message,
                      buttons: List[MButton] = None,
                      i_buttons: List[MButton] = None):
+        message = self._prepare_message(message, buttons, i_buttons)
+
+        key = self.next_idempotency_key()
+        if (bot_api_settings.OUTBOX_ENABLED
+                and OutboxMessage.enqueue(self, message, key)):
+            return
+        if key and not send_ledger.claim(key):
+            log.info(f'Account {self.id}; Message {key} is already sent.')
+            return
+
+        # TODO: make Massage parameter and handle him in api objects
+        try:
+            # the dispatch doesn't wait long, the outbox relay does
+            retry_call(self.messenger.call_api, 'send_message',
+                       self.id, message, max_delay=(
+                           bot_api_settings.SEND_RETRY_DISPATCH_MAX_DELAY))
+            if bot_api_settings.SAVE_MESSAGES:
+                message_log.log_outgoing(self.messenger_id, self, message)
+        except NotSubscribed:
+            self.is_active = False
+            log.warning(f'Account {self.username}:{self.id} is not subscribed.')
+        except MessengerTimeout as err:
+            # the message may be delivered, the key stays claimed
+            log.exception(err)
+        except (MessengerException, RequestsLimitExceeded) as err:
+            if key:
+                send_ledger.release(key)
+            log.exception(err)
+
+    async def asend_message(self, message: Message,
+                            buttons: List[MButton] = None,
+                            i_buttons: List[MButton] = None):
+        """
+        Async counterpart of `send_message` for async handlers.
+        Database and cache calls don't need the thread of the caller,
+        so sends of different accounts run in parallel.
+        """
+        message = await sync_to_async(
+            self._prepare_async_message, thread_sensitive=False)(
+            message, buttons, i_buttons)
+
+        key = self.next_idempotency_key()
+        if (bot_api_settings.OUTBOX_ENABLED and await sync_to_async(
+                OutboxMessage.enqueue, thread_sensitive=False)(
+                self, message, key)):
+            return
+        if key and not await sync_to_async(
+                send_ledger.claim, thread_sensitive=False)(key):
+            log.info(f'Account {self.id}; Message {key} is already sent.')
+            return
+
+        try:
+            await aretry_call(self.messenger.acall_api, 'send_message',
+                              self.id, message, max_delay=(
+                                  bot_api_settings
+                                  .SEND_RETRY_DISPATCH_MAX_DELAY))
+            if bot_api_settings.SAVE_MESSAGES:
+                message_log.log_outgoing(self.messenger_id, self, message)
+        except NotSubscribed:
+            self.is_active = False
+            log.warning(f'Account {self.username}:{self.id} is not subscribed.')
+        except MessengerTimeout as err:
+            log.exception(err)
+        except (MessengerException, RequestsLimitExceeded) as err:
+            if key:
+                await sync_to_async(
+                    send_ledger.release, thread_sensitive=False)(key)
+            log.exception(err)
+
+    def begin_update(self, update_key: Optional[str]):
+        """
+        Bind the following sends to an incoming update, so their
+        idempotency keys are the same when the update is processed again
+        :param update_key: unique id of the incoming update
+        :return: None
+        """
+        self._update_key = update_key
+        self._send_position = 0
+        self._detached_count = 0
+
+    def next_idempotency_key(self) -> Optional[str]:
+        """
+        Key of the next sent message: incoming update and message position
+        """
+        update_key = getattr(self, '_update_key', None)
+        if not update_key:
+            return None
+        self._send_position += 1
+        return f'{update_key}:{self._send_position}'
+
+    def _prepare_message(self, message: Message,
+                         buttons: List[MButton] = None,
+                         i_buttons: List[MButton] = None) -> Message:
         # TODO simplify
         if buttons:
             message.buttons = message.buttons or [] + buttons
@@ -335,27 +877,96 @@ class Account(models.Model):
         if self.menu:
             message.buttons = message.buttons or [] + self.menu.button_list()
             message.buttons = message.buttons or [] + self.menu.i_button_list()
+        return message
 
-        # TODO: make Massage parameter and handle him in api objects
-        try:
-            self.messenger.api.send_message(self.id, message)
-        except NotSubscribed:
-            self.is_active = False
-            log.warning(f'Account {self.username}:{self.id} is not subscribed.')
-        except MessengerException as err:
-            log.exception(err)
+    def _prepare_async_message(self, message: Message,
+                               buttons: List[MButton] = None,
+                               i_buttons: List[MButton] = None):
+        # menu buttons and the connector are loaded from the database
+        self.messenger.aapi
+        return self._prepare_message(message, buttons, i_buttons)
 
-    def update_info(self):
+    def update_info(self) -> bool:
+        if not self.fetch_info():
+            return False
+        try:
+            with transaction.atomic():
+                self.save(update_fields=['username', 'avatar_url',
+                                         'info_refreshed_at'])
+                AccountProfile.save_many([self])
+        except ConcurrentUpdate as err:
+            # the profile is fetched again by the next update
+            log.info(f'Account {self.id}; Profile is not saved; {err}')
+            return False
+        return True
+
+    def fetch_info(self) -> bool:
+        """
+        Load the user profile from the messenger API without saving.
+        :return: True if the profile is loaded
+        """
         try:
-            user_info = self.messenger.api.get_user_info(self.id,
-                                                         chat_id=self.id)
-            self.update(username=user_info.get('username'),
-                        info=user_info.get('info'))
+            user_info = self.messenger.call_api('get_user_info', self.id,
+                                                chat_id=self.id)
         except RequestsLimitExceeded as err:
-            self.info['error'] = str(err)
             # self.update(username=message.sender.username,
             #             info=requestLimit)
             log.exception(err)
+            return False
+        except MessengerException as err:
+            log.exception(err)
+            return False
+
+        self.username = user_info.get('username')
+        self.info = user_info.get('info')
+        self.info_refreshed_at = timezone.now()
+        return True
+
+
+class AccountProfile(models.Model):
+    """
+    Bulky profile data of an account (e.g. all Telegram photos),
+    kept out of the Account rows read on every message.
+    """
+    account = models.OneToOneField(
+        'Account', models.CASCADE,
+        verbose_name=_('account'), related_name='profile',
+        primary_key=True)
+    info = models.JSONField(
+        _('information'),
+        default=dict, blank=True)
+    updated = models.DateTimeField(
+        _('updated'), auto_now=True)
+
+    class Meta:
+        verbose_name = _('account profile')
+        verbose_name_plural = _('account profiles')
+
+    def __str__(self):
+        return str(self.account_id)
+
+    def __repr__(self):
+        return f'<bot_engine.AccountProfile object ({self.account_id})>'
+
+    @classmethod
+    def save_many(cls, accounts: List[Account]):
+        """
+        Save loaded profiles of the accounts: existing rows are bulk
+        updated, missing ones are bulk created
+        :param accounts: list of bot_engine.Account objects
+        :return: None
+        """
+        profiles = {account.id: cls(account_id=account.id, info=account.info,
+                                    updated=timezone.now())
+                    for account in accounts}
+        existing = set(cls.objects.filter(account_id__in=list(profiles))
+                       .values_list('account_id', flat=True))
+        cls.objects.bulk_update(
+            [profiles[key] for key in existing], ['info', 'updated'])
+        cls.objects.bulk_create(
+            [profile for key, profile in profiles.items()
+             if key not in existing],
+            ignore_conflicts=True)
 
 
 class Menu(models.Model):
@@ -404,6 +1015,10 @@ class Menu(models.Model):
         """
         # TODO check process
         # TODO make permissions filter
+        if bot_api_settings.STATS_ENABLED:
+            interaction_counter.click(StatsKind.MENU, self.id,
+                                      getattr(account, 'id', None))
+
         if isinstance(message, MButton):
             log.debug(f'Menu.process_message; {message.text=} '
                       f'{message.command=}; {self.buttons=};')
@@ -423,13 +1038,22 @@ class Menu(models.Model):
                             ' This can lead to unplanned behavior.'
                             ' We recommend making the buttons unique.')
         elif self.handler:
-            self.call_handler(message, account)
+            try:
+                self.call_handler(message, account,
+                                  on_error=self.handler_error)
+            except Exception as err:
+                self.handler_error(err)
+                raise
+
+    def handler_error(self, error: Exception):
+        if bot_api_settings.STATS_ENABLED:
+            interaction_counter.error(StatsKind.MENU, self.id)
 
     @property
     def call_handler(self) -> Callable:
         if not hasattr(self, '_handler'):
             self._handler = import_string(self.handler)
-        return self._handler
+        return partial(handler_budget.run, self.handler, self._handler)
 
     def button_list(self) -> List[Button]:
         return list(self.buttons.filter(is_inline=False).all())
@@ -505,27 +1129,43 @@ class Button(models.Model):
         :return: None
         """
         # TODO check process
-        if self.message:
-            account.send_message(Text(text=self.message))
-
-        if self.next_menu:
-            account.update(menu=self.next_menu)
-
-            btn_list = list(self.next_menu.buttons.all()) or None
-            if self.next_menu.message:
-                msg_text = self.next_menu.message
-                account.send_message(Text(text=msg_text), buttons=btn_list)
-            else:
-                account.send_message(Message(buttons=btn_list))
+        if bot_api_settings.STATS_ENABLED:
+            interaction_counter.click(StatsKind.BUTTON, self.id,
+                                      getattr(account, 'id', None))
+
+        # the menu change and the answers are saved together to the outbox
+        with (transaction.atomic() if bot_api_settings.OUTBOX_ENABLED
+              else nullcontext()):
+            if self.message:
+                account.send_message(Text(text=self.message))
+
+            if self.next_menu:
+                account.update(menu=self.next_menu)
+
+                btn_list = list(self.next_menu.buttons.all()) or None
+                if self.next_menu.message:
+                    msg_text = self.next_menu.message
+                    account.send_message(Text(text=msg_text), buttons=btn_list)
+                else:
+                    account.send_message(Message(buttons=btn_list))
 
         if self.handler:
-            self.call_handler(message, account)
+            try:
+                self.call_handler(message, account,
+                                  on_error=self.handler_error)
+            except Exception as err:
+                self.handler_error(err)
+                raise
+
+    def handler_error(self, error: Exception):
+        if bot_api_settings.STATS_ENABLED:
+            interaction_counter.error(StatsKind.BUTTON, self.id)
 
     @property
     def call_handler(self) -> Callable:
         if not hasattr(self, '_handler'):
             self._handler = import_string(self.handler)
-        return self._handler
+        return partial(handler_budget.run, self.handler, self._handler)
 
     def save(self, *args, **kwargs):
         if not self.command:
@@ -541,3 +1181,439 @@ class Button(models.Model):
         return {'text': self.title,
                 'command': self.command,
                 'size': (2, 1), }
+
+
+class FailedUpdate(models.Model):
+    """
+    Dead letter: an incoming update whose processing raised an error.
+    It is acknowledged to the messenger API and kept for replay.
+    """
+    messenger = models.ForeignKey(
+        'Messenger', models.CASCADE,
+        verbose_name=_('messenger'), related_name='failed_updates')
+    body = models.TextField(
+        _('body'),
+        help_text=_('Raw request body.'))
+    headers = models.JSONField(
+        _('headers'),
+        default=dict, blank=True,
+        help_text=_('Request headers needed to parse the body, '
+                    'e.g. a signature.'))
+    error = models.TextField(
+        _('error'),
+        default='', blank=True)
+    traceback = models.TextField(
+        _('traceback'),
+        default='', blank=True)
+    attempts = models.PositiveSmallIntegerField(
+        _('attempts'),
+        default=1)
+    updated = models.DateTimeField(
+        _('updated'), auto_now=True)
+    created = models.DateTimeField(
+        _('created'), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _('failed update')
+        verbose_name_plural = _('failed updates')
+        ordering = ('id', )
+
+    def __str__(self):
+        return f'{self.messenger_id}: {self.error[:64]}'
+
+    def __repr__(self):
+        return f'<bot_engine.FailedUpdate object ({self.id})>'
+
+    @classmethod
+    def capture(cls, messenger: Messenger, body: bytes, error: Exception,
+                meta: dict = None) -> FailedUpdate:
+        """
+        Save the update that failed
+        :param messenger: bot_engine.Messenger object
+        :param body: raw request body
+        :param error: raised exception
+        :param meta: request META (optional)
+        :return: FailedUpdate object
+        """
+        headers = {key: value for key, value in (meta or {}).items()
+                   if key.startswith('HTTP_X_') or key == 'CONTENT_TYPE'}
+        return cls.objects.create(
+            messenger=messenger,
+            body=body.decode('utf-8', errors='replace'),
+            headers=headers,
+            error=repr(error),
+            traceback=''.join(format_exception(
+                type(error), error, error.__traceback__)),
+        )
+
+    def as_request(self) -> HttpRequest:
+        request = HttpRequest()
+        request.method = 'POST'
+        request.META.update(self.headers)
+        request._body = self.body.encode('utf-8')
+        return request
+
+    def replay(self) -> bool:
+        """
+        Process the update again, the object is not saved.
+        The update is processed at once, bypassing the stale policy,
+        the load guard and the lanes: it is old by definition and
+        must not be dropped or queued before the dead letter is deleted.
+        :return: True if the update is processed
+        """
+        try:
+            message = self.messenger.api.parse_message(self.as_request())
+            self.messenger.dispatch_message(message, deferred=True)
+        except Exception as err:
+            log.exception(f'Replay; FailedUpdate={self.id}; Error={err};')
+            self.attempts += 1
+            self.updated = timezone.now()
+            self.error = repr(err)
+            self.traceback = ''.join(format_exception(
+                type(err), err, err.__traceback__))
+            return False
+        return True
+
+
+class OutboxMessage(models.Model):
+    """
+    Outbound message saved in the transaction of the account changes
+    and sent later by the outbox relay (`relay_outbox` command).
+    """
+    messenger = models.ForeignKey(
+        'Messenger', models.CASCADE,
+        verbose_name=_('messenger'), related_name='outbox')
+    account = models.ForeignKey(
+        'Account', models.CASCADE,
+        verbose_name=_('account'), related_name='outbox')
+    idempotency_key = models.CharField(
+        _('idempotency key'), max_length=256,
+        unique=True, null=True, blank=True, editable=False,
+        help_text=_('Incoming update and position of the answer, '
+                    'the same answer is saved once.'))
+    payload = models.BinaryField(
+        _('payload'),
+        help_text=_('Pickled bot_engine.Message object.'))
+    status = models.CharField(
+        _('status'), max_length=16,
+        choices=OutboxStatus.choices,
+        default=OutboxStatus.PENDING)
+    attempts = models.PositiveSmallIntegerField(
+        _('attempts'),
+        default=0)
+    available_at = models.DateTimeField(
+        _('available at'),
+        default=timezone.now,
+        help_text=_('The message is not sent before this time.'))
+    error = models.TextField(
+        _('error'),
+        default='', blank=True)
+    sent_at = models.DateTimeField(
+        _('sent'),
+        null=True, blank=True)
+    created = models.DateTimeField(
+        _('created'), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _('outbox message')
+        verbose_name_plural = _('outbox messages')
+        ordering = ('id', )
+        indexes = [
+            models.Index(fields=['status', 'available_at', 'id'],
+                         name='bot_engine_outbox_pending'),
+        ]
+
+    def __str__(self):
+        return f'{self.account_id}: {self.status}'
+
+    def __repr__(self):
+        return f'<bot_engine.OutboxMessage object ({self.id})>'
+
+    @classmethod
+    def enqueue(cls, account: Account, message: Message,
+                idempotency_key: str = None) -> bool:
+        """
+        Save the prepared message to the outbox in the current transaction
+        :param account: receiver
+        :param message: bot_engine.Message object
+        :param idempotency_key: key of the answer (optional)
+        :return: False if the message can't be saved and must be sent directly
+        """
+        if account.messenger_id is None:
+            return False
+        try:
+            payload = pickle.dumps(message)
+        except (pickle.PicklingError, TypeError, AttributeError) as err:
+            # e.g. a file object opened by a handler
+            log.warning(f'Outbox; Account={account.id}; Error={err};')
+            return False
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(messenger_id=account.messenger_id,
+                                   account=account,
+                                   idempotency_key=idempotency_key,
+                                   payload=payload)
+        except IntegrityError:
+            log.info(f'Account {account.id}; Message {idempotency_key} '
+                     f'is already in the outbox.')
+        return True
+
+    @property
+    def message(self) -> Message:
+        return pickle.loads(self.payload)
+
+
+class MessageLogQuerySet(models.QuerySet):
+    def search(self, query: str) -> MessageLogQuerySet:
+        """
+        Full-text search over the message text
+        :param query: words to find
+        :return: filtered queryset
+        """
+        return search_messages(self, query)
+
+    def for_messenger(self, messenger) -> MessageLogQuerySet:
+        return self.filter(messenger_id=getattr(messenger, 'id', messenger))
+
+    def for_account(self, account) -> MessageLogQuerySet:
+        return self.filter(account_id=getattr(account, 'id', account))
+
+    def between(self, start: datetime = None,
+                end: datetime = None) -> MessageLogQuerySet:
+        """
+        Messages created in the time range, both bounds are optional
+        """
+        queryset = self
+        if start is not None:
+            queryset = queryset.filter(created__gte=start)
+        if end is not None:
+            queryset = queryset.filter(created__lt=end)
+        return queryset
+
+
+class MessageLog(models.Model):
+    """
+    Append-only history of incoming and outgoing messages,
+    saved in batches when the SAVE_MESSAGES setting is on.
+    """
+    messenger = models.ForeignKey(
+        'Messenger', models.DO_NOTHING,
+        verbose_name=_('messenger'), related_name='+',
+        null=True, blank=True, db_constraint=False)
+    account = models.ForeignKey(
+        'Account', models.DO_NOTHING,
+        verbose_name=_('account'), related_name='+',
+        null=True, blank=True, db_constraint=False)
+    direction = models.CharField(
+        _('direction'), max_length=3,
+        choices=MessageDirection.choices)
+    message_type = models.CharField(
+        _('message type'), max_length=32)
+    message_id = models.CharField(
+        _('message id'), max_length=256,
+        null=True, blank=True)
+    text = models.TextField(
+        _('text'),
+        default='', blank=True)
+    payload = models.JSONField(
+        _('payload'),
+        default=dict, blank=True)
+    created = models.DateTimeField(
+        _('created'), default=timezone.now)
+
+    objects = MessageLogQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = _('message log')
+        verbose_name_plural = _('message log')
+        ordering = ('-created', '-id')
+        indexes = [
+            # account timeline, newest first
+            models.Index(fields=['account', '-created', '-id'],
+                         name='bot_engine_log_account'),
+            models.Index(fields=['messenger', '-created'],
+                         name='bot_engine_log_messenger'),
+            models.Index(fields=['created'],
+                         name='bot_engine_log_created'),
+        ]
+
+    def __str__(self):
+        return f'{self.account_id} {self.direction}: {self.text[:64]}'
+
+    def __repr__(self):
+        return f'<bot_engine.MessageLog object ({self.id})>'
+
+
+class InteractionStats(models.Model):
+    """
+    Menu and button usage in a time bucket, merged from the in-process
+    counters of all workers.
+    """
+    kind = models.CharField(
+        _('kind'), max_length=8,
+        choices=StatsKind.choices)
+    object_id = models.PositiveIntegerField(
+        _('menu or button id'))
+    bucket = models.DateTimeField(
+        _('period start'))
+    clicks = models.PositiveIntegerField(
+        _('clicks'),
+        default=0)
+    unique_accounts = models.PositiveIntegerField(
+        _('unique accounts'),
+        default=0,
+        help_text=_('Estimated by the sketch.'))
+    errors = models.PositiveIntegerField(
+        _('handler errors'),
+        default=0)
+    sketch = models.BinaryField(
+        _('sketch'),
+        help_text=_('HyperLogLog registers of account ids.'))
+
+    class Meta:
+        verbose_name = _('interaction stats')
+        verbose_name_plural = _('interaction stats')
+        ordering = ('-bucket', )
+        unique_together = ('kind', 'object_id', 'bucket')
+
+    def __str__(self):
+        return f'{self.kind} {self.object_id}: {self.bucket}'
+
+    def __repr__(self):
+        return f'<bot_engine.InteractionStats object ({self.id})>'
+
+
+class Segment(models.Model):
+    """
+    Named audience of accounts, materialized into the membership table.
+    Empty conditions match all accounts. A segment without the refresh
+    time is dirty: it waits for a rebuild by `refresh_segments`.
+    """
+    title = models.CharField(
+        _('title'), max_length=256, unique=True)
+    messenger = models.ForeignKey(
+        'Messenger', models.SET_NULL,
+        verbose_name=_('messenger'), related_name='segments',
+        null=True, blank=True)
+    menu = models.ForeignKey(
+        'Menu', models.SET_NULL,
+        verbose_name=_('current menu'), related_name='segments',
+        null=True, blank=True)
+    utm_source = models.CharField(
+        _('utm source'), max_length=256,
+        default='', blank=True)
+    is_active = models.BooleanField(
+        _('active'),
+        null=True, blank=True,
+        help_text=_('Subscribed or unsubscribed accounts, '
+                    'leave empty for both.'))
+    seen_days = models.PositiveIntegerField(
+        _('seen in days'),
+        null=True, blank=True,
+        help_text=_('Accounts with the last visit in this number of days.'))
+    size = models.PositiveIntegerField(
+        _('size'),
+        default=0, editable=False)
+    refreshed_at = models.DateTimeField(
+        _('refreshed'),
+        null=True, blank=True, editable=False)
+    updated = models.DateTimeField(
+        _('updated'), auto_now=True)
+    created = models.DateTimeField(
+        _('created'), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _('segment')
+        verbose_name_plural = _('segments')
+
+    def __str__(self):
+        return self.title
+
+    def __repr__(self):
+        return f'<bot_engine.Segment object ({self.id})>'
+
+    def matching_accounts(self) -> models.QuerySet:
+        """
+        Accounts matching the definition, an ad-hoc query
+        """
+        queryset = Account.objects.all()
+        if self.messenger_id:
+            queryset = queryset.filter(messenger_id=self.messenger_id)
+        if self.menu_id:
+            queryset = queryset.filter(menu_id=self.menu_id)
+        if self.utm_source:
+            queryset = queryset.filter(utm_source=self.utm_source)
+        if self.is_active is not None:
+            queryset = queryset.filter(is_active=self.is_active)
+        if self.seen_days is not None:
+            queryset = queryset.filter(
+                updated__gte=timezone.now() - timedelta(days=self.seen_days))
+        return queryset
+
+    def accounts(self) -> models.QuerySet:
+        """
+        Members of the materialized segment
+        """
+        return Account.objects.filter(segment_memberships__segment=self)
+
+    def iter_accounts(self, batch_size: int = 500) -> Iterator[List[Account]]:
+        """
+        Members in keyset batches, e.g. for a broadcast
+        :param batch_size: number of accounts in a batch
+        :return: iterator over lists of accounts
+        """
+        return self.accounts().batches(batch_size)
+
+    def refresh(self, batch_size: int = 5000) -> int:
+        """
+        Rebuild the membership from the definition. Only the difference
+        is written: missing members are added and stale ones removed.
+        :param batch_size: number of rows inserted or deleted at once
+        :return: segment size
+        """
+        memberships = SegmentMembership.objects.filter(segment=self)
+        matching = self.matching_accounts()
+        stale = memberships.exclude(account__in=matching.values('id'))
+        while True:
+            ids = list(stale.values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            SegmentMembership.objects.filter(id__in=ids).delete()
+
+        missing = matching.exclude(
+            id__in=memberships.values('account_id')).only('id')
+        for batch in keyset_batches(missing, batch_size):
+            SegmentMembership.objects.bulk_create(
+                [SegmentMembership(segment=self, account=account)
+                 for account in batch],
+                ignore_conflicts=True)
+
+        self.size = memberships.count()
+        self.refreshed_at = timezone.now()
+        Segment.objects.filter(id=self.id).update(
+            size=self.size, refreshed_at=self.refreshed_at)
+        return self.size
+
+
+class SegmentMembership(models.Model):
+    segment = models.ForeignKey(
+        'Segment', models.CASCADE,
+        verbose_name=_('segment'), related_name='memberships')
+    account = models.ForeignKey(
+        'Account', models.CASCADE,
+        verbose_name=_('account'), related_name='segment_memberships')
+    created = models.DateTimeField(
+        _('created'), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _('segment membership')
+        verbose_name_plural = _('segment memberships')
+        # the unique index also serves keyset iteration of a segment
+        unique_together = ('segment', 'account')
+
+    def __str__(self):
+        return f'{self.segment_id}: {self.account_id}'
+
+    def __repr__(self):
+        return f'<bot_engine.SegmentMembership object ({self.id})>'
@@ -0,0 +1,210 @@
+import logging
+import time
+from datetime import timedelta
+from typing import List, Optional, Tuple
+
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .delivery import retry_call
+from .errors import (
+    CircuitOpen, MessengerException, MessengerTimeout, NotSubscribed,
+    RequestsLimitExceeded
+)
+from .message_log import message_log
+from .settings import bot_api_settings
+
+
+log = logging.getLogger(__name__)
+
+
+class OutboxRelay:
+    """
+    Sends messages saved to the outbox in batches. A batch is claimed
+    in a short transaction (rows locked by another relay are skipped),
+    so several relays can drain the same outbox. Every message is leased
+    for the longest send of one message and its lease is extended right
+    before the send, so messages of a crashed relay are available again
+    soon. A message is saved right after its send and only while
+    the lease is still ours.
+    """
+
+    def __init__(self, batch_size: int = None, max_attempts: int = None,
+                 retry_delay: int = None, lease: int = None):
+        self.batch_size = (batch_size or bot_api_settings.OUTBOX_BATCH_SIZE)
+        self.max_attempts = (max_attempts or
+                             bot_api_settings.OUTBOX_MAX_ATTEMPTS)
+        self.retry_delay = (retry_delay if retry_delay is not None
+                            else bot_api_settings.OUTBOX_RETRY_DELAY)
+        self.lease = lease or self.send_time()
+        self._messengers = {}
+
+    @staticmethod
+    def send_time() -> float:
+        """
+        Longest send of a message: all attempts time out in the bulkhead
+        and the longest delays are waited between them
+        :return: seconds
+        """
+        attempts = bot_api_settings.SEND_RETRY_ATTEMPTS
+        return (attempts * bot_api_settings.BULKHEAD_TIMEOUT +
+                (attempts - 1) * bot_api_settings.SEND_RETRY_MAX_DELAY)
+
+    def claim(self) -> List:
+        """
+        Take pending messages for the lease time
+        :return: list of bot_engine.OutboxMessage objects
+        """
+        from .models import OutboxMessage, OutboxStatus
+
+        now = timezone.now()
+        until = now + timedelta(seconds=self.lease)
+        with transaction.atomic():
+            batch = list(OutboxMessage.objects
+                         .select_for_update(skip_locked=True)
+                         .filter(status=OutboxStatus.PENDING,
+                                 available_at__lte=now)
+                         .order_by('id')[:self.batch_size])
+            OutboxMessage.objects.filter(
+                id__in=[item.id for item in batch]
+            ).update(available_at=until)
+        for item in batch:
+            # the lease end identifies the claim of this relay
+            item.available_at = item.leased_until = until
+        return batch
+
+    def extend(self, item) -> bool:
+        """
+        Extend the lease of the claimed message for one send
+        :param item: bot_engine.OutboxMessage object
+        :return: False if the lease is taken over by another relay
+        """
+        from .models import OutboxMessage, OutboxStatus
+
+        until = timezone.now() + timedelta(seconds=self.lease)
+        extended = OutboxMessage.objects.filter(
+            id=item.id, status=OutboxStatus.PENDING,
+            available_at=item.leased_until
+        ).update(available_at=until)
+        if extended:
+            item.available_at = item.leased_until = until
+        return bool(extended)
+
+    def drain(self) -> Tuple[int, int]:
+        """
+        Send one batch of pending messages
+        :return: numbers of sent and failed messages
+        """
+        from .models import Messenger
+
+        batch = self.claim()
+        if not batch:
+            return 0, 0
+
+        # one connector per messenger for all batches
+        missing = {item.messenger_id for item in batch} - set(self._messengers)
+        self._messengers.update(Messenger.objects.in_bulk(missing))
+
+        sent = failed = 0
+        for item in batch:
+            result = self.send(item)
+            if result is None:
+                log.warning(f'Outbox; Message={item.id}; Lease is lost;')
+            elif result:
+                sent += 1
+            else:
+                failed += 1
+        return sent, failed
+
+    def send(self, item) -> Optional[bool]:
+        """
+        Send the claimed message and save its status
+        :param item: bot_engine.OutboxMessage object
+        :return: True if it is sent, False if it is failed,
+            None if its lease is taken over by another relay
+        """
+        from .models import Account, OutboxMessage, OutboxStatus
+
+        if not self.extend(item):
+            return None
+
+        messenger = self._messengers[item.messenger_id]
+        item.attempts += 1
+        try:
+            retry_call(messenger.call_api, 'send_message',
+                       item.account_id, item.message)
+        except NotSubscribed as err:
+            Account.objects.filter(id=item.account_id).update(is_active=False)
+            self._fail(item, err, final=True)
+        except MessengerTimeout as err:
+            # the message may be delivered, it is not sent again
+            self._fail(item, err, final=True)
+        except (CircuitOpen, MessengerException,
+                RequestsLimitExceeded) as err:
+            self._fail(item, err)
+        except Exception as err:
+            log.exception(f'Outbox; Message={item.id}; Error={err};')
+            self._fail(item, err)
+        else:
+            if bot_api_settings.SAVE_MESSAGES:
+                message_log.log_outgoing(item.messenger_id,
+                                         item.account_id, item.message)
+            item.status = OutboxStatus.SENT
+            item.sent_at = timezone.now()
+            item.error = ''
+
+        # a relay that has taken over the lease owns the message now
+        saved = OutboxMessage.objects.filter(
+            id=item.id, available_at=item.leased_until
+        ).update(status=item.status, attempts=item.attempts,
+                 available_at=item.available_at, error=item.error,
+                 sent_at=item.sent_at)
+        if not saved:
+            return None
+        return item.status == OutboxStatus.SENT
+
+    def purge(self, ttl: int = None) -> int:
+        """
+        Delete sent messages older than TTL, their keys are not needed
+        to deduplicate answers anymore
+        :param ttl: seconds, SEND_DEDUP_TTL by default
+        :return: number of deleted messages
+        """
+        from .models import OutboxMessage, OutboxStatus
+
+        ttl = ttl if ttl is not None else bot_api_settings.SEND_DEDUP_TTL
+        border = timezone.now() - timedelta(seconds=ttl)
+        deleted, _ = OutboxMessage.objects.filter(
+            status=OutboxStatus.SENT, sent_at__lt=border).delete()
+        return deleted
+
+    def run(self, interval: float = 1.0, once: bool = False):
+        """
+        Drain the outbox until it is empty, then poll it
+        :param interval: seconds between polls of an empty outbox
+        :param once: stop when the outbox is empty
+        :return: None
+        """
+        while True:
+            close_old_connections()
+            sent, failed = self.drain()
+            if sent or failed:
+                log.info(f'Outbox; Sent={sent}; Failed={failed};')
+                continue
+            if once:
+                return
+            self.purge()
+            time.sleep(interval)
+
+    def _fail(self, item, error: Exception, final: bool = False):
+        from .models import OutboxStatus
+
+        item.error = repr(error)
+        if final or item.attempts >= self.max_attempts:
+            item.status = OutboxStatus.FAILED
+            log.warning(f'Outbox; Message={item.id}; Gave up; Error={error};')
+            return
+        delay = self.retry_delay * 2 ** (item.attempts - 1)
+        retry_after = getattr(error, 'retry_after', None)
+        item.available_at = timezone.now() + timedelta(
+            seconds=max(delay, retry_after or 0))
@@ -0,0 +1,231 @@
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .errors import ConcurrentUpdate
+from .settings import bot_api_settings
+from .throttling import RateLimiter
+from .utils import keyset_batches
+
+
+log = logging.getLogger(__name__)
+
+
+class ProfileUpdater:
+    """
+    Background queue of account profile updates.
+    Every account is queued at most once, requests to a messenger API
+    are rate limited and a failed update is retried with a backoff.
+    Failures of accounts that are not queued again within the maximum
+    delay are forgotten.
+    """
+
+    def __init__(self, rate: float = None, retry_delay: int = None,
+                 max_delay: int = None):
+        self.limiter = RateLimiter(
+            rate if rate is not None
+            else bot_api_settings.PROFILE_UPDATE_RATE_LIMIT)
+        self.retry_delay = (retry_delay if retry_delay is not None
+                            else bot_api_settings.PROFILE_UPDATE_RETRY_DELAY)
+        self.max_delay = (max_delay if max_delay is not None
+                          else bot_api_settings.PROFILE_UPDATE_MAX_DELAY)
+
+        self._queue: List[Tuple[float, str, Optional[int]]] = []
+        self._queued = set()
+        self._failures: Dict[str, int] = {}
+        self._not_before: Dict[str, float] = {}
+        self._pruned_at = 0.0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def enqueue(self, account) -> bool:
+        """
+        Queue the profile update of the account.
+        :param account: bot_engine.Account object
+        :return: True if the account is queued
+        """
+        now = time.monotonic()
+        with self._condition:
+            if account.id in self._queued:
+                return False
+            if self._not_before.get(account.id, 0) > now:
+                return False
+            self._push(account.id, account.messenger_id, now)
+            self._start()
+        return True
+
+    def process(self, account_id: str) -> bool:
+        """
+        Update the profile of the account.
+        :param account_id: account id
+        :return: True if the profile is updated
+        """
+        from .models import Account
+
+        try:
+            account = Account.objects.select_related('messenger').get(
+                id=account_id)
+        except Account.DoesNotExist:
+            return True
+        return account.update_info()
+
+    def _push(self, account_id: str, messenger_id: Optional[int],
+              due: float):
+        heapq.heappush(self._queue, (due, account_id, messenger_id))
+        self._queued.add(account_id)
+        self._condition.notify()
+
+    def _prune(self, now: float):
+        # an account not queued since its retry time has passed
+        # by the maximum delay doesn't need its backoff anymore
+        if now - self._pruned_at < self.retry_delay:
+            return
+        self._pruned_at = now
+        border = now - self.max_delay
+        for account_id, not_before in list(self._not_before.items()):
+            if not_before < border and account_id not in self._queued:
+                del self._not_before[account_id]
+                self._failures.pop(account_id, None)
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name='bot-engine-profiles', daemon=True)
+            self._thread.start()
+
+    def _next(self) -> Tuple[str, Optional[int]]:
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if self._queue and self._queue[0][0] <= now:
+                    due, account_id, messenger_id = heapq.heappop(self._queue)
+                    wait = self.limiter.delay(messenger_id)
+                    if wait <= 0:
+                        return account_id, messenger_id
+                    heapq.heappush(self._queue,
+                                   (now + wait, account_id, messenger_id))
+                    continue
+                timeout = self._queue[0][0] - now if self._queue else None
+                self._condition.wait(timeout)
+
+    def _run(self):
+        while True:
+            account_id, messenger_id = self._next()
+            close_old_connections()
+            try:
+                updated = self.process(account_id)
+            except Exception as err:
+                log.exception(f'Profile update; Account={account_id}; '
+                              f'Error={err};')
+                updated = False
+            finally:
+                close_old_connections()
+
+            with self._condition:
+                self._queued.discard(account_id)
+                if updated:
+                    self._failures.pop(account_id, None)
+                    self._not_before.pop(account_id, None)
+                    continue
+                failures = self._failures.get(account_id, 0) + 1
+                self._failures[account_id] = failures
+                delay = min(self.retry_delay * 2 ** (failures - 1),
+                            self.max_delay)
+                now = time.monotonic()
+                self._not_before[account_id] = now + delay
+                self._prune(now)
+                log.warning(f'Profile update failed; Account={account_id}; '
+                            f'Attempt={failures}; Retry in {delay}s;')
+
+
+profile_updater = ProfileUpdater()
+
+
+def stale_accounts(ttl: int, batch_size: int = 500,
+                   messengers: Iterable[int] = None) -> Iterator[list]:
+    """
+    Accounts whose profile is older than TTL, in keyset batches.
+    :param ttl: profile lifetime in seconds
+    :param batch_size: number of accounts in a batch
+    :param messengers: messenger ids (optional)
+    :return: iterator over lists of accounts
+    """
+    from .models import Account
+
+    border = timezone.now() - timedelta(seconds=ttl)
+    queryset = (Account.bulk
+                .filter(messenger__isnull=False)
+                .filter(Q(info_refreshed_at__isnull=True) |
+                        Q(info_refreshed_at__lt=border))
+                .only('id', 'username', 'avatar_url', 'info_refreshed_at',
+                      'messenger_id', 'version'))
+    if messengers:
+        queryset = queryset.filter(messenger_id__in=list(messengers))
+
+    return keyset_batches(queryset, batch_size)
+
+
+def refresh_profiles(accounts: List, workers: int = 4,
+                     limiter: RateLimiter = None) -> int:
+    """
+    Refresh profiles of the accounts concurrently, save the accounts
+    with compare-and-swap updates and the profiles with a bulk update.
+    :param accounts: list of bot_engine.Account objects
+    :param workers: number of concurrent API requests
+    :param limiter: rate limiter shared with the profile updater
+    :return: number of refreshed accounts
+    """
+    from .models import AccountProfile, Messenger
+
+    limiter = limiter or profile_updater.limiter
+    # one connector per messenger instead of one per account
+    messenger_ids = {account.messenger_id for account in accounts}
+    messengers = Messenger.objects.in_bulk(messenger_ids)
+    for messenger in list(messengers.values()):
+        try:
+            messenger.api  # connectors are created before the threads start
+        except Exception as err:
+            log.exception(f'Profile refresh; Messenger={messenger.id}; '
+                          f'Error={err};')
+            del messengers[messenger.id]
+    for account in accounts:
+        account.messenger = messengers.get(account.messenger_id)
+
+    def fetch(account) -> bool:
+        if account.messenger is None:
+            return False
+        limiter.acquire(account.messenger_id)
+        try:
+            return account.fetch_info()
+        except Exception as err:
+            log.exception(f'Profile refresh; Account={account.id}; '
+                          f'Error={err};')
+            return False
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(fetch, accounts))
+
+    refreshed = []
+    with transaction.atomic():
+        for account, ok in zip(accounts, results):
+            if not ok:
+                continue
+            try:
+                account.update(username=account.username,
+                               avatar_url=account.avatar_url,
+                               info_refreshed_at=account.info_refreshed_at)
+            except ConcurrentUpdate as err:
+                # the account stays stale and is refreshed next time
+                log.info(f'Profile refresh; Account={account.id}; {err}')
+                continue
+            refreshed.append(account)
+        AccountProfile.save_many(refreshed)
+    return len(refreshed)
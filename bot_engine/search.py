@@ -0,0 +1,65 @@
+import logging
+
+from django.db import connections
+from django.db.models import BooleanField, Q, QuerySet
+from django.db.models.expressions import RawSQL
+
+
+log = logging.getLogger(__name__)
+
+# created by the 0009_messagelog_search migration
+SEARCH_CONFIG = 'simple'
+FTS_TABLE = 'bot_engine_messagelog_fts'
+
+_fts_tables = {}
+
+
+def has_fts_table(alias: str) -> bool:
+    """
+    SQLite may be built without FTS5, then the index is not created
+    """
+    if alias not in _fts_tables:
+        with connections[alias].cursor() as cursor:
+            tables = connections[alias].introspection.table_names(cursor)
+        _fts_tables[alias] = FTS_TABLE in tables
+    return _fts_tables[alias]
+
+
+def fts5_query(query: str) -> str:
+    """
+    Quote the words, so the user input is not parsed as FTS5 syntax
+    """
+    words = (word.replace('"', '""') for word in query.split())
+    return ' '.join(f'"{word}"' for word in words)
+
+
+def search_messages(queryset: QuerySet, query: str) -> QuerySet:
+    """
+    Filter the message log by words of the text using the full-text index
+    of the database: PostgreSQL tsvector with a GIN index, SQLite FTS5.
+    Other databases fall back to a LIKE scan.
+    :param queryset: queryset of bot_engine.MessageLog
+    :param query: words to find
+    :return: filtered queryset
+    """
+    query = (query or '').strip()
+    if not query:
+        return queryset
+
+    table = queryset.model._meta.db_table
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        # the expression matches the index one to use it
+        return queryset.filter(RawSQL(
+            f"to_tsvector('{SEARCH_CONFIG}', \"{table}\".\"text\") "
+            f"@@ plainto_tsquery('{SEARCH_CONFIG}', %s)",
+            (query, ), output_field=BooleanField()))
+    if connection.vendor == 'sqlite' and has_fts_table(queryset.db):
+        return queryset.filter(id__in=RawSQL(
+            f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s',
+            (fts5_query(query), )))
+
+    condition = Q()
+    for word in query.split():
+        condition &= Q(text__icontains=word)
+    return queryset.filter(condition)
@@ -0,0 +1,113 @@
+import atexit
+import logging
+import threading
+import time
+from typing import Iterable
+
+from django.db import close_old_connections, transaction
+from django.dispatch import receiver
+
+from .settings import bot_api_settings
+from .signals import account_updated
+
+
+log = logging.getLogger(__name__)
+
+
+def update_membership(segment, account_ids: Iterable[str]) -> int:
+    """
+    Add or remove the accounts from the materialized segment
+    according to its definition
+    :param segment: bot_engine.Segment object
+    :param account_ids: ids of changed accounts
+    :return: segment size
+    """
+    from .models import SegmentMembership
+
+    account_ids = set(account_ids)
+    matching = set(segment.matching_accounts()
+                   .filter(id__in=account_ids)
+                   .values_list('id', flat=True))
+    memberships = SegmentMembership.objects.filter(segment=segment)
+    members = set(memberships.filter(account_id__in=account_ids)
+                  .values_list('account_id', flat=True))
+    added, removed = matching - members, members - matching
+    if not added and not removed:
+        return segment.size
+
+    segments = type(segment).objects.filter(id=segment.id)
+    with transaction.atomic():
+        # writers of the segment are serialized, the size is counted
+        # because rows may be skipped as written by another process
+        segments.select_for_update().values_list('id').first()
+        memberships.filter(account_id__in=removed).delete()
+        SegmentMembership.objects.bulk_create(
+            [SegmentMembership(segment=segment, account_id=account_id)
+             for account_id in added],
+            ignore_conflicts=True)
+        segment.size = memberships.count()
+        segments.update(size=segment.size)
+    return segment.size
+
+
+class SegmentRefresher:
+    """
+    Incremental refresh of segments: ids of saved accounts are collected
+    in memory and matched against all segment definitions periodically,
+    one query per segment for the whole batch.
+    """
+
+    def __init__(self, flush_interval: float = None):
+        self.flush_interval = (flush_interval or
+                               bot_api_settings.SEGMENTS_FLUSH_INTERVAL)
+        self._account_ids = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def mark(self, account_id: str):
+        with self._lock:
+            self._account_ids.add(account_id)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='bot-engine-segments', daemon=True)
+                self._thread.start()
+
+    def flush(self) -> int:
+        """
+        Refresh membership of the changed accounts
+        :return: number of checked accounts
+        """
+        from .models import Segment
+
+        with self._lock:
+            account_ids, self._account_ids = self._account_ids, set()
+        if not account_ids:
+            return 0
+
+        for segment in Segment.objects.all():
+            try:
+                update_membership(segment, account_ids)
+            except Exception as err:
+                log.exception(f'Segments; Segment={segment.id}; Error={err};')
+        return len(account_ids)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            close_old_connections()
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+
+segment_refresher = SegmentRefresher()
+atexit.register(segment_refresher.flush)
+
+
+@receiver(account_updated)
+def account_saved(sender, instance, **kwargs):
+    # other queryset updates don't send signals, the refresh_segments
+    # command catches them up
+    if bot_api_settings.SEGMENTS_INCREMENTAL:
+        segment_refresher.mark(instance.id)
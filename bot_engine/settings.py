@@ -1,21 +1,14 @@
 """
-Settings for REST framework are all namespaced in the REST_FRAMEWORK setting.
+Settings for Bot engine are all namespaced in the BOT_ENGINE setting.
 For example your project's `settings.py` file might look like this:
 
-REST_FRAMEWORK = {
-    'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
-        'rest_framework.renderers.TemplateHTMLRenderer',
-    ],
-    'DEFAULT_PARSER_CLASSES': [
-        'rest_framework.parsers.JSONParser',
-        'rest_framework.parsers.FormParser',
-        'rest_framework.parsers.MultiPartParser',
-    ],
+BOT_ENGINE = {
+    'PROFILE_UPDATE_DEFERRED': True,
+    'PROFILE_UPDATE_RATE_LIMIT': 5,
 }
 
-This module provides the `api_setting` object, that is used to access
-REST framework settings, checking for user settings first, then falling
+This module provides the `bot_api_settings` object, that is used to access
+Bot engine settings, checking for user settings first, then falling
 back to the defaults.
 """
 from django.conf import settings
@@ -30,8 +23,73 @@ DEFAULTS = {
     'BUTTON_PREFIX': 'BTN_',
     'MENU_ITEM_PREFIX': 'MI_BTN_',
     'SAVE_MESSAGES': True,
+    # storage of Account.state: Database, Cache or MemoryContextStore
+    'CONTEXT_STORE': 'bot_engine.context.DatabaseContextStore',
+    'CONTEXT_CACHE_ALIAS': 'default',
+    'CONTEXT_CACHE_TIMEOUT': None,  # seconds, None to keep keys forever
+    'MESSAGE_LOG_BATCH_SIZE': 500,  # records saved with one insert
+    'MESSAGE_LOG_FLUSH_INTERVAL': 2,  # seconds
+    'MESSAGE_LOG_MAX_BUFFER': 50000,  # older records are dropped
+    'MESSAGE_LOG_RETENTION_DAYS': None,  # None to keep the history forever
+    # storage class or object of archives, None for the default storage
+    'MESSAGE_LOG_ARCHIVE_STORAGE': None,
+    'MESSAGE_LOG_ARCHIVE_PATH': 'bot_engine/message_log',
     'BOT_API_CLIENT_MODEL': '',
 
+    # Account profiles
+    'PROFILE_UPDATE_DEFERRED': True,
+    'PROFILE_UPDATE_RATE_LIMIT': 10,  # requests per second for a messenger
+    'PROFILE_UPDATE_RETRY_DELAY': 60,  # seconds, doubled on each failure
+    'PROFILE_UPDATE_MAX_DELAY': 3600,
+    'PROFILE_TTL': 7 * 24 * 3600,  # seconds
+    'PROBE_RATE_LIMIT': 20,  # probe requests per second for a messenger
+
+    # Dispatch
+    'STALE_WORKERS': 1,  # workers of deferred stale messages
+    'DISPATCH_LANES': False,  # process webhook messages in priority lanes
+    'LANE_WORKERS': {
+        'interactive': 4,  # buttons and commands
+        'text': 2,
+        'media': 1,
+        'events': 1,
+    },
+    # handler time budget in seconds, None to wait for handlers
+    'HANDLER_TIME_BUDGET': None,
+    'HANDLER_OFFLOAD_AFTER': 3,  # overruns before moving to the background
+    'HANDLER_WORKERS': 16,
+    'HANDLER_BACKGROUND_WORKERS': 2,
+    # outbound API calls of each messenger
+    'BULKHEAD_MAX_CONCURRENT': 8,
+    'BULKHEAD_MAX_QUEUE': 100,
+    'BULKHEAD_TIMEOUT': 30,  # seconds
+    'CIRCUIT_FAILURE_THRESHOLD': 5,  # failures in a row to open the circuit
+    'CIRCUIT_RESET_TIMEOUT': 30,  # seconds before a trial call
+    # outbound message retries and deduplication
+    'SEND_RETRY_ATTEMPTS': 3,
+    'SEND_RETRY_BASE_DELAY': 0.5,  # seconds, doubled on each attempt
+    'SEND_RETRY_MAX_DELAY': 10,  # longer retry_after is not waited
+    # the same limit for sends in the dispatch, which hold a worker
+    'SEND_RETRY_DISPATCH_MAX_DELAY': 1,
+    'SEND_DEDUP_TTL': 24 * 3600,  # seconds
+    # save answers to the outbox, they are sent by the relay_outbox command
+    'OUTBOX_ENABLED': False,
+    'OUTBOX_BATCH_SIZE': 100,
+    'OUTBOX_MAX_ATTEMPTS': 5,
+    'OUTBOX_RETRY_DELAY': 30,  # seconds, doubled on each failure
+    # menu and button usage counters
+    'STATS_ENABLED': True,
+    'STATS_FLUSH_INTERVAL': 60,  # seconds
+    'STATS_BUCKET_SIZE': 3600,  # seconds
+    # compare-and-swap updates of accounts
+    'ACCOUNT_CONFLICT_RETRIES': 3,
+    # audience segments
+    'SEGMENTS_INCREMENTAL': True,  # refresh segments of saved accounts
+    'SEGMENTS_FLUSH_INTERVAL': 10,  # seconds
+    # webhook backpressure, None to disable a limit
+    'WEBHOOK_MAX_IN_FLIGHT': None,  # dispatches processed right now
+    'WEBHOOK_MAX_QUEUE_DEPTH': None,  # messages waiting in lanes
+    'WEBHOOK_RETRY_AFTER': 5,  # seconds
+
     # REST Framework examples
     # Base API policies
     'DEFAULT_RENDERER_CLASSES': [
@@ -52,6 +110,8 @@ DEFAULTS = {
 IMPORT_STRINGS = [
     # Bot API
     'DEFAULT_BOT',
+    'CONTEXT_STORE',
+    'MESSAGE_LOG_ARCHIVE_STORAGE',
     # REST Framework examples
     'DEFAULT_RENDERER_CLASSES',
     'DEFAULT_SCHEMA_CLASS',
@@ -90,8 +150,8 @@ class APISettings:
     A settings object, that allows API settings to be accessed as properties.
     For example:
 
-        from rest_framework.settings import api_settings
-        print(api_settings.DEFAULT_RENDERER_CLASSES)
+        from bot_engine.settings import bot_api_settings
+        print(bot_api_settings.DEFAULT_BOT)
 
     Any setting with string import paths will be automatically resolved
     and return the class, rather than the string literal.
@@ -106,7 +166,7 @@ class APISettings:
     @property
     def user_settings(self):
         if not hasattr(self, '_user_settings'):
-            self._user_settings = getattr(settings, 'REST_FRAMEWORK', {})
+            self._user_settings = getattr(settings, 'BOT_ENGINE', {})
         return self._user_settings
 
     def __getattr__(self, attr):
@@ -0,0 +1,6 @@
+from django.dispatch import Signal
+
+
+# sent by Account.save() and Account.update() and for accounts changed
+# in bulk, with arguments: instance, created, update_fields
+account_updated = Signal()
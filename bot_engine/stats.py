@@ -0,0 +1,205 @@
+import atexit
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from hashlib import blake2b
+from typing import Dict, Hashable, Iterable, Tuple
+
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .settings import bot_api_settings
+from .utils import normalize_datetime
+
+
+log = logging.getLogger(__name__)
+
+
+class HyperLogLog:
+    """
+    Sketch that estimates the number of unique values in a fixed
+    memory (1 KB with the default precision, about 3% error).
+    Sketches are merged by a maximum of registers.
+    """
+
+    def __init__(self, registers: bytes = None, precision: int = 10):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers or self.size)
+
+    def add(self, value: Hashable):
+        digest = blake2b(str(value).encode('utf-8'), digest_size=8).digest()
+        hashed = int.from_bytes(digest, 'big')
+        bits = 64 - self.precision
+        index = hashed >> bits
+        rank = bits - (hashed & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: 'HyperLogLog'):
+        self.registers = bytearray(
+            max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def count(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size ** 2 / sum(
+            2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.size and zeros:
+            # small range correction
+            estimate = self.size * math.log(self.size / zeros)
+        return int(round(estimate))
+
+    def __bytes__(self) -> bytes:
+        return bytes(self.registers)
+
+
+class InteractionCounter:
+    """
+    Write-behind counters of menu and button usage. Clicks, unique
+    accounts and handler errors are counted in memory and periodically
+    merged into time buckets of the InteractionStats table.
+    """
+
+    def __init__(self, flush_interval: float = None, bucket_size: int = None):
+        self.flush_interval = (flush_interval or
+                               bot_api_settings.STATS_FLUSH_INTERVAL)
+        self.bucket_size = bucket_size or bot_api_settings.STATS_BUCKET_SIZE
+
+        self._counters: Dict[Tuple[str, int, datetime], list] = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def click(self, kind: str, object_id: int, account_id: str = None):
+        """
+        Count a click of the menu or button
+        :param kind: StatsKind value
+        :param object_id: menu or button id
+        :param account_id: clicking account (optional)
+        :return: None
+        """
+        with self._lock:
+            counter = self._counter(kind, object_id)
+            counter[0] += 1
+            if account_id is not None:
+                counter[2].add(account_id)
+        self._start()
+
+    def error(self, kind: str, object_id: int):
+        with self._lock:
+            self._counter(kind, object_id)[1] += 1
+        self._start()
+
+    def flush(self) -> int:
+        """
+        Merge the counters into the stats table
+        :return: number of saved rows
+        """
+        with self._lock:
+            counters, self._counters = self._counters, {}
+        if not counters:
+            return 0
+
+        try:
+            try:
+                return self._save(counters)
+            except IntegrityError:
+                # another process has created some of the rows
+                return self._save(counters)
+        except Exception as err:
+            log.exception(f'Stats; Rows={len(counters)}; Error={err};')
+            return 0
+
+    def _counter(self, kind: str, object_id: int) -> list:
+        timestamp = timezone.now().timestamp()
+        bucket = normalize_datetime(datetime.fromtimestamp(
+            timestamp - timestamp % self.bucket_size, dt_timezone.utc))
+        key = (kind, object_id, bucket)
+        if key not in self._counters:
+            self._counters[key] = [0, 0, HyperLogLog()]
+        return self._counters[key]
+
+    @staticmethod
+    def _save(counters: dict) -> int:
+        from .models import InteractionStats
+
+        keys = Q()
+        for kind, object_id, bucket in counters:
+            keys |= Q(kind=kind, object_id=object_id, bucket=bucket)
+
+        with transaction.atomic():
+            existing = {
+                (row.kind, row.object_id, row.bucket): row
+                for row in InteractionStats.objects.select_for_update()
+                                                   .filter(keys)
+            }
+            created = []
+            for key, (clicks, errors, sketch) in counters.items():
+                row = existing.get(key)
+                if row is None:
+                    row = InteractionStats(kind=key[0], object_id=key[1],
+                                           bucket=key[2], sketch=b'')
+                    created.append(row)
+                row.clicks += clicks
+                row.errors += errors
+                if row.sketch:
+                    sketch.merge(HyperLogLog(bytes(row.sketch)))
+                row.sketch = bytes(sketch)
+                row.unique_accounts = sketch.count()
+
+            InteractionStats.objects.bulk_update(
+                existing.values(),
+                ['clicks', 'errors', 'sketch', 'unique_accounts'])
+            InteractionStats.objects.bulk_create(created)
+        return len(counters)
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(
+                        target=self._run, name='bot-engine-stats',
+                        daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            close_old_connections()
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+
+interaction_counter = InteractionCounter()
+atexit.register(interaction_counter.flush)
+
+
+def usage_summary(kind: str, object_ids: Iterable[int],
+                  days: int = 7) -> Dict[int, dict]:
+    """
+    Clicks, unique accounts and handler errors for the last days
+    :param kind: StatsKind value
+    :param object_ids: menu or button ids
+    :param days: period
+    :return: summary by object id
+    """
+    from .models import InteractionStats
+
+    since = timezone.now() - timedelta(days=days)
+    summary = {}
+    for row in InteractionStats.objects.filter(
+            kind=kind, object_id__in=list(object_ids), bucket__gte=since):
+        item = summary.setdefault(row.object_id, {
+            'clicks': 0, 'errors': 0, 'sketch': HyperLogLog()})
+        item['clicks'] += row.clicks
+        item['errors'] += row.errors
+        item['sketch'].merge(HyperLogLog(bytes(row.sketch)))
+
+    for item in summary.values():
+        item['unique_accounts'] = item.pop('sketch').count()
+    return summary
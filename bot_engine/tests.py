@@ -0,0 +1,433 @@
+import asyncio
+import copy
+import gzip
+import json
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from telebot import apihelper
+
+from .aio import run_coroutine
+from .budgets import handler_budget
+from .bulkheads import Bulkhead, CircuitBreaker
+from .context import (
+    AccountContext, CacheContextStore, DatabaseContextStore,
+    MemoryContextStore
+)
+from .errors import ConcurrentUpdate
+from .lanes import Lane, LanePool
+from .message_log import archive_messages
+from .messengers.telegram import AsyncTelegram
+from .models import (
+    Account, MessageDirection, MessageLog, Messenger, MessengerType,
+    OutboxMessage, OutboxStatus
+)
+from .outbox import OutboxRelay
+from .settings import bot_api_settings
+from .signals import account_updated
+from .types import Button, Picture, Text
+
+
+class ProbeAccountsTests(TestCase):
+
+    def setUp(self):
+        self.messenger = Messenger.objects.create(
+            title='bot', api_type=MessengerType.TELEGRAM, token='token')
+        self.inactive = Account.objects.create(
+            id='1', messenger=self.messenger, is_active=False)
+        self.active = Account.objects.create(
+            id='2', messenger=self.messenger, is_active=True)
+
+    def test_success_keeps_account_inactive(self):
+        # getChat succeeds for a user who blocked the bot
+        with mock.patch.object(apihelper, 'get_chat', return_value={}):
+            changed = self.messenger.probe_accounts()
+
+        self.assertEqual(changed, 0)
+        self.inactive.refresh_from_db()
+        self.active.refresh_from_db()
+        self.assertFalse(self.inactive.is_active)
+        self.assertTrue(self.active.is_active)
+
+    def test_forbidden_deactivates_account(self):
+        error = Exception('A request to the Telegram API was unsuccessful. '
+                          'Error code: 403. Description: Forbidden')
+        with mock.patch.object(apihelper, 'get_chat', side_effect=error):
+            changed = self.messenger.probe_accounts()
+
+        self.assertEqual(changed, 1)
+        self.active.refresh_from_db()
+        self.assertFalse(self.active.is_active)
+
+    def test_result_mapping(self):
+        errors = {
+            '1': Exception('Error code: 400. Description: chat not found'),
+            '2': Exception('Error code: 403. Description: Forbidden'),
+            '3': Exception('Error code: 500. Description: Internal'),
+        }
+
+        def get_chat(token, user_id):
+            if user_id in errors:
+                raise errors[user_id]
+            return {'id': user_id}
+
+        with mock.patch.object(apihelper, 'get_chat', side_effect=get_chat):
+            result = self.messenger.api.probe_accounts(['1', '2', '3', '4'])
+
+        self.assertEqual(result, {'1': False, '2': False,
+                                  '3': None, '4': None})
+
+
+class OutboxRelayTests(TestCase):
+
+    def setUp(self):
+        self.messenger = Messenger.objects.create(
+            title='bot', api_type=MessengerType.TELEGRAM, token='token')
+        self.account = Account.objects.create(
+            id='1', messenger=self.messenger, is_active=True)
+        OutboxMessage.enqueue(self.account, Text(text='hello'), 'update:1')
+
+    def expire(self):
+        OutboxMessage.objects.update(
+            available_at=timezone.now() - timedelta(seconds=1))
+
+    def test_claim_leases_for_one_send(self):
+        relay = OutboxRelay()
+        item, = relay.claim()
+
+        lease = (item.available_at - timezone.now()).total_seconds()
+        self.assertLessEqual(lease, OutboxRelay.send_time())
+        self.assertEqual(OutboxRelay().claim(), [])
+
+    def test_lease_takeover(self):
+        first, second = OutboxRelay(), OutboxRelay()
+        lost, = first.claim()
+        self.expire()
+
+        with mock.patch.object(Messenger, 'call_api',
+                               return_value=['1_1']) as call_api:
+            self.assertEqual(second.drain(), (1, 0))
+            first._messengers[self.messenger.id] = self.messenger
+            self.assertIsNone(first.send(lost))
+
+        self.assertEqual(call_api.call_count, 1)
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.status, OutboxStatus.SENT)
+        self.assertEqual(message.attempts, 1)
+
+    def test_extend_checks_the_lease(self):
+        relay = OutboxRelay()
+        item, = relay.claim()
+        stale = copy.copy(item)
+
+        self.assertTrue(relay.extend(item))
+        self.assertGreater(item.leased_until, stale.leased_until)
+        self.assertFalse(relay.extend(stale))
+
+
+class AccountConcurrencyTests(TestCase):
+
+    def setUp(self):
+        self.account = Account.objects.create(id='1', username='old')
+
+    def test_update_conflict(self):
+        first = Account.objects.get(id='1')
+        second = Account.objects.get(id='1')
+
+        first.update(username='first')
+        with self.assertRaises(ConcurrentUpdate):
+            second.update(username='second')
+
+        second.reload()
+        second.update(username='second')
+        self.assertEqual(Account.objects.get(id='1').version, 2)
+
+    def test_save_conflict(self):
+        first = Account.objects.get(id='1')
+        second = Account.objects.get(id='1')
+
+        first.username = 'first'
+        first.save()
+        second.username = 'second'
+        with self.assertRaises(ConcurrentUpdate):
+            second.save(update_fields=['username'])
+        with self.assertRaises(ConcurrentUpdate):
+            second.save()
+
+        account = Account.objects.get(id='1')
+        self.assertEqual(account.username, 'first')
+        self.assertEqual(account.version, first.version)
+        self.assertEqual(account.version, 1)
+
+    def test_updated_signal(self):
+        received = []
+
+        def receiver(sender, instance, **kwargs):
+            received.append(instance.version)
+
+        account_updated.connect(receiver)
+        try:
+            self.account.update(username='new')
+            self.account.save()
+        finally:
+            account_updated.disconnect(receiver)
+        self.assertEqual(received, [1, 2])
+
+
+class DetachedHandlerTests(TransactionTestCase):
+    # the handler runs in another thread with its own connection
+
+    def setUp(self):
+        self.account = Account.objects.create(id='1', username='old')
+        self.account.begin_update('1:100')
+
+    @mock.patch.object(bot_api_settings, 'HANDLER_TIME_BUDGET', 5)
+    def test_account_is_attached_after_the_handler(self):
+        keys = []
+
+        def handler(account):
+            keys.append(account.next_idempotency_key())
+            account.update(username='new')
+            account.state['step'] = 2
+
+        handler_budget.run('tests.handler', handler, self.account)
+
+        self.assertEqual(self.account.username, 'new')
+        self.assertEqual(self.account.state['step'], 2)
+        self.account.update(username='newer')
+        self.assertEqual(keys, ['1:100:detached:1:1'])
+        self.assertEqual(self.account.next_idempotency_key(), '1:100:1')
+
+
+class AsyncClientTests(TestCase):
+
+    def test_client_per_event_loop(self):
+        connector = AsyncTelegram('token')
+
+        async def clients():
+            return connector.client, connector.client
+
+        first, same = asyncio.run(clients())
+        shared, _ = run_coroutine(clients()).result()
+        self.assertIs(first, same)
+        self.assertIsNot(first, shared)
+
+        async def close():
+            client = connector.client
+            await AsyncTelegram.aclose()
+            return client.is_closed, connector.client is client
+
+        self.assertEqual(asyncio.run(close()), (True, False))
+
+
+class BulkheadTests(TestCase):
+
+    def test_async_call_from_different_loops(self):
+        bulkhead = Bulkhead('test', max_concurrent=2, max_queue=0,
+                            timeout=5, breaker=CircuitBreaker(5, 30))
+
+        async def answer():
+            await asyncio.sleep(0.01)
+            return 42
+
+        async def calls():
+            # more calls than slots, so they wait for the semaphore
+            return await asyncio.gather(
+                *(bulkhead.acall(answer) for _ in range(3)))
+
+        self.assertEqual(asyncio.run(calls()), [42] * 3)
+        self.assertEqual(run_coroutine(calls()).result(), [42] * 3)
+        self.assertEqual(asyncio.run(calls()), [42] * 3)
+
+
+class LanePoolTests(TestCase):
+
+    class FakeMessenger:
+
+        def __init__(self):
+            self.release = threading.Event()
+            self.dispatched = []
+
+        def dispatch_message(self, message):
+            self.release.wait(5)
+            self.dispatched.append(message)
+
+    def test_message_never_waits_in_a_slower_lane(self):
+        messenger = self.FakeMessenger()
+        pool = LanePool({Lane.INTERACTIVE: 1, Lane.TEXT: 1, Lane.MEDIA: 1})
+
+        media = Picture(user_id='1')
+        button = Button('start', user_id='1')
+        text = Text(text='hello', user_id='1')
+        lanes = [pool.submit(messenger, message, b'')
+                 for message in (media, button, text)]
+        messenger.release.set()
+        pool.join()
+
+        # the text follows the button of the chat to the faster lane
+        self.assertEqual(lanes, [Lane.MEDIA, Lane.INTERACTIVE,
+                                 Lane.INTERACTIVE])
+        self.assertLess(messenger.dispatched.index(button),
+                        messenger.dispatched.index(text))
+        self.assertEqual(pool._chats, {})
+
+
+class ContextStoreTestsMixin:
+
+    def make_store(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        Account.objects.create(id='1')
+        cache.clear()
+        self.store = self.make_store()
+
+    def test_set_many_keeps_other_keys(self):
+        self.store.set_many('1', {'a': 1, 'b': {'x': [1, 2]}})
+        self.store.set_many('1', {'c': 'text'}, deleted=['a'])
+
+        self.assertEqual(self.store.get_many('1'),
+                         {'b': {'x': [1, 2]}, 'c': 'text'})
+        self.assertEqual(self.store.get('1', 'a', 'missing'), 'missing')
+
+    def test_incr(self):
+        self.assertEqual(self.store.incr('1', 'count'), 1)
+        self.assertEqual(self.store.incr('1', 'count', 5), 6)
+        self.store.set('1', 'other', True)
+
+        self.assertEqual(self.store.get_many('1'),
+                         {'count': 6, 'other': True})
+
+    def test_ttl(self):
+        self.store.set('1', 'code', 1234, ttl=60)
+        self.store.set('1', 'name', 'kept')
+        self.assertEqual(self.store.get('1', 'code'), 1234)
+
+        # stores check the expiration with the wall or monotonic clock
+        wall, monotonic = time.time() + 61, time.monotonic() + 61
+        with mock.patch('time.time', return_value=wall):
+            with mock.patch('time.monotonic', return_value=monotonic):
+                self.assertEqual(self.store.get_many('1'), {'name': 'kept'})
+
+    def test_account_context(self):
+        context = AccountContext('1', self.store)
+        context['step'] = 2
+        context.set('code', 1234, ttl=60)
+        self.assertEqual(context.incr('visits'), 1)
+        # changed keys are written by save(), increments at once
+        self.assertEqual(self.store.get_many('1'), {'visits': 1})
+
+        context.save()
+        self.assertEqual(AccountContext('1', self.store).all(),
+                         {'step': 2, 'code': 1234, 'visits': 1})
+
+
+class DatabaseContextStoreTests(ContextStoreTestsMixin, TestCase):
+
+    def make_store(self):
+        return DatabaseContextStore()
+
+    def test_row_update_fallback(self):
+        self.store.set_many('1', {'a': 1, 'b': 2})
+        self.store._update_row('1', {'c': 3}, ['a'])
+
+        self.assertEqual(self.store.get_many('1'), {'b': 2, 'c': 3})
+        self.assertEqual(Account.objects.get(id='1').version, 0)
+
+
+class CacheContextStoreTests(ContextStoreTestsMixin, TestCase):
+
+    def make_store(self):
+        return CacheContextStore()
+
+
+class MemoryContextStoreTests(ContextStoreTestsMixin, TestCase):
+
+    def make_store(self):
+        return MemoryContextStore()
+
+
+class MessageSearchTests(TestCase):
+
+    def setUp(self):
+        texts = ('Hello world', 'world peace', 'say "hello"', 'other')
+        self.logs = [MessageLog.objects.create(
+            direction=MessageDirection.INCOMING, message_type='Text',
+            text=text) for text in texts]
+
+    def search(self, query):
+        return set(MessageLog.objects.search(query)
+                   .values_list('text', flat=True))
+
+    def check_search(self):
+        self.assertEqual(self.search('hello'), {'Hello world', 'say "hello"'})
+        self.assertEqual(self.search('world hello'), {'Hello world'})
+        self.assertEqual(self.search('  '), {log.text for log in self.logs})
+        # the user input is not parsed as a query syntax
+        self.assertEqual(self.search('"hello" OR'), set())
+
+        self.logs[0].delete()
+        self.assertEqual(self.search('hello'), {'say "hello"'})
+
+    def test_search(self):
+        # the FTS5 index of SQLite if it is built with FTS5
+        self.check_search()
+
+    @mock.patch('bot_engine.search.has_fts_table', return_value=False)
+    def test_like_fallback(self, has_fts_table):
+        self.check_search()
+        self.assertTrue(has_fts_table.called)
+
+
+class ArchiveMessagesTests(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.storage = FileSystemStorage(self.tmp.name)
+        day = datetime(2020, 5, 1, 12, tzinfo=dt_timezone.utc)
+        for created, text in ((day, 'first'),
+                              (day + timedelta(hours=1), 'second'),
+                              (day + timedelta(days=1), 'next day'),
+                              (timezone.now(), 'recent')):
+            MessageLog.objects.create(
+                direction=MessageDirection.OUTGOING, message_type='Text',
+                text=text, payload={'extra': text}, created=created)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        archived = {row['id']: row for row in MessageLog.objects.exclude(
+            text='recent').values()}
+        border = timezone.now() - timedelta(days=1)
+
+        files = list(archive_messages(border, self.storage, path='log'))
+
+        self.assertEqual(files, [('log/2020/05/2020-05-01.jsonl.gz', 2),
+                                 ('log/2020/05/2020-05-02.jsonl.gz', 1)])
+        self.assertEqual(list(MessageLog.objects.values_list('text',
+                                                             flat=True)),
+                         ['recent'])
+        # the archived rows are loaded back as they were
+        for name, _ in files:
+            with self.storage.open(name) as file:
+                rows = [json.loads(line) for line in gzip.open(file)]
+            MessageLog.objects.bulk_create(MessageLog(**row) for row in rows)
+        restored = {row['id']: row for row in MessageLog.objects.exclude(
+            text='recent').values()}
+        self.assertEqual(restored, archived)
+
+    def test_without_delete(self):
+        border = timezone.now() - timedelta(days=1)
+        files = list(archive_messages(border, self.storage, path='log',
+                                      delete=False))
+
+        self.assertEqual(len(files), 2)
+        self.assertEqual(MessageLog.objects.count(), 4)
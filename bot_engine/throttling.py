@@ -0,0 +1,60 @@
+import threading
+import time
+from typing import Dict, Hashable, Tuple
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter with a separate bucket for each key
+    (as a rule, a messenger id). Buckets that have refilled are the
+    same as missing ones and are dropped when there are many of them.
+    """
+
+    def __init__(self, rate: float, burst: int = None,
+                 max_buckets: int = 1024):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, int(rate)))
+        self.max_buckets = max_buckets
+        self._buckets: Dict[Hashable, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def delay(self, key: Hashable = None) -> float:
+        """
+        Take a token from the bucket if it is available.
+        :param key: bucket key
+        :return: 0 if the token is taken, otherwise seconds to wait
+        """
+        if self.rate <= 0:
+            return 0.0
+
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if key not in self._buckets and (
+                    len(self._buckets) >= self.max_buckets):
+                self._prune(now)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return 0.0
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+
+    def _prune(self, now: float):
+        refill = self.burst / self.rate
+        self._buckets = {
+            key: (tokens, updated)
+            for key, (tokens, updated) in self._buckets.items()
+            if now - updated < refill
+        }
+
+    def acquire(self, key: Hashable = None):
+        """
+        Block until a token from the bucket is taken.
+        :param key: bucket key
+        :return: None
+        """
+        wait = self.delay(key)
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.delay(key)
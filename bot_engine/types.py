@@ -1,7 +1,8 @@
 from __future__ import annotations
 from dataclasses import dataclass
-from datetime import datetime
-from typing import List, Union
+from datetime import datetime, timezone
+from os import PathLike
+from typing import BinaryIO, List, Optional, Union
 
 
 class Message:
@@ -26,6 +27,19 @@ class Message:
         self.buttons = buttons
         self.inline_buttons = inline_buttons
 
+    @property
+    def sent_at(self) -> Optional[datetime]:
+        """
+        Timestamp as datetime, messengers send it in seconds (Telegram)
+        or milliseconds (Viber) since the epoch.
+        """
+        if self.timestamp is None or isinstance(self.timestamp, datetime):
+            return self.timestamp
+        timestamp = float(self.timestamp)
+        if timestamp > 1e11:
+            timestamp /= 1000
+        return datetime.fromtimestamp(timestamp, timezone.utc)
+
     def __str__(self) -> str:
         return (f'{self.__class__.__name__}(id={self.id}, '
                 f'im_type={self.im_type}, user={self.user_id})')
@@ -103,11 +117,13 @@ class File(Message):
                  file_size: int = None,
                  file_name: str = None,
                  file_mime_type: str = None,
-                 text: str = None, **kwargs):
+                 text: str = None,
+                 file: Union[str, PathLike, BinaryIO] = None, **kwargs):
         super().__init__(**kwargs)
 
         self.file_id = file_id
         self.file_url = file_url
+        self.file = file
         self.file_size = file_size
         self.file_name = file_name
         self.file_mime_type = file_mime_type
@@ -122,11 +138,13 @@ class Picture(Message):
                  file_size: int = None,
                  file_name: str = None,
                  file_mime_type: str = None,
-                 text: str = None, **kwargs):
+                 text: str = None,
+                 file: Union[str, PathLike, BinaryIO] = None, **kwargs):
         super().__init__(**kwargs)
 
         self.file_id = file_id
         self.file_url = file_url
+        self.file = file
         self.file_size = file_size
         self.file_name = file_name
         self.file_mime_type = file_mime_type
@@ -162,11 +180,13 @@ class Audio(Message):
                  file_mime_type: str = None,
                  file_duration: int = None,
                  is_voice: bool = False,
-                 text: str = None, **kwargs):
+                 text: str = None,
+                 file: Union[str, PathLike, BinaryIO] = None, **kwargs):
         super().__init__(**kwargs)
 
         self.file_id = file_id
         self.file_url = file_url
+        self.file = file
         self.file_size = file_size
         self.file_name = file_name
         self.file_mime_type = file_mime_type
@@ -185,11 +205,13 @@ class Video(Message):
                  file_mime_type: str = None,
                  file_duration: int = None,
                  is_video_note: bool = False,
-                 text: str = None, **kwargs):
+                 text: str = None,
+                 file: Union[str, PathLike, BinaryIO] = None, **kwargs):
         super().__init__(**kwargs)
 
         self.file_id = file_id
         self.file_url = file_url
+        self.file = file
         self.file_size = file_size
         self.file_name = file_name
         self.file_mime_type = file_mime_type
@@ -0,0 +1,42 @@
+from datetime import datetime
+from typing import Iterator, List, Optional
+
+from django.conf import settings
+from django.db.models import QuerySet
+from django.utils import timezone
+
+
+def keyset_batches(queryset: QuerySet, batch_size: int = 500) -> Iterator[List]:
+    """
+    Iterate over a queryset in batches ordered by the primary key.
+    Each batch is selected with `pk > last pk` instead of OFFSET,
+    so the cost of a batch does not depend on its position.
+    :param queryset: queryset of any model
+    :param batch_size: number of objects in a batch
+    :return: iterator over lists of objects
+    """
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        batch_qs = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        batch = list(batch_qs[:batch_size])
+        if not batch:
+            return
+        last_pk = batch[-1].pk
+        yield batch
+
+
+def normalize_datetime(value: Optional[datetime]) -> Optional[datetime]:
+    """
+    Make the datetime aware or naive according to the USE_TZ setting,
+    like `timezone.now()`. Messenger timestamps are aware (UTC),
+    with USE_TZ = False they are converted to naive local time.
+    :param value: datetime or None
+    :return: datetime that can be compared with `timezone.now()`
+    """
+    if value is None:
+        return None
+    if settings.USE_TZ:
+        return value if timezone.is_aware(value) else (
+            timezone.make_aware(value))
+    return timezone.make_naive(value) if timezone.is_aware(value) else value
@@ -9,7 +9,9 @@ from django.utils.decorators import method_decorator
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 
-from .models import Messenger
+from .backpressure import load_guard
+from .errors import Overloaded
+from .models import FailedUpdate, Messenger
 
 
 log = logging.getLogger(__name__)
@@ -49,19 +51,36 @@ class MessengerWebhook(View):
 
         try:
             messenger = Messenger.objects.get(hash=im_hash)
-            answer = messenger.dispatch(request)
+        except Messenger.DoesNotExist as err:
+            log.exception(f'Bot Engine Webhook; Messenger not found; '
+                          f'Hash={im_hash}; Error={err};')
+            return HttpResponseNotFound('Webhook not found.')
+
+        try:
+            with load_guard.track():
+                answer = messenger.dispatch(request)
             if answer is not None:
                 answer = json.dumps(answer).encode('utf-8')
                 content_type = 'application/json'
                 log.debug(f'Bot Engine Webhook; Response={answer};')
             else:
                 answer, content_type = b'', None
-        except Messenger.DoesNotExist as err:
-            log.exception(f'Bot Engine Webhook; Messenger not found; '
-                          f'Hash={im_hash}; Error={err};')
-            return HttpResponseNotFound('Webhook not found.')
+        except Overloaded as err:
+            log.warning(f'Bot Engine Webhook; Hash={im_hash}; Error={err};')
+            response = HttpResponse('Service unavailable.', status=503)
+            response['Retry-After'] = str(err.retry_after or 1)
+            return response
         except Exception as err:
             log.exception(f'Bot Engine Webhook; Hash={im_hash}; Error={err};')
-            return HttpResponseServerError('Server error.')
+            # the update is acknowledged, otherwise the messenger API
+            # retries it and blocks the delivery of the next ones
+            try:
+                FailedUpdate.capture(messenger, request.body, err,
+                                     request.META)
+            except Exception as save_err:
+                log.exception(f'Bot Engine Webhook; Hash={im_hash}; '
+                              f'Failed update not saved; Error={save_err};')
+                return HttpResponseServerError('Server error.')
+            return HttpResponse()
 
         return HttpResponse(answer, content_type=content_type)
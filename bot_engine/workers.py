@@ -0,0 +1,87 @@
+import logging
+import threading
+from queue import Queue
+from typing import Any, Callable, Hashable, List
+
+from django.db import close_old_connections
+
+from .settings import bot_api_settings
+
+
+log = logging.getLogger(__name__)
+
+
+class OrderedWorkerPool:
+    """
+    Pool of worker threads that keeps the order of items with the same key.
+    Every key is bound to one worker, so items of one chat are processed
+    one by one and items of different chats are processed in parallel.
+    """
+
+    def __init__(self, handler: Callable[[Any], Any], workers: int = 4,
+                 name: str = 'bot-engine-worker'):
+        self.handler = handler
+        self._queues: List[Queue] = [Queue() for _ in range(max(1, workers))]
+        self._threads = [
+            threading.Thread(target=self._run, args=(queue, ),
+                             name=f'{name}-{i}', daemon=True)
+            for i, queue in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key: Hashable, item: Any):
+        """
+        Queue the item for processing.
+        :param key: ordering key, e.g. chat id
+        :param item: item passed to the handler
+        :return: None
+        """
+        self._queues[hash(key) % len(self._queues)].put(item)
+
+    def qsize(self) -> int:
+        """
+        Approximate number of queued items.
+        """
+        return sum(queue.qsize() for queue in self._queues)
+
+    def join(self):
+        """
+        Block until all queued items are processed.
+        """
+        for queue in self._queues:
+            queue.join()
+
+    def _run(self, queue: Queue):
+        while True:
+            item = queue.get()
+            close_old_connections()
+            try:
+                self.handler(item)
+            except Exception as err:
+                log.exception(f'Worker; Item={item}; Error={err};')
+            finally:
+                close_old_connections()
+                queue.task_done()
+
+
+_deferred_pool = None
+_deferred_lock = threading.Lock()
+
+
+def deferred_pool() -> OrderedWorkerPool:
+    """
+    Low priority pool for deferred stale messages.
+    It has few workers, so the backlog is drained without taking
+    the capacity of fresh messages.
+    """
+    global _deferred_pool
+    if _deferred_pool is None:
+        with _deferred_lock:
+            if _deferred_pool is None:
+                _deferred_pool = OrderedWorkerPool(
+                    lambda item: item[0].dispatch_message(
+                        item[1], deferred=True),
+                    workers=bot_api_settings.STALE_WORKERS,
+                    name='bot-engine-deferred')
+    return _deferred_pool
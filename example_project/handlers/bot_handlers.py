@@ -7,11 +7,17 @@ from bot_engine.types import Message
 
 @bot.handler
 def main_menu_echo(message: Message, account: Account):
-    if account.context.get('reply'):
+    if account.state.get('reply'):
         message.reply_to_id = message.id
     account.send_message(message)
 
 
+@bot.handler
+async def async_echo(message: Message, account: Account):
+    # async handlers send with asend_message
+    await account.asend_message(message)
+
+
 @bot.handler
 def submenu_text(message: Message, account: Account):
     answer = Message.text(text=f'This is a submenu handler. '
@@ -22,7 +28,7 @@ def submenu_text(message: Message, account: Account):
 
 @bot.button_handler
 def button_context(message: Message, account: Account):
-    answer = Message.text(text=json.dumps(account.context))
+    answer = Message.text(text=json.dumps(account.state.all()))
     account.send_message(answer)
 
 
@@ -34,11 +40,10 @@ def button_menu(message: Message, account: Account):
 
 @bot.button_handler
 def button_answer_type(message: Message, account: Account):
-    if account.context.get('reply'):
-        account.context['reply'] = False
-        account.save()
+    # only the changed key is written after the dispatch
+    if account.state.get('reply'):
+        account.state['reply'] = False
         account.send_message(Message.text('Reply disabled'))
     else:
-        account.context['reply'] = True
-        account.save()
+        account.state['reply'] = True
         account.send_message(Message.text('Reply enabled'))
@@ -14,8 +14,11 @@ setup(
     license='Apache License 2.0',
     author='Aleksey Terentyev',
     author_email='terentjew.alexey@gmail.com',
+    python_requires='>=3.8',
     install_requires=open('requirements.txt').readlines(),
-    packages=['bot_engine', 'bot_engine.messengers', 'bot_engine.migrations'],
+    packages=['bot_engine', 'bot_engine.management',
+              'bot_engine.management.commands', 'bot_engine.messengers',
+              'bot_engine.migrations'],
     classifiers=[
         'Development Status :: 2 - Pre-Alpha',
         'Framework :: Django',
@@ -23,8 +26,6 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: Apache Software License',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
-        'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
         'Environment :: Other Environment',
         'Operating System :: OS Independent',